@@ -0,0 +1,640 @@
+"""
+Benchmarks of the pathway and infilling code
+
+The benchmarks use synthetic data (see ``synthetic.py``) so they can be run
+without the processed data and at sizes larger than the current NDC dataset.
+The timings and peak memory usage of each benchmark are written to a JSON file
+named after the current commit so runs on different commits can be compared.
+
+Usage::
+
+    python benchmarks/run.py --preset small
+    python benchmarks/run.py --countries 2000 --dates 50 --db memory \\
+        --only ArrayNDCCruncher
+    python benchmarks/run.py --compare results/abc.json results/def.json
+"""
+
+import argparse
+import atexit
+import datetime as dt
+import functools
+import importlib
+import inspect
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+os.environ.setdefault("TQDM_DISABLE", "1")
+
+import numpy as np  # noqa: E402
+import pandas as pd  # noqa: E402
+import scmdata  # noqa: E402
+import scmdata.database  # noqa: E402
+
+# Only the code which exists in every commit is imported here, the rest is
+# imported by the benchmarks which use it (see ``_require``)
+import ndcs.pathways  # noqa: E402
+from ndcs.constants import LEAD  # noqa: E402
+from ndcs.infilling import (  # noqa: E402
+    EqualQuantileWalk_MM,
+    calc_ghg,
+    extend_timeseries,
+    kyoto_ghg_exclude_co2_vars,
+)
+from ndcs.pathways import (  # noqa: E402
+    get_latest,
+    sum_country_emissions,
+)
+
+sys.path.insert(0, os.path.dirname(__file__))
+import synthetic  # noqa: E402
+
+ROOT_DIR = os.path.join(os.path.dirname(__file__), "..")
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+
+PRESETS = {
+    "small": dict(countries=20, dates=6, years=41, combinations=2, db_scenarios=50),
+    "medium": dict(countries=200, dates=20, years=41, combinations=8, db_scenarios=200),
+    "large": dict(
+        countries=2000, dates=50, years=41, combinations=24, db_scenarios=1000
+    ),
+}
+
+
+def _require(module, *names):
+    """
+    Import ``names`` from ``module``
+
+    Names can refer to attributes, e.g. ``"EqualQuantileWalk_MM.derive_relationships"``.
+
+    Raises
+    ------
+    ImportError
+        Any of the names does not exist, e.g. when benchmarking a commit from
+        before they were added
+    """
+    module = importlib.import_module(module)
+
+    res = []
+    for name in names:
+        try:
+            res.append(functools.reduce(getattr, name.split("."), module))
+        except AttributeError:
+            raise ImportError("{}.{} does not exist".format(module.__name__, name))
+
+    return res
+
+
+class Benchmark:
+    """
+    A benchmark
+
+    ``setup`` is called before each repeat and its result is passed to ``run``,
+    only ``run`` is measured. ``make`` returns ``run`` and ``setup`` and is only
+    called when the benchmark is created. If it raises an :class:`ImportError`,
+    the benchmark is skipped.
+    """
+
+    def __init__(self, name, make):
+        self.name = name
+        try:
+            self._run, self._setup = make()
+            self.skip = None
+        except ImportError as exc:
+            self._run, self._setup = None, None
+            self.skip = str(exc)
+
+    def setup(self):
+        return self._setup() if self._setup is not None else None
+
+    def run(self, state):
+        return self._run(state) if state is not None else self._run()
+
+
+class _Database(scmdata.database.ScmDatabase):
+    def save(self, scmrun, disable_tqdm=True):
+        super(_Database, self).save(scmrun, disable_tqdm=disable_tqdm)
+
+
+class _MemoryDatabase:
+    """
+    Database which keeps the saved pathways in memory
+    """
+
+    levels = ()
+
+    def __init__(self):
+        self.runs = []
+
+    def save(self, scmrun, disable_tqdm=True):
+        self.runs.append(scmrun)
+
+
+def _database(root_dir, bulk=False):
+    """
+    Get the disk database to save the crunched pathways to
+
+    If ``bulk`` is True and the code supports it, all the pathways of a
+    combination of options are stored in one file.
+    """
+    if bulk:
+        try:
+            levels, backend_cls = _require(
+                "ndcs.pathways", "BUFFERED_DATABASE_LEVELS", "PathwayDatabaseBackend"
+            )
+        except ImportError:
+            pass
+        else:
+            return _Database(
+                root_dir,
+                levels=levels,
+                backend=backend_cls(levels=levels, root_dir=root_dir),
+            )
+
+    return _Database(
+        root_dir,
+        levels=(
+            "ambition",
+            "conditionality",
+            "country_extension",
+            "exclude_hot_air",
+            "pathway_id",
+        ),
+    )
+
+
+def _crunch_setup(db, bulk=False):
+    try:
+        (meta_store_cls,) = _require("ndcs.pathway_meta", "PathwayMetaStore")
+    except ImportError:
+        # The metadata is written to a JSON file per pathway
+        meta_store_cls = None
+
+    def _setup():
+        out_dir = tempfile.TemporaryDirectory()
+        ndcs.pathways.GLOBAL_DATABASE_META_DIR = os.path.join(out_dir.name, "meta")
+        if db == "memory":
+            output_db = _MemoryDatabase()
+        else:
+            output_db = _database(os.path.join(out_dir.name, "global"), bulk=bulk)
+        meta_store = None
+        if meta_store_cls is not None:
+            meta_store = meta_store_cls(os.path.join(out_dir.name, "meta.sqlite"))
+
+        return out_dir, output_db, meta_store
+
+    return _setup
+
+
+def _supported_kwargs(cls, **kwargs):
+    """
+    Get the keyword arguments which ``cls`` accepts
+
+    Subclasses which pass ``**kwargs`` on to their parent accept the keyword
+    arguments of the parent.
+    """
+    for klass in cls.__mro__:
+        parameters = inspect.signature(klass).parameters
+        if not any(p.kind == p.VAR_KEYWORD for p in parameters.values()):
+            break
+
+    return {k: v for k, v in kwargs.items() if k in parameters}
+
+
+def get_benchmarks(data, db="disk"):
+    """
+    Get the benchmarks for a set of synthetic data
+
+    If ``db`` is ``"memory"`` the crunched pathways are kept in memory rather
+    than saved to a :class:`scmdata.database.ScmDatabase`.
+
+    The code used by each benchmark is imported when the benchmark is created,
+    so the benchmarks of code which does not exist in the current commit are
+    skipped rather than stopping the whole run.
+    """
+    crunch_setup = _crunch_setup(db)
+    bulk_crunch_setup = _crunch_setup(db, bulk=True)
+    country_emms = data["country_emms"]
+    baseline_emms = data["baseline_emms"]
+    option = data["options"][0]
+
+    latest = get_latest(
+        country_emms.filter(**dict(zip(synthetic.OPTION_VALUES, option)))
+    )
+    infilling_db = data["infilling_database"].to_iamdataframe()
+    lead_scenarios = data["lead_scenarios"].to_iamdataframe()
+    extension_database = calc_ghg(
+        data["infilling_database"], kyoto_ghg_exclude_co2_vars
+    )
+    pathways = synthetic.make_pathways(data["lead_scenarios"])
+
+    def infilling_index():
+        (cls,) = _require("ndcs.infilling_database", "InfillingDatabase")
+        return cls(data["infilling_database"])
+
+    def crunch(cls):
+        def _run(state):
+            _, output_db, meta_store = state
+            cls(
+                output_db,
+                country_emms,
+                baseline_emms,
+                *option,
+                **_supported_kwargs(cls, buffer_writes=True, meta_store=meta_store),
+            ).crunch()
+
+        return _run
+
+    def crunch_cls(name):
+        def _make():
+            (cls,) = _require("ndcs.pathways", name)
+            if _supported_kwargs(cls, buffer_writes=True):
+                # The buffered pathways are written to shared files
+                return crunch(cls), bulk_crunch_setup
+
+            return crunch(cls), crunch_setup
+
+        return _make
+
+    def crunch_multi():
+        (cls,) = _require("ndcs.pathways", "MultiNDCCruncher")
+
+        def _run(state):
+            _, output_db, meta_store = state
+            cls(
+                output_db,
+                country_emms,
+                baseline_emms,
+                options=data["options"],
+                meta_store=meta_store,
+            ).crunch()
+
+        return _run, bulk_crunch_setup
+
+    def crunch_shared_task():
+        shared_run_cls, crunch_shared, cls = _require(
+            "ndcs.pathways", "_SharedRun", "_crunch_shared", "ArrayNDCCruncher"
+        )
+        # The shared memory is created once, as ``crunch_all`` does, and the
+        # task is run in this process so its allocations are traced
+        country_shm, country = shared_run_cls.create(country_emms)
+        baseline_shm, baseline = shared_run_cls.create(baseline_emms)
+        for shm in [country_shm, baseline_shm]:
+            atexit.register(shm.unlink)
+            atexit.register(shm.close)
+        task_country = country.subset(**dict(zip(synthetic.OPTION_VALUES, option)))
+
+        def _run(state):
+            _, output_db, meta_store = state
+            crunch_shared(
+                cls,
+                output_db,
+                task_country,
+                baseline,
+                option,
+                dict(buffer_writes=True, meta_store=meta_store),
+            )
+
+        return _run, bulk_crunch_setup
+
+    def sum_remainder():
+        (cls,) = _require("ndcs.pathways", "BaselineRemainder")
+        return (
+            lambda remainder: sum_country_emissions(latest, remainder),
+            lambda: cls(baseline_emms),
+        )
+
+    def prepare_index():
+        index = infilling_index()
+        return (
+            lambda: EqualQuantileWalk_MM(index, kyoto_ghg_exclude_co2_vars),
+            None,
+        )
+
+    def make_index():
+        (cls,) = _require("ndcs.infilling_database", "InfillingDatabase")
+        return lambda: cls(data["infilling_database"]), None
+
+    def quantile_sketch():
+        (cls,) = _require("ndcs.quantile_sketch", "QuantileSketch")
+        (quantiles,) = _require("ndcs.infilling", "DEFAULT_QUANTILES")
+        return (
+            lambda: cls().update(data["infilling_database"]).quantiles(quantiles),
+            None,
+        )
+
+    def infill_setup():
+        return EqualQuantileWalk_MM(infilling_db, kyoto_ghg_exclude_co2_vars)
+
+    def infill_filler():
+        def _run(cruncher):
+            for gas in kyoto_ghg_exclude_co2_vars:
+                cruncher.derive_relationship(gas, [LEAD])(lead_scenarios)
+
+        return _run, infill_setup
+
+    def infill_filler_all():
+        _require("ndcs.infilling", "EqualQuantileWalk_MM.derive_relationships")
+
+        def _run(cruncher):
+            cruncher.derive_relationships(kyoto_ghg_exclude_co2_vars, [LEAD])(
+                lead_scenarios
+            )
+
+        return _run, infill_setup
+
+    def infill_filler_scmrun():
+        _require("ndcs.infilling", "EqualQuantileWalk_MM.derive_scmrun_relationships")
+
+        def _run(cruncher):
+            cruncher.derive_scmrun_relationships(kyoto_ghg_exclude_co2_vars, [LEAD])(
+                data["lead_scenarios"]
+            )
+
+        return _run, infill_setup
+
+    def extend_loop():
+        def _run():
+            for pathway_id in pathways.get_unique_meta("pathway_id"):
+                extend_timeseries(
+                    extension_database, pathways.filter(pathway_id=pathway_id)
+                )
+
+        return _run, None
+
+    def extender():
+        (cls,) = _require("ndcs.infilling", "TimeseriesExtender")
+        return (
+            lambda extender: extender.extend(pathways),
+            lambda: cls(extension_database),
+        )
+
+    def calc_ghg_index():
+        index = infilling_index()
+        return lambda: calc_ghg(index, kyoto_ghg_exclude_co2_vars), None
+
+    def calc_ghg_contexts():
+        # Lists of contexts were added together with GHG_UNIT
+        _require("ndcs.infilling", "GHG_UNIT")
+        return (
+            lambda: calc_ghg(
+                data["infilling_database"],
+                kyoto_ghg_exclude_co2_vars,
+                context=["AR6GWP100", "AR5GWP100", "AR4GWP100"],
+            ),
+            None,
+        )
+
+    return [
+        Benchmark(
+            "sum_country_emissions",
+            lambda: (lambda: sum_country_emissions(latest, baseline_emms), None),
+        ),
+        Benchmark("sum_country_emissions[BaselineRemainder]", sum_remainder),
+        Benchmark("NDCCruncher", crunch_cls("NDCCruncher")),
+        Benchmark("ArrayNDCCruncher", crunch_cls("ArrayNDCCruncher")),
+        Benchmark("MultiNDCCruncher", crunch_multi),
+        Benchmark("crunch_all[task]", crunch_shared_task),
+        Benchmark(
+            "EqualQuantileWalk_MM[prepare]",
+            lambda: (
+                lambda: EqualQuantileWalk_MM(infilling_db, kyoto_ghg_exclude_co2_vars),
+                None,
+            ),
+        ),
+        Benchmark("EqualQuantileWalk_MM[prepare, InfillingDatabase]", prepare_index),
+        Benchmark("InfillingDatabase", make_index),
+        Benchmark("QuantileSketch", quantile_sketch),
+        Benchmark("EqualQuantileWalk_MM[fill]", infill_filler),
+        Benchmark("EqualQuantileWalk_MM[fill_all]", infill_filler_all),
+        Benchmark("EqualQuantileWalk_MM[fill_scmrun]", infill_filler_scmrun),
+        Benchmark("extend_timeseries", extend_loop),
+        Benchmark("TimeseriesExtender", extender),
+        Benchmark(
+            "calc_ghg",
+            lambda: (
+                lambda: calc_ghg(
+                    data["infilling_database"], kyoto_ghg_exclude_co2_vars
+                ),
+                None,
+            ),
+        ),
+        Benchmark("calc_ghg[InfillingDatabase]", calc_ghg_index),
+        Benchmark("calc_ghg[3 contexts]", calc_ghg_contexts),
+    ]
+
+
+def make_data(config):
+    years = range(2010, 2010 + config["years"])
+    infilling_database = synthetic.make_infilling_database(config["db_scenarios"])
+    return {
+        "options": synthetic.get_options(config["combinations"]),
+        "country_emms": synthetic.make_country_emms(
+            n_countries=config["countries"],
+            n_dates=config["dates"],
+            years=years,
+            n_combinations=config["combinations"],
+        ),
+        "baseline_emms": synthetic.make_baseline_emms(
+            n_countries=config["countries"], years=years
+        ),
+        "infilling_database": infilling_database,
+        "lead_scenarios": synthetic.make_lead_scenarios(
+            infilling_database, config["lead_scenarios"]
+        ),
+    }
+
+
+def measure(benchmark, repeat):
+    """
+    Time a benchmark and measure the peak memory it allocates
+
+    The timings are made without tracing the memory allocations, the peak
+    memory is measured with :mod:`tracemalloc` in a separate run.
+    """
+    times = []
+    for _ in range(repeat):
+        state = benchmark.setup()
+        start = time.perf_counter()
+        benchmark.run(state)
+        times.append(time.perf_counter() - start)
+        del state
+
+    state = benchmark.setup()
+    tracemalloc.start()
+    try:
+        benchmark.run(state)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "time_min": min(times),
+        "time_mean": float(np.mean(times)),
+        "repeat": repeat,
+        "peak_memory": peak,
+    }
+
+
+def get_commit():
+    try:
+        commit = subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=ROOT_DIR, text=True
+        ).strip()
+        dirty = bool(
+            subprocess.check_output(
+                ["git", "status", "--porcelain", "--untracked-files=no"],
+                cwd=ROOT_DIR,
+                text=True,
+            ).strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+    return commit, dirty
+
+
+def run(config, only=None, repeat=3):
+    data = make_data(config)
+    benchmarks = get_benchmarks(data, config.get("db", "disk"))
+    if only:
+        benchmarks = [b for b in benchmarks if b.name in only]
+
+    commit, dirty = get_commit()
+    res = {
+        "commit": commit,
+        "dirty": dirty,
+        "created_at": dt.datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "versions": {m.__name__: m.__version__ for m in [np, pd, scmdata]},
+        "config": config,
+        "n_submissions": len(data["country_emms"]) // config["combinations"],
+        "results": {},
+    }
+    res["skipped"] = {}
+    for benchmark in benchmarks:
+        if benchmark.skip is not None:
+            print(
+                "Skipping {}: {}".format(benchmark.name, benchmark.skip),
+                file=sys.stderr,
+            )
+            res["skipped"][benchmark.name] = benchmark.skip
+            continue
+
+        print("Running {}".format(benchmark.name), file=sys.stderr)
+        res["results"][benchmark.name] = measure(benchmark, repeat)
+
+    try:
+        (get_peak_rss,) = _require("ndcs.profiling", "get_peak_rss")
+        res["peak_rss"] = get_peak_rss()
+    except ImportError:
+        res["peak_rss"] = None
+
+    return res
+
+
+def print_results(res):
+    print(
+        "{:<42} {:>10} {:>10} {:>12}".format(
+            "benchmark", "min (s)", "mean (s)", "peak (MB)"
+        )
+    )
+    for name, r in res["results"].items():
+        print(
+            "{:<42} {:>10.4f} {:>10.4f} {:>12.1f}".format(
+                name, r["time_min"], r["time_mean"], r["peak_memory"] / 1e6
+            )
+        )
+
+
+def compare(base_fname, new_fname):
+    with open(base_fname) as fh:
+        base = json.load(fh)
+    with open(new_fname) as fh:
+        new = json.load(fh)
+
+    if base["config"] != new["config"]:
+        print("Warning: the configurations differ", file=sys.stderr)
+
+    print(
+        "{:<42} {:>10} {:>10} {:>8} {:>8}".format(
+            "benchmark", "base (s)", "new (s)", "time", "memory"
+        )
+    )
+    for name in base["results"]:
+        if name not in new["results"]:
+            continue
+        b = base["results"][name]
+        n = new["results"][name]
+        print(
+            "{:<42} {:>10.4f} {:>10.4f} {:>7.2f}x {:>7.2f}x".format(
+                name,
+                b["time_min"],
+                n["time_min"],
+                n["time_min"] / b["time_min"],
+                n["peak_memory"] / max(b["peak_memory"], 1),
+            )
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--preset", choices=sorted(PRESETS), default="small")
+    parser.add_argument("--countries", type=int, help="Number of countries")
+    parser.add_argument("--dates", type=int, help="Number of submission dates")
+    parser.add_argument("--years", type=int, help="Number of years from 2010")
+    parser.add_argument(
+        "--combinations", type=int, help="Number of combinations of options"
+    )
+    parser.add_argument(
+        "--db-scenarios", type=int, help="Number of scenarios in the infilling db"
+    )
+    parser.add_argument(
+        "--lead-scenarios", type=int, default=10, help="Number of scenarios to infill"
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--only", nargs="+", help="Names of the benchmarks to run")
+    parser.add_argument(
+        "--db",
+        choices=["disk", "memory"],
+        default="disk",
+        help="Where the crunched pathways are saved",
+    )
+    parser.add_argument("--output", help="JSON file to write the results to")
+    parser.add_argument(
+        "--compare", nargs=2, metavar=("BASE", "NEW"), help="Compare two results"
+    )
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    config = dict(PRESETS[args.preset])
+    for k in ["countries", "dates", "years", "combinations", "db_scenarios"]:
+        if getattr(args, k) is not None:
+            config[k] = getattr(args, k)
+    config["lead_scenarios"] = args.lead_scenarios
+    config["db"] = args.db
+
+    res = run(config, only=args.only, repeat=args.repeat)
+    print_results(res)
+
+    output = args.output
+    if output is None:
+        output = os.path.join(
+            RESULTS_DIR, "{}.json".format((res["commit"] or "unknown")[:10])
+        )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as fh:
+        json.dump(res, fh, indent=2)
+    print("Results written to {}".format(output), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,286 @@
+"""
+Synthetic datasets for benchmarking
+
+The datasets have the same structure as the NDC submissions, baseline emissions
+and infilling database used in the notebooks, but their size can be chosen
+freely so the scaling of the pathway and infilling code can be measured without
+the processed data.
+"""
+
+import datetime as dt
+import itertools
+
+import numpy as np
+import scmdata
+
+from ndcs.constants import LEAD
+from ndcs.infilling import calc_ghg, kyoto_ghg_exclude_co2_vars
+
+OPTION_VALUES = {
+    "conditionality": ["C", "U"],
+    "ambition": ["high", "low"],
+    "country_extension": ["SSP1BL", "2030", "constant"],
+    "exclude_hot_air": ["exclude", "include"],
+}
+
+INFILLING_YEARS = [2015] + list(range(2020, 2101, 5))
+
+# Approximate global emissions in 2015 in the units used in the infilling database
+GAS_SIZES = {
+    "Emissions|C2F6": (2.0, "kt C2F6/yr"),
+    "Emissions|C6F14": (0.5, "kt C6F14/yr"),
+    "Emissions|CF4": (12.0, "kt CF4/yr"),
+    "Emissions|CH4": (380.0, "Mt CH4/yr"),
+    "Emissions|CO2|MAGICC Fossil and Industrial": (37000.0, "Mt CO2/yr"),
+    "Emissions|HFC125": (60.0, "kt HFC125/yr"),
+    "Emissions|HFC134a": (200.0, "kt HFC134a/yr"),
+    "Emissions|HFC143a": (25.0, "kt HFC143a/yr"),
+    "Emissions|HFC227ea": (5.0, "kt HFC227ea/yr"),
+    "Emissions|HFC23": (12.0, "kt HFC23/yr"),
+    "Emissions|HFC245fa": (10.0, "kt HFC245fa/yr"),
+    "Emissions|HFC32": (30.0, "kt HFC32/yr"),
+    "Emissions|HFC4310": (2.0, "kt HFC4310/yr"),
+    "Emissions|N2O": (10000.0, "kt N2O/yr"),
+    "Emissions|SF6": (8.0, "kt SF6/yr"),
+}
+
+
+def get_options(n_combinations):
+    """
+    Get ``n_combinations`` combinations of options
+
+    The combinations of the options used in the notebooks are used first,
+    afterwards additional country extensions are made up.
+
+    Returns
+    -------
+    list[tuple[str, str, str, str]]
+        (``conditionality``, ``ambition``, ``country_extension``,
+        ``exclude_hot_air``) of each combination
+    """
+    options = list(itertools.product(*OPTION_VALUES.values()))
+    i = 0
+    while len(options) < n_combinations:
+        options.extend(
+            itertools.product(
+                OPTION_VALUES["conditionality"],
+                OPTION_VALUES["ambition"],
+                ["EXT{}".format(i)],
+                OPTION_VALUES["exclude_hot_air"],
+            )
+        )
+        i += 1
+
+    return options[:n_combinations]
+
+
+def get_regions(n_countries):
+    return ["R{:05d}".format(i) for i in range(n_countries)]
+
+
+def make_country_emms(
+    n_countries=50,
+    n_dates=10,
+    years=range(2010, 2051),
+    n_combinations=2,
+    resubmit_fraction=0.5,
+    seed=0,
+):
+    """
+    Make NDC submissions
+
+    Each country submits once on a random date and ``resubmit_fraction`` of the
+    countries submit an updated NDC on a later date. Each submission has a
+    timeseries for each combination of options.
+
+    Parameters
+    ----------
+    n_countries : int
+        Number of countries (or other units) which submit
+
+    n_dates : int
+        Number of unique submission dates
+
+    years : list[int]
+        Years of the timeseries
+
+    n_combinations : int
+        Number of combinations of options, see :func:`get_options`
+
+    resubmit_fraction : float
+        Fraction of the countries which submit twice
+
+    seed : int
+        Seed of the random number generator
+
+    Returns
+    -------
+    :class:`scmdata.ScmRun`
+    """
+    rng = np.random.default_rng(seed)
+    years = list(years)
+    regions = get_regions(n_countries)
+    dates = [dt.date(2016, 4, 22) + dt.timedelta(days=30 * i) for i in range(n_dates)]
+
+    submissions = []
+    for region in regions:
+        first = rng.integers(0, max(n_dates - 1, 1))
+        submissions.append((region, first))
+        if n_dates > 1 and rng.uniform() < resubmit_fraction:
+            submissions.append((region, rng.integers(first + 1, n_dates)))
+
+    size = rng.lognormal(3, 1.5, size=n_countries)
+    trend = np.linspace(1, 0.6, len(years))
+    options = get_options(n_combinations)
+    values = []
+    columns = {c: [] for c in ["region", "submission_date", "scenario"]}
+    columns.update({c: [] for c in OPTION_VALUES})
+    for region, date in submissions:
+        base = size[int(region[1:])] * trend * rng.uniform(0.8, 1.2)
+        for option in options:
+            values.append(base * rng.uniform(0.9, 1.1))
+            columns["region"].append(region)
+            columns["submission_date"].append(dates[date])
+            columns["scenario"].append("NDC{}".format(date))
+            for c, v in zip(OPTION_VALUES, option):
+                columns[c].append(v)
+
+    columns.update(
+        {
+            "model": "NDC Factsheet",
+            "variable": "Emissions|Total GHG excl. LULUCF",
+            "unit": "Mt CO2 /yr",
+        }
+    )
+    return scmdata.ScmRun(np.array(values).T, index=years, columns=columns)
+
+
+def make_baseline_emms(
+    n_countries=50, years=range(2010, 2051), missing_fraction=0.2, seed=1
+):
+    """
+    Make baseline emissions
+
+    The baseline includes the regions of :func:`make_country_emms` plus
+    ``missing_fraction`` more regions which never submit.
+
+    Returns
+    -------
+    :class:`scmdata.ScmRun`
+    """
+    rng = np.random.default_rng(seed)
+    years = list(years)
+    regions = get_regions(int(n_countries * (1 + missing_fraction)))
+    size = rng.lognormal(3, 1.5, size=len(regions))
+    growth = rng.uniform(0.9, 1.5, size=len(regions))
+    values = size[:, np.newaxis] * np.linspace(1, growth, len(years)).T
+
+    return scmdata.ScmRun(
+        values.T,
+        index=years,
+        columns={
+            "model": "SSP",
+            "scenario": "SSP1BL",
+            "region": regions,
+            "variable": "Emissions|Total GHG",
+            "unit": "Mt CO2 /yr",
+        },
+    )
+
+
+def make_infilling_database(
+    n_scenarios=100, years=INFILLING_YEARS, gases=kyoto_ghg_exclude_co2_vars, seed=2
+):
+    """
+    Make an infilling database
+
+    Each scenario has a timeseries for each of ``gases``. CO2 declines linearly
+    and may become negative, the other gases change exponentially.
+
+    Parameters
+    ----------
+    n_scenarios : int
+        Number of scenarios in the database
+
+    years : list[int]
+        Years of the timeseries
+
+    gases : list[str]
+        Variables in the database, must be in :data:`GAS_SIZES`
+
+    seed : int
+        Seed of the random number generator
+
+    Returns
+    -------
+    :class:`scmdata.ScmRun`
+    """
+    rng = np.random.default_rng(seed)
+    t = np.asarray(years) - years[0]
+
+    values = []
+    columns = {c: [] for c in ["model", "scenario", "variable", "unit"]}
+    for i in range(n_scenarios):
+        for gas in gases:
+            size, unit = GAS_SIZES[gas]
+            if gas.startswith("Emissions|CO2"):
+                pathway = 1 - rng.uniform(0, 1.5) * t / t[-1]
+            else:
+                pathway = np.exp(-rng.uniform(-0.01, 0.05) * t)
+            noise = rng.uniform(0.95, 1.05, size=len(t))
+            values.append(size * rng.uniform(0.8, 1.2) * pathway * noise)
+            columns["model"].append("model{}".format(i // 10))
+            columns["scenario"].append("scenario{}".format(i))
+            columns["variable"].append(gas)
+            columns["unit"].append(unit)
+
+    columns["region"] = "World"
+    return scmdata.ScmRun(np.array(values).T, index=years, columns=columns)
+
+
+def make_lead_scenarios(infilling_database, n_scenarios=10, seed=3):
+    """
+    Make scenarios of the lead gas to infill
+
+    The scenarios are the bottom-up GHG emissions of random scenarios in the
+    infilling database, scaled by up to 10%.
+
+    Returns
+    -------
+    :class:`scmdata.ScmRun`
+    """
+    rng = np.random.default_rng(seed)
+    ghg = calc_ghg(infilling_database, kyoto_ghg_exclude_co2_vars)
+    ts = ghg.timeseries(time_axis="year")
+    rows = rng.integers(0, len(ts), size=n_scenarios)
+
+    return scmdata.ScmRun(
+        (ts.values[rows] * rng.uniform(0.9, 1.1, size=(n_scenarios, 1))).T,
+        index=ts.columns.values,
+        columns={
+            "model": "NDC",
+            "scenario": ["pathway{}".format(i) for i in range(n_scenarios)],
+            "region": "World",
+            "variable": LEAD,
+            "unit": "Mt CO2/yr",
+        },
+    )
+
+
+def make_pathways(lead_scenarios, end_year=2050):
+    """
+    Make annual pathways of the lead gas to extend
+
+    The pathways are the ``lead_scenarios`` until ``end_year``, with a
+    ``pathway_id`` for each.
+
+    Returns
+    -------
+    :class:`scmdata.ScmRun`
+    """
+    pathways = lead_scenarios.filter(year=range(2015, end_year + 1)).resample("AS")
+    pathways = pathways.filter(year=range(2015, end_year + 1))
+    pathways["pathway_id"] = pathways["scenario"]
+    pathways["unit"] = "Mt CO2 / yr"
+
+    return pathways
@@ -0,0 +1,234 @@
+"""
+On-disk cache of expensive intermediate results
+
+Results are stored as ``.npz`` files (without pickling) named after a key which
+is derived from the content of the inputs, see :func:`make_key`. When the number
+of entries exceeds a limit the least recently used entries are removed.
+"""
+
+import hashlib
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+import scmdata
+
+from .utils import ensure_dir_exists
+
+logger = logging.getLogger(__name__)
+
+# Increment if the format or contents of the cached results change
+# 2: database quantiles calculated by InfillingDatabase (which differ in the
+#    last digits) and grouped by the metadata other than model and scenario
+CACHE_VERSION = 2
+
+_SEP = "__"
+
+
+def _update_hash(h, part):
+    if isinstance(part, pd.DataFrame):
+        # Hash each row and sort the hashes so the order of the rows does not
+        # matter
+        row_hashes = pd.util.hash_pandas_object(
+            part[sorted(part.columns)], index=False
+        ).values
+        h.update(np.sort(row_hashes).tobytes())
+        h.update(repr(sorted(part.columns)).encode())
+    elif isinstance(part, np.ndarray):
+        h.update(np.ascontiguousarray(part).tobytes())
+        h.update(repr((part.dtype.str, part.shape)).encode())
+    elif isinstance(part, (list, tuple)):
+        for p in part:
+            _update_hash(h, p)
+    else:
+        h.update(repr(part).encode())
+    # Separate the parts so that e.g. ("ab", "c") and ("a", "bc") differ
+    h.update(b"\0")
+
+
+def make_key(*parts):
+    """
+    Make a cache key from the content of the inputs
+
+    Parameters
+    ----------
+    *parts
+        :obj:`pd.DataFrame`, :obj:`np.ndarray`, lists or values with a
+        deterministic ``repr``. The order of the rows of a
+        :obj:`pd.DataFrame` is ignored.
+
+    Returns
+    -------
+    str
+        Hex digest of the SHA-256 hash of the parts and :data:`CACHE_VERSION`
+    """
+    h = hashlib.sha256()
+    _update_hash(h, CACHE_VERSION)
+    for part in parts:
+        _update_hash(h, part)
+
+    return h.hexdigest()
+
+
+def _run_to_arrays(name, run):
+    ts = run.timeseries()
+    meta = ts.index.to_frame(index=False)
+
+    arrays = {
+        _SEP.join([name, "values"]): ts.values,
+        _SEP.join([name, "time"]): ts.columns.values.astype("datetime64[s]"),
+    }
+    for c in meta.columns:
+        values = meta[c]
+        if pd.api.types.is_numeric_dtype(values):
+            arrays[_SEP.join([name, "meta", c])] = values.values
+        else:
+            arrays[_SEP.join([name, "meta", c])] = values.astype(str).values.astype(str)
+            if values.isnull().any():
+                arrays[_SEP.join([name, "null", c])] = values.isnull().values
+
+    return arrays
+
+
+def _arrays_to_runs(arrays):
+    runs = {}
+    for k in arrays:
+        name, kind = k.split(_SEP)[:2]
+        if kind == "values":
+            runs[name] = {}
+
+    for name in runs:
+        columns = {}
+        for k in arrays:
+            parts = k.split(_SEP)
+            if parts[0] == name and parts[1] == "meta":
+                values = arrays[k].tolist()
+                null_key = _SEP.join([name, "null", parts[2]])
+                if null_key in arrays:
+                    values = [
+                        np.nan if null else v
+                        for v, null in zip(values, arrays[null_key])
+                    ]
+                columns[parts[2]] = values
+
+        runs[name] = scmdata.ScmRun(
+            arrays[_SEP.join([name, "values"])].T,
+            index=arrays[_SEP.join([name, "time"])].astype("datetime64[s]"),
+            columns=columns,
+        )
+
+    return runs
+
+
+class RunCache:
+    """
+    Cache of :class:`scmdata.ScmRun` results
+
+    Each entry is a dictionary of named :class:`scmdata.ScmRun` which is stored
+    in a ``{prefix}-{key}.npz`` file in ``cache_dir``.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory containing the cache
+
+    prefix : str
+        Name of the cached results. Entries with different prefixes are evicted
+        independently
+
+    max_entries : int
+        Maximum number of entries with ``prefix`` to keep. Once exceeded, the
+        least recently used entries are removed
+    """
+
+    def __init__(self, cache_dir, prefix, max_entries=8):
+        self.cache_dir = cache_dir
+        self.prefix = prefix
+        self.max_entries = max_entries
+
+    def get_fname(self, key):
+        """
+        Get the file for an entry
+        """
+        return os.path.join(self.cache_dir, "{}-{}.npz".format(self.prefix, key))
+
+    def load(self, key):
+        """
+        Load an entry
+
+        Returns
+        -------
+        dict[str, :class:`scmdata.ScmRun`]
+            The cached results or None if the entry does not exist or cannot be
+            read
+        """
+        fname = self.get_fname(key)
+        if not os.path.exists(fname):
+            return None
+
+        try:
+            with np.load(fname, allow_pickle=False) as data:
+                runs = _arrays_to_runs({k: data[k] for k in data.files})
+        except Exception:  # pragma: no cover
+            logger.warning("Removing unreadable cache entry {}".format(fname))
+            os.remove(fname)
+            return None
+
+        # Mark as recently used
+        os.utime(fname)
+        logger.debug("Loaded {}".format(fname))
+        return runs
+
+    def save(self, key, runs):
+        """
+        Save an entry and evict the least recently used entries
+
+        Parameters
+        ----------
+        key : str
+            Key of the entry, see :func:`make_key`
+
+        runs : dict[str, :class:`scmdata.ScmRun`]
+            Results to cache
+        """
+        arrays = {}
+        for name, run in runs.items():
+            if _SEP in name:
+                raise ValueError("Names cannot contain '{}'".format(_SEP))
+            arrays.update(_run_to_arrays(name, run))
+
+        fname = self.get_fname(key)
+        ensure_dir_exists(fname)
+        tmp_fname = fname + ".tmp"
+        with open(tmp_fname, "wb") as fh:
+            np.savez_compressed(fh, **arrays)
+        os.replace(tmp_fname, fname)
+
+        self.evict()
+
+    def entries(self):
+        """
+        Get the files of the entries ordered from most to least recently used
+        """
+        if not os.path.isdir(self.cache_dir):
+            return []
+
+        fnames = [
+            os.path.join(self.cache_dir, f)
+            for f in os.listdir(self.cache_dir)
+            if f.startswith(self.prefix + "-") and f.endswith(".npz")
+        ]
+        return sorted(fnames, key=os.path.getmtime, reverse=True)
+
+    def evict(self):
+        """
+        Remove the least recently used entries beyond :attr:`max_entries`
+        """
+        for fname in self.entries()[self.max_entries :]:
+            logger.info("Evicting {}".format(fname))
+            try:
+                os.remove(fname)
+            except FileNotFoundError:  # pragma: no cover
+                # Removed by another process
+                pass
@@ -0,0 +1,169 @@
+"""
+Storage of the contribution of each submission to the global pathways
+
+Each global pathway differs from the previous one by a single submission. The
+change in global emissions caused by that submission (the new commitment of the
+``last_country`` minus the commitment or baseline emissions it replaces) is
+stored by :class:`ContributionStore` as arrays for each combination of
+options. This allows attribution of the changes in the global emissions to each
+country without loading and differencing the pathways.
+"""
+
+import glob
+import os
+
+import numpy as np
+import pandas as pd
+import scmdata
+
+from .pathway_meta import KEY_COLUMNS
+from .utils import ensure_dir_exists
+
+CONTRIBUTION_COLUMNS = ("pathway_id", "pathway_num", "date", "last_country", "unit")
+
+
+class ContributionStore:
+    """
+    Contributions of the ``last_country`` of each pathway
+
+    The contributions for each combination of options are stored in a directory
+    in ``root_dir`` using the same directory layout as the global pathway
+    database. Each call to :meth:`add_many` appends a
+    ``contributions_<chunk>.npz`` file to the directory, so the existing
+    contributions are never rewritten. Each file holds a pathways x years array
+    of contributions together with the ``pathway_id``, ``pathway_num``,
+    ``date``, ``last_country`` and ``unit`` of each pathway.
+
+    Parameters
+    ----------
+    root_dir : str
+        Directory to store the contributions in
+    """
+
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+
+    def get_dir(self, ambition, conditionality, country_extension, exclude_hot_air):
+        """
+        Get the directory containing the contributions for a combination of
+        options
+        """
+        return os.path.join(
+            self.root_dir,
+            ambition,
+            conditionality,
+            country_extension,
+            exclude_hot_air,
+        )
+
+    def _get_chunks(self, key):
+        return sorted(
+            glob.glob(os.path.join(self.get_dir(*key), "contributions_*.npz"))
+        )
+
+    def add_many(self, records):
+        """
+        Add the contributions of many pathways
+
+        The contributions are written to a new file for each combination of
+        options. A pathway which already exists is replaced.
+
+        Parameters
+        ----------
+        records : list[dict]
+            Pathway metadata with the key columns and ``pathway_id``,
+            ``pathway_num``, ``date``, ``last_country`` and ``unit`` plus the
+            ``contribution`` as a :obj:`pd.Series` indexed by year
+        """
+        by_key = {}
+        for record in records:
+            key = tuple(str(record[c]) for c in KEY_COLUMNS)
+            by_key.setdefault(key, []).append(record)
+
+        for key, key_records in by_key.items():
+            meta = pd.DataFrame(
+                [{c: r[c] for c in CONTRIBUTION_COLUMNS} for r in key_records]
+            )
+            values = pd.DataFrame([r["contribution"] for r in key_records])
+
+            fname = os.path.join(
+                self.get_dir(*key),
+                "contributions_{:06d}.npz".format(len(self._get_chunks(key))),
+            )
+            self._write(fname, meta, values)
+
+    @staticmethod
+    def _read(fname):
+        with np.load(fname) as data:
+            meta = pd.DataFrame({c: data[c] for c in CONTRIBUTION_COLUMNS})
+            values = pd.DataFrame(data["values"], columns=data["years"])
+
+        return meta, values
+
+    @staticmethod
+    def _write(fname, meta, values):
+        values = values.sort_index(axis=1)
+
+        ensure_dir_exists(fname)
+        tmp_fname = fname + ".tmp"
+        with open(tmp_fname, "wb") as fh:
+            np.savez(
+                fh,
+                years=values.columns.values.astype(int),
+                values=values.values.astype(float),
+                **{
+                    c: meta[c].values.astype(int if c == "pathway_num" else str)
+                    for c in CONTRIBUTION_COLUMNS
+                }
+            )
+        os.replace(tmp_fname, fname)
+
+    def load(self, ambition, conditionality, country_extension, exclude_hot_air):
+        """
+        Load the contributions for a combination of options
+
+        Returns
+        -------
+        :class:`scmdata.ScmRun`
+            Contribution of the ``last_country`` of each pathway ordered by
+            ``pathway_num``
+
+        Raises
+        ------
+        KeyError
+            No contributions are stored for the combination of options
+        """
+        key = (ambition, conditionality, country_extension, exclude_hot_air)
+        chunks = self._get_chunks(key)
+        if not chunks:
+            raise KeyError(
+                "No contributions for {}".format(dict(zip(KEY_COLUMNS, key)))
+            )
+
+        meta, values = zip(*[self._read(fname) for fname in chunks])
+        meta = pd.concat(meta, ignore_index=True)
+        values = pd.concat(values, ignore_index=True).sort_index(axis=1)
+
+        # Later chunks replace the earlier contributions of a pathway
+        keep = ~meta["pathway_id"].duplicated(keep="last").values
+        order = np.argsort(meta["pathway_num"].values[keep], kind="stable")
+        meta = meta[keep].iloc[order].reset_index(drop=True)
+        values = values[keep].iloc[order].reset_index(drop=True)
+
+        columns = {c: meta[c].tolist() for c in CONTRIBUTION_COLUMNS}
+        columns.update(
+            {
+                "variable": "Emissions|Total GHG excl. LULUCF",
+                "region": "World",
+                "model": "NDC contribution",
+                # Same scenario names as the global pathways
+                "scenario": [
+                    "__".join((pathway_id,) + key) for pathway_id in meta["pathway_id"]
+                ],
+            }
+        )
+        columns.update(dict(zip(KEY_COLUMNS, key)))
+
+        return scmdata.ScmRun(
+            values.values.T, index=values.columns.values, columns=columns
+        )
@@ -1,65 +1,231 @@
+import functools
 import logging
+import os
 import warnings
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import numpy as np
 import pandas as pd
-from pyam import IamDataFrame
-import silicone.time_projectors
+import scipy.stats
 import scmdata
+from scmdata.errors import InsufficientDataError
+from scmdata.units import UnitConverter
 from silicone.database_crunchers import TimeDepRatio as BaseTimeDepRatio
 from silicone.database_crunchers.base import _DatabaseCruncher
-from typing import List
+from tqdm.auto import tqdm
 
+from .cache import RunCache, make_key
 from .constants import LEAD
+from .infilling_database import InfillingDatabase
 
 
 logger = logging.getLogger(__name__)
 
+CACHE_ENV_VAR = "NDCS_INFILLING_CACHE_DIR"
 
-def _determine_quantile(
-    quantile_data: scmdata.ScmRun, values: scmdata.ScmRun
-) -> list[float]:
-    assert quantile_data.shape[1] == 1, "More than one timestep present"
-    assert values.shape[1] == 1, "More than one timestep present"
+DEFAULT_QUANTILES = np.arange(0.01, 1, 0.01)
 
-    quantiles = quantile_data.timeseries().squeeze()
-    quantiles.index = quantiles.index.get_level_values("quantile")
-    quantiles = quantiles.sort_index()
 
-    # linear interpolation
-    res = np.interp(
-        np.atleast_1d(values.values.squeeze()), quantiles.values, quantiles.index
-    )
+def _interp(x, xp, fp):
+    """
+    Row-wise linear interpolation
+
+    Equivalent to calling :func:`np.interp` for each row, i.e.
+    ``np.interp(x[i], xp[i], fp[..., i, :])``, but all rows are interpolated at
+    once.
+
+    Parameters
+    ----------
+    x : :obj:`np.ndarray`
+        Values to interpolate at with shape (rows, n)
+
+    xp : :obj:`np.ndarray`
+        Increasing x-coordinates of each row with shape (rows, m) or shape (m,)
+        if all rows share the same x-coordinates
+
+    fp : :obj:`np.ndarray`
+        y-coordinates of each row with shape (..., rows, m). Any leading
+        dimensions are interpolated using the same x-coordinates
+
+    Returns
+    -------
+    :obj:`np.ndarray`
+        Interpolated values with shape (..., rows, n)
+    """
+    rows = np.arange(x.shape[0])[:, np.newaxis]
+    n = xp.shape[-1]
+    # Index of the last x-coordinate <= x (-1 if x is below the first)
+    if xp.ndim == 1:
+        j = np.searchsorted(xp, x, side="right") - 1
+        lower = np.clip(j, 0, n - 2)
+        x0 = xp[lower]
+        x1 = xp[lower + 1]
+    else:
+        j = (xp[:, :, np.newaxis] <= x[:, np.newaxis, :]).sum(axis=1) - 1
+        lower = np.clip(j, 0, n - 2)
+        x0 = xp[rows, lower]
+        x1 = xp[rows, lower + 1]
 
-    assert len(res) == len(values)
-    return res
+    y0 = fp[..., rows, lower]
+    y1 = fp[..., rows, lower + 1]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        res = (y1 - y0) / (x1 - x0) * (x - x0) + y0
 
+    res = np.where(x0 == x, y0, res)
+    res = np.where(j < 0, fp[..., :1], res)
+    res = np.where(j >= n - 1, fp[..., -1:], res)
+    return np.where(np.isnan(x), np.nan, res)
 
-def _lookup_quantile(lookup_data: scmdata.ScmRun, quantiles: List[float]):
-    assert lookup_data.shape[1] == 1, "More than one timestep present"
 
-    lookup = lookup_data.timeseries().squeeze()
-    lookup.index = lookup.index.get_level_values("quantile")
-    lookup = lookup.sort_index()
+def _quantile_table(run):
+    """
+    Extract a dense year x quantile table from the output of ``quantiles_over``
 
-    # linear interpolation
-    res = np.interp(quantiles, lookup.index, lookup.values)
+    Returns
+    -------
+    :obj:`np.ndarray`, :obj:`np.ndarray`, :obj:`np.ndarray`
+        Years, sorted quantiles and the values with shape (years, quantiles)
+    """
+    ts = run.timeseries(time_axis="year")
+    quantiles = ts.index.get_level_values("quantile").values.astype(float)
+    if len(np.unique(quantiles)) != len(quantiles):
+        raise ValueError("Expected a single timeseries per quantile")
 
-    assert len(res) == len(quantiles)
-    return res
+    order = np.argsort(quantiles)
+    return ts.columns.values, quantiles[order], ts.values[order].T
+
+
+def _check_quantiles(quantiles):
+    if quantiles is None:
+        return DEFAULT_QUANTILES
+
+    quantiles = np.asarray(quantiles, dtype=float)
+    if quantiles.ndim != 1 or len(quantiles) < 2:
+        raise ValueError("Expected at least two quantiles")
+    if np.any(np.diff(quantiles) <= 0):
+        raise ValueError("Quantiles must be strictly increasing")
+    if quantiles[0] < 0 or quantiles[-1] > 1:
+        raise ValueError("Quantiles must be between 0 and 1")
+
+    return quantiles
 
 
 class EqualQuantileWalk_MM(_DatabaseCruncher):
-    def __init__(self, db, bottom_up_gases):
+    """
+    Infill by following the same quantile of the database as the lead gas
+
+    Parameters
+    ----------
+    db : :obj:`pyam.IamDataFrame` or :class:`InfillingDatabase`
+        Infilling database. The quantiles of an :class:`InfillingDatabase` are
+        calculated from its index without converting it
+
+    bottom_up_gases : list[str]
+        Gases which are summed to give the lead gas
+
+    cache_dir : str
+        Directory in which to cache the quantiles of the database. The cache is
+        keyed by the content of ``db``, the quantiles and ``bottom_up_gases`` so
+        building a cruncher for the same database again skips calculating the
+        quantiles. If None, the ``NDCS_INFILLING_CACHE_DIR`` environment
+        variable is used and if that is not set nothing is cached.
+
+    quantiles : list[float]
+        Increasing quantiles of the database to walk along. Lead values outside
+        the range of the quantiles are infilled with the lowest or highest
+        quantile. Defaults to the 1st, 2nd, ..., 99th percentiles
+
+    See Also
+    --------
+    EqualQuantileWalk_MM.from_sketch
+        Create a cruncher from an estimate of the quantiles of a database which
+        is too large to hold in memory
+    """
+
+    def __init__(self, db, bottom_up_gases, cache_dir=None, quantiles=None):
         super(EqualQuantileWalk_MM, self).__init__(db)
         self.bottom_up_gases = bottom_up_gases
+        if cache_dir is None:
+            cache_dir = os.environ.get(CACHE_ENV_VAR) or None
+        self.cache_dir = cache_dir
+        self.quantiles = _check_quantiles(quantiles)
         self._prepare_percentiles()
 
+    @classmethod
+    def from_sketch(cls, sketch, bottom_up_gases, quantiles=None):
+        """
+        Create a cruncher from a :class:`ndcs.quantile_sketch.QuantileSketch`
+
+        The sketch is built chunk by chunk so the database does not have to fit
+        in memory. The quantiles are estimates, see
+        :class:`ndcs.quantile_sketch.QuantileSketch` for their accuracy.
+
+        Parameters
+        ----------
+        sketch : :class:`ndcs.quantile_sketch.QuantileSketch`
+            Sketch of the infilling database
+
+        bottom_up_gases : list[str]
+            Gases which are summed to give the lead gas
+
+        quantiles : list[float]
+            Quantiles of the database to walk along
+
+        Returns
+        -------
+        :class:`EqualQuantileWalk_MM`
+        """
+        cruncher = cls.__new__(cls)
+        cruncher._db = None
+        cruncher.bottom_up_gases = bottom_up_gases
+        cruncher.cache_dir = None
+        cruncher.quantiles = _check_quantiles(quantiles)
+        cruncher._set_percentiles(sketch.quantiles(cruncher.quantiles))
+        cruncher._prepare_tables()
+
+        return cruncher
+
+    def __getstate__(self):
+        # Only the prepared tables are needed to infill so the database isn't
+        # copied when the cruncher is sent to other processes
+        state = self.__dict__.copy()
+        state["_db"] = None
+        return state
+
     def _prepare_percentiles(self):
-        # Prepare by calculating the ghg's corresponding the 1st, 2nd, ... quantile of each target gas
-        self._db_quantiles = scmdata.ScmRun(self._db).quantiles_over(
-            ("scenario", "model"), quantiles=np.arange(0.01, 1, 0.01)
-        )
+        cache = None
+        cached = None
+        if self.cache_dir is not None:
+            cache = RunCache(self.cache_dir, "equal_quantile_walk")
+            if isinstance(self._db, InfillingDatabase):
+                db_key = self._db.key
+            else:
+                db_key = self._db.data
+            key = make_key(db_key, self.quantiles, sorted(self.bottom_up_gases))
+            cached = cache.load(key)
+
+        if cached is not None:
+            self._db_quantiles = cached["db_quantiles"]
+            self._db_ghg = cached["db_ghg"]
+        else:
+            # Prepare by calculating the ghg's corresponding the 1st, 2nd, ...
+            # quantile of each target gas
+            if isinstance(self._db, InfillingDatabase):
+                db_quantiles = self._db.quantiles(self.quantiles)
+            else:
+                db_quantiles = scmdata.ScmRun(self._db).quantiles_over(
+                    ("scenario", "model"), quantiles=self.quantiles
+                )
+            self._set_percentiles(db_quantiles)
+            if cache is not None:
+                cache.save(
+                    key, {"db_quantiles": self._db_quantiles, "db_ghg": self._db_ghg}
+                )
+
+        self._prepare_tables()
+
+    def _set_percentiles(self, db_quantiles):
+        self._db_quantiles = db_quantiles
         self._db_quantiles["scenario"] = "Unknown"
         self._db_quantiles["model"] = "Unknown"
         self._db_quantiles = scmdata.ScmRun(self._db_quantiles)
@@ -67,15 +233,68 @@ class EqualQuantileWalk_MM(_DatabaseCruncher):
         # Calculate bottom up GHGs
         self._db_ghg = calc_ghg(self._db_quantiles, self.bottom_up_gases)
 
+    def _prepare_tables(self):
+        # Dense year x quantile tables so that all the scenarios and years can be
+        # infilled at once
+        self._years, self._quantiles, self._ghg_table = _quantile_table(self._db_ghg)
+        lookup_data = InfillingDatabase(self._db_quantiles)
+        quantiles = lookup_data.meta["quantile"].values.astype(float)
+        order = np.argsort(quantiles)
+        assert np.array_equal(lookup_data.years, self._years)
+        assert np.array_equal(quantiles[order], self._quantiles)
+        self._follower_tables = {
+            variable: (
+                lookup_data.get_unit(variable),
+                np.ascontiguousarray(lookup_data.values(variable)[:, order]),
+            )
+            for variable in lookup_data.variables
+        }
+
     def derive_relationship(
         self, variable_follower, variable_leaders, include_quantile=False, **kwargs
     ):
-        lookup_data = self._db_quantiles.filter(variable=variable_follower)
-        if lookup_data.empty:
-            error_msg = f"No data in the database for {variable_follower}"
-            raise ValueError(error_msg)
+        return self.derive_relationships(
+            [variable_follower], variable_leaders, include_quantile=include_quantile
+        )
+
+    def derive_relationships(
+        self, variable_followers, variable_leaders, include_quantile=False
+    ):
+        """
+        Derive the relationships between the lead and many follower variables
 
-        data_unit = lookup_data.get_unique_meta("unit", True)
+        The quantile of the lead variable is only determined once for each
+        scenario and year. It is then used to look up all the followers at once.
+
+        Parameters
+        ----------
+        variable_followers : list[str]
+            The variables to infill (e.g. ``kyoto_ghg_exclude_co2_vars``)
+        variable_leaders : list[str]
+            The lead variable
+        include_quantile : bool
+            If True, the filler also returns the quantile of the lead variable
+            as ``"{variable_follower}|Quantile"`` for each follower
+        Returns
+        -------
+        :obj:`func`
+            Function which takes a :obj:`pyam.IamDataFrame` containing
+            ``variable_leaders`` timeseries and returns the timeseries of all
+            ``variable_followers``
+        Raises
+        ------
+        ValueError
+            There is no data for one of ``variable_followers`` in the database
+
+        See Also
+        --------
+        EqualQuantileWalk_MM.derive_scmrun_relationships
+            The same filler without converting to and from
+            :obj:`pyam.IamDataFrame`
+        """
+        scmrun_filler = self.derive_scmrun_relationships(
+            variable_followers, variable_leaders, include_quantile=include_quantile
+        )
 
         def filler(in_iamdf):
             """
@@ -93,53 +312,312 @@ class EqualQuantileWalk_MM(_DatabaseCruncher):
             ValueError
                 The key year for filling is not in ``in_iamdf``.
             """
+            return scmrun_filler(scmdata.ScmRun(in_iamdf)).to_iamdataframe()
+
+        return filler
 
-            in_scmrun = scmdata.ScmRun(in_iamdf)
+    def derive_scmrun_relationships(
+        self, variable_followers, variable_leaders, include_quantile=False
+    ):
+        """
+        Derive the relationships between the lead and many follower variables
 
-            lead_var = in_scmrun.filter(variable=variable_leaders)
-            assert (
-                lead_var["unit"].nunique() == 1
-            ), "There are multiple units for the lead variable."
+        Same as :meth:`derive_relationships` but the filler takes and returns
+        :class:`scmdata.ScmRun` so no :obj:`pyam.IamDataFrame` is created.
 
-            # Only handles annual data currently
-            years_needed = set(in_scmrun["year"])
-            if any([k not in set(self._db_quantiles["year"]) for k in years_needed]):
-                error_msg = (
-                    "Not all required timepoints are in the data for "
-                    "the lead gas ({})".format(variable_leaders[0])
-                )
+        Parameters
+        ----------
+        variable_followers : list[str]
+            The variables to infill (e.g. ``kyoto_ghg_exclude_co2_vars``)
+        variable_leaders : list[str]
+            The lead variable
+        include_quantile : bool
+            If True, the filler also returns the quantile of the lead variable
+            as ``"{variable_follower}|Quantile"`` for each follower
+        Returns
+        -------
+        :obj:`func`
+            Function which takes a :class:`scmdata.ScmRun` containing
+            ``variable_leaders`` timeseries and returns a
+            :class:`scmdata.ScmRun` of all ``variable_followers``
+        Raises
+        ------
+        ValueError
+            There is no data for one of ``variable_followers`` in the database
+        """
+        self._check_followers(variable_followers)
+
+        return _QuantileWalkFiller(
+            self, variable_followers, variable_leaders, include_quantile
+        )
+
+    def infill_values(self, years, lead_values, variable_followers):
+        """
+        Infill arrays of the lead variable
+
+        The array equivalent of the fillers of
+        :meth:`derive_scmrun_relationships`.
+
+        Parameters
+        ----------
+        years : :obj:`np.ndarray`
+            Years of the lead values with shape (years,)
+
+        lead_values : :obj:`np.ndarray`
+            Values of the lead variable, in the units of the lead variable of
+            the database, with shape (timeseries, years)
+
+        variable_followers : list[str]
+            The variables to infill
+
+        Returns
+        -------
+        :obj:`np.ndarray`, :obj:`np.ndarray`
+            The quantile of the lead values with shape (timeseries, years) and
+            the infilled values with shape (followers, timeseries, years)
+
+        Raises
+        ------
+        ValueError
+            There is no data for one of ``variable_followers`` or one of the
+            ``years`` in the database
+        """
+        self._check_followers(variable_followers)
+        years = np.asarray(years)
+        year_idx = np.searchsorted(self._years, years)
+        if np.any(year_idx >= len(self._years)) or np.any(
+            self._years[np.minimum(year_idx, len(self._years) - 1)] != years
+        ):
+            raise ValueError("Not all the years are in the database")
+
+        # variable x year x quantile
+        lookup_table = np.stack(
+            [self._follower_tables[v][1] for v in variable_followers]
+        )
+
+        # Interpolate all the scenarios, years and followers at once
+        quantile_levels = np.broadcast_to(
+            self._quantiles, (len(year_idx), len(self._quantiles))
+        )
+        quantiles = _interp(
+            np.asarray(lead_values, dtype=float).T,
+            self._ghg_table[year_idx],
+            quantile_levels,
+        )
+        values = _interp(quantiles, self._quantiles, lookup_table[:, year_idx])
+
+        return quantiles.T, np.swapaxes(values, 1, 2)
+
+    def _check_followers(self, variable_followers):
+        for variable_follower in variable_followers:
+            if variable_follower not in self._follower_tables:
+                error_msg = f"No data in the database for {variable_follower}"
                 raise ValueError(error_msg)
 
-            output_ts = lead_var.timeseries(time_axis="year").copy()
-            quantiles_ts = lead_var.timeseries(time_axis="year").copy()
 
-            for year in lead_var["year"]:
-                quantile = _determine_quantile(
-                    self._db_ghg.filter(year=year), lead_var.filter(year=year)
-                )
-                quantiles_ts.loc[:, year] = quantile
-                output_ts.loc[:, year] = _lookup_quantile(
-                    lookup_data.filter(year=year), quantile
-                )
+def _to_run(ts, values, variables, units):
+    """
+    Make a :class:`scmdata.ScmRun` from arrays with the metadata of ``ts``
 
-            output_ts.reset_index(inplace=True)
-            output_ts["variable"] = variable_follower
-            output_ts["unit"] = data_unit
+    Parameters
+    ----------
+    ts : :obj:`pd.DataFrame`
+        Timeseries with years as columns whose metadata is used for each
+        variable
 
-            quantiles_ts.reset_index(inplace=True)
-            quantiles_ts["variable"] = variable_follower + "|Quantile"
-            quantiles_ts["unit"] = "unitless"
+    values : :obj:`np.ndarray`
+        Values with shape (variables, timeseries, years)
 
-            output = scmdata.ScmRun(output_ts)
+    variables : list[str]
+        Variable of each of the first dimension of ``values``
 
-            if include_quantile:
-                output = output.append(scmdata.ScmRun(quantiles_ts))
-            return output.to_iamdataframe()
+    units : list[str]
+        Unit of each variable
+    """
+    meta = ts.index.to_frame(index=False)
+    meta = pd.concat([meta] * len(variables), ignore_index=True)
+    meta["variable"] = np.repeat(variables, len(ts))
+    meta["unit"] = np.repeat(units, len(ts))
 
-        return filler
+    return scmdata.ScmRun(
+        np.asarray(values).reshape(-1, len(ts.columns)).T,
+        index=ts.columns.values,
+        columns=meta.to_dict("list"),
+    )
+
+
+class _QuantileWalkFiller:
+    """
+    Filler of :meth:`EqualQuantileWalk_MM.derive_scmrun_relationships`
+
+    A class rather than a closure so that it can be sent to other processes.
+    """
+
+    def __init__(
+        self, cruncher, variable_followers, variable_leaders, include_quantile
+    ):
+        self.cruncher = cruncher
+        self.variable_followers = list(variable_followers)
+        self.variable_leaders = variable_leaders
+        self.include_quantile = include_quantile
+        self.data_units = [
+            cruncher._follower_tables[v][0] for v in self.variable_followers
+        ]
+
+    def __call__(self, in_scmrun):
+        """
+        Parameters
+        ----------
+        in_scmrun : :class:`scmdata.ScmRun`
+            Input data to fill data in
+        Returns
+        -------
+        :class:`scmdata.ScmRun`
+            Filled-in data (without original source data)
+        Raises
+        ------
+        ValueError
+            The key year for filling is not in ``in_scmrun``.
+        """
+        lead_var = in_scmrun.filter(
+            variable=self.variable_leaders, log_if_empty=False
+        )
+        assert (
+            len(lead_var.get_unique_meta("unit")) == 1
+        ), "There are multiple units for the lead variable."
+
+        # Only handles annual data currently
+        years_needed = set(in_scmrun["year"])
+        if any([k not in set(self.cruncher._years) for k in years_needed]):
+            error_msg = (
+                "Not all required timepoints are in the data for "
+                "the lead gas ({})".format(self.variable_leaders[0])
+            )
+            raise ValueError(error_msg)
+
+        lead_ts = lead_var.timeseries(time_axis="year")
+        quantiles, values = self.cruncher.infill_values(
+            lead_ts.columns.values, lead_ts.values, self.variable_followers
+        )
+
+        variables = list(self.variable_followers)
+        units = list(self.data_units)
+        if self.include_quantile:
+            values = np.concatenate([values, np.broadcast_to(quantiles, values.shape)])
+            variables += [v + "|Quantile" for v in self.variable_followers]
+            units += ["unitless"] * len(self.variable_followers)
+
+        return _to_run(lead_ts, values, variables, units)
+
+
+class _TimeDepRatioFiller:
+    """
+    Filler of :meth:`TimeDepRatio.derive_scmrun_relationship`
+
+    A class rather than a closure so that it can be sent to other processes
+    without the database.
+    """
+
+    def __init__(
+        self,
+        variable_follower,
+        variable_leaders,
+        data_follower_unit,
+        scaling,
+        follower_times,
+    ):
+        self.variable_follower = variable_follower
+        self.variable_leaders = variable_leaders
+        self.data_follower_unit = data_follower_unit
+        self.scaling = scaling
+        self.follower_times = follower_times
+
+    def __call__(self, in_scmrun):
+        """
+        Parameters
+        ----------
+        in_scmrun : :class:`scmdata.ScmRun`
+            Input data to fill data in
+        Returns
+        -------
+        :class:`scmdata.ScmRun`
+            Filled-in data (without original source data)
+        Raises
+        ------
+        ValueError
+            The key year for filling is not in ``in_scmrun``.
+        """
+        variable_leaders = self.variable_leaders
+        lead_var = in_scmrun.filter(variable=variable_leaders, log_if_empty=False)
+        assert (
+            len(lead_var.get_unique_meta("unit")) == 1
+        ), "There are multiple units for the lead variable."
+        output_ts = lead_var.timeseries(time_axis="year")
+
+        if np.any(output_ts.values < 0):
+            logger.warning(
+                "Note that the lead variable {} goes negative. The time dependent "
+                "ratio cruncher can produce unexpected results in this case.".format(
+                    variable_leaders
+                )
+            )
+        times_needed = set(in_scmrun["year"])
+        if any([k not in self.follower_times for k in times_needed]):
+            error_msg = (
+                "Not all required timepoints are in the data for "
+                "the lead gas ({})".format(variable_leaders[0])
+            )
+            raise ValueError(error_msg)
+
+        # Scale all the scenarios and times at once
+        values = output_ts.values
+        time_scaling = self.scaling.loc[output_ts.columns]
+        pos_scaling = time_scaling["pos"].values.astype(float)
+        neg_scaling = time_scaling["neg"].values.astype(float)
+
+        missing = np.isnan(np.where(values < 0, neg_scaling, pos_scaling))
+        if missing.any():
+            year = output_ts.columns[missing.any(axis=0)][0]
+            raise ValueError(
+                "Attempt to infill {} data using the time_dep_ratio cruncher "
+                "where the infillee data has a sign not seen in the infiller "
+                "database for year "
+                "{}.".format(variable_leaders, year)
+            )
+
+        return _to_run(
+            output_ts,
+            values * np.where(values > 0, pos_scaling, neg_scaling),
+            [self.variable_follower],
+            [self.data_follower_unit],
+        )
 
 
 class TimeDepRatio(BaseTimeDepRatio):
+    """
+    Infill by scaling the lead variable by the time dependent ratio of the
+    follower to the lead in the database
+
+    The ratios are calculated from an :class:`InfillingDatabase` of ``db``, in
+    which the leader and follower of each scenario are aligned.
+
+    Parameters
+    ----------
+    db : :obj:`pyam.IamDataFrame`, :class:`scmdata.ScmRun` or :class:`InfillingDatabase`
+        Infilling database
+    """
+
+    def __init__(self, db):
+        if isinstance(db, InfillingDatabase):
+            self._db = None
+            self._index = db
+        elif isinstance(db, scmdata.ScmRun):
+            self._db = None
+            self._index = InfillingDatabase(db)
+        else:
+            super(TimeDepRatio, self).__init__(db)
+            self._index = InfillingDatabase(self._db)
+
     def derive_relationship(
         self,
         variable_follower,
@@ -184,61 +662,20 @@ class TimeDepRatio(BaseTimeDepRatio):
         ValueError
             There is no data for ``variable_leaders`` or ``variable_follower`` in the
             database.
+
+        See Also
+        --------
+        TimeDepRatio.derive_scmrun_relationship
+            The same filler without converting to and from
+            :obj:`pyam.IamDataFrame`
         """
-        if only_consistent_cases:
-            consistent_cases = (
-                self._db.filter(variable=variable_leaders + [variable_follower])
-                .timeseries()
-                .dropna()
-            )
-            consistent_cases = consistent_cases.loc[
-                consistent_cases.index.to_frame().duplicated(
-                    ["model", "scenario", "region"], keep=False
-                )
-            ]
-            self._filtered_db = IamDataFrame(consistent_cases)
-        else:
-            self._filtered_db = self._db
-        iamdf_follower, data_follower = self._get_iamdf_followers(
-            variable_follower, variable_leaders
+        scmrun_filler = self.derive_scmrun_relationship(
+            variable_follower,
+            variable_leaders,
+            same_sign=same_sign,
+            only_consistent_cases=only_consistent_cases,
         )
-
-        data_follower_unit = np.unique(iamdf_follower.data["unit"].values)
-        if data_follower_unit.size == 1:
-            data_follower_unit = data_follower_unit[0]
-        else:
-            raise ValueError("There are multiple/no units in follower data")
-        data_follower_time_col = iamdf_follower.time_col
-        iamdf_leader = self._filtered_db.filter(variable=variable_leaders[0])
-        data_leader = iamdf_leader.timeseries()
-        if iamdf_leader["unit"].nunique() != 1:
-            raise ValueError("There are multiple/no units for the leader data.")
-        if data_follower.size != data_leader.size:
-            error_msg = "The follower and leader data have different sizes"
-            raise ValueError(error_msg)
-        # Calculate the ratios to use
-        all_times = np.unique(iamdf_leader.data[iamdf_leader.time_col])
-        scaling = pd.DataFrame(index=all_times, columns=["pos", "neg"])
-        if same_sign:
-            # We want to have separate positive and negative answers. We calculate a
-            # tuple, first for positive and then negative values.
-            with warnings.catch_warnings():
-                warnings.simplefilter("ignore")
-                for year in all_times:
-                    pos_inds = data_leader[year].values > 0
-                    scaling["pos"][year] = np.nanmean(
-                        data_follower[year].iloc[pos_inds].values
-                    ) / np.nanmean(data_leader[year].iloc[pos_inds].values)
-                    scaling["neg"][year] = np.nanmean(
-                        data_follower[year].iloc[~pos_inds].values
-                    ) / np.nanmean(data_leader[year].iloc[~pos_inds].values)
-        else:
-            # The tuple is the same in both cases
-            for year in all_times:
-                scaling["pos"][year] = np.mean(data_follower[year].values) / np.mean(
-                    data_leader[year].values
-                )
-            scaling["neg"] = scaling["pos"]
+        data_follower_time_col = getattr(self._db, "time_col", "year")
 
         def filler(in_iamdf):
             """
@@ -256,10 +693,6 @@ class TimeDepRatio(BaseTimeDepRatio):
             ValueError
                 The key year for filling is not in ``in_iamdf``.
             """
-            lead_var = in_iamdf.filter(variable=variable_leaders)
-            assert (
-                lead_var["unit"].nunique() == 1
-            ), "There are multiple units for the lead variable."
             if data_follower_time_col != in_iamdf.time_col:
                 raise ValueError(
                     "`in_iamdf` time column must be the same as the time column used "
@@ -268,72 +701,598 @@ class TimeDepRatio(BaseTimeDepRatio):
                     )
                 )
 
-            ##### Change the line below
-            if any(lead_var.data["value"] < 0):
-                warn_str = (
-                    "Note that the lead variable {} goes negative. The time dependent "
-                    "ratio cruncher can produce unexpected results in this caprojectorsse.".format(
-                        variable_leaders
-                    )
+            return scmrun_filler(scmdata.ScmRun(in_iamdf)).to_iamdataframe()
+
+        return filler
+
+    def derive_scmrun_relationship(
+        self,
+        variable_follower,
+        variable_leaders,
+        same_sign=True,
+        only_consistent_cases=True,
+    ):
+        """
+        Derive the relationship between two variables from the database.
+
+        Same as :meth:`derive_relationship` but the ratios are calculated from
+        a :class:`scmdata.ScmRun` of the database and the filler takes and
+        returns :class:`scmdata.ScmRun` so no :obj:`pyam.IamDataFrame` is
+        created.
+
+        Parameters
+        ----------
+        variable_follower : str
+            The variable for which we want to calculate timeseries
+        variable_leaders : list[str]
+            The variable we want to use in order to infer timeseries of
+            ``variable_follower``
+        same_sign : bool
+            Use separate ratios for positive and negative values of the leader
+        only_consistent_cases : bool
+            Only use model/scenario combinations where both lead and follow have
+            data at all times
+        Returns
+        -------
+        :obj:`func`
+            Function which takes a :class:`scmdata.ScmRun` containing
+            ``variable_leaders`` timeseries and returns a
+            :class:`scmdata.ScmRun` of ``variable_follower``
+        Raises
+        ------
+        ValueError
+            ``variable_leaders`` contains more than one variable.
+        ValueError
+            There is no data for ``variable_leaders`` or ``variable_follower`` in the
+            database.
+        """
+        years, leader, follower = self._get_index_followers(
+            variable_follower, variable_leaders, only_consistent_cases
+        )
+        data_follower_unit = self._index.get_unit(variable_follower)
+        if follower.shape != leader.shape:
+            error_msg = "The follower and leader data have different sizes"
+            raise ValueError(error_msg)
+        follower_times = set(years[~np.isnan(follower).all(axis=1)])
+        # Calculate the ratios to use for all times at once. The rows of the
+        # leader and follower data are matched by scenario and the arrays are
+        # time x scenario so the reductions are along the contiguous axis.
+        has_leader = ~np.isnan(leader).all(axis=1)
+        all_times = years[has_leader]
+        leader = np.ascontiguousarray(leader[has_leader])
+        follower = np.ascontiguousarray(follower[has_leader])
+        if same_sign:
+            # We want to have separate positive and negative answers. We calculate a
+            # tuple, first for positive and then negative values.
+            pos_inds = leader > 0
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                pos = np.nanmean(
+                    np.where(pos_inds, follower, np.nan), axis=1
+                ) / np.nanmean(np.where(pos_inds, leader, np.nan), axis=1)
+                neg = np.nanmean(
+                    np.where(pos_inds, np.nan, follower), axis=1
+                ) / np.nanmean(np.where(pos_inds, np.nan, leader), axis=1)
+        else:
+            # The tuple is the same in both cases
+            pos = np.mean(follower, axis=1) / np.mean(leader, axis=1)
+            neg = pos
+        scaling = pd.DataFrame({"pos": pos, "neg": neg}, index=all_times)
+
+        return _TimeDepRatioFiller(
+            variable_follower,
+            variable_leaders,
+            data_follower_unit,
+            scaling,
+            follower_times,
+        )
+
+    def _get_index_followers(
+        self, variable_follower, variable_leaders, only_consistent_cases
+    ):
+        if len(variable_leaders) > 1:
+            raise ValueError(
+                "For `TimeDepRatio`, ``variable_leaders`` should only "
+                "contain one variable"
+            )
+
+        if not all([v in self._index for v in variable_leaders]):
+            error_msg = "No data for `variable_leaders` ({}) in database".format(
+                variable_leaders
+            )
+            raise ValueError(error_msg)
+        if variable_follower not in self._index:
+            error_msg = "No data for `variable_follower` ({}) in database".format(
+                variable_follower
+            )
+            raise ValueError(error_msg)
+
+        # year x scenario
+        leader = self._index.values(variable_leaders[0])
+        follower = self._index.values(variable_follower)
+        # Only the years in which either variable has data
+        years = ~(np.isnan(leader).all(axis=1) & np.isnan(follower).all(axis=1))
+        leader, follower = leader[years], follower[years]
+        years = self._index.years[years]
+
+        if only_consistent_cases:
+            leader_rows = ~(
+                np.isnan(leader).any(axis=0) | np.isnan(follower).any(axis=0)
+            )
+            follower_rows = leader_rows
+        else:
+            leader_rows = ~np.isnan(leader).all(axis=0)
+            follower_rows = ~np.isnan(follower).all(axis=0)
+
+        if not follower_rows.any():
+            raise ValueError(
+                "No data is complete enough to use in the time-dependent ratio cruncher"
+            )
+
+        return years, leader[:, leader_rows], follower[:, follower_rows]
+
+
+_WORKER_INFILL = None
+
+
+def _init_infill_worker(fillers, output_db):
+    global _WORKER_INFILL
+    _WORKER_INFILL = (fillers, output_db)
+
+
+def _infill_chunk(chunk):
+    fillers, output_db = _WORKER_INFILL
+    infilled = scmdata.run_append([filler(chunk) for filler in fillers])
+    output_db.save(infilled, disable_tqdm=True)
+
+    return len(infilled)
+
+
+def _get_chunks(scenarios, levels, chunk_size):
+    """
+    Split the timeseries into chunks of about ``chunk_size`` timeseries
+
+    Timeseries with the same values of ``levels`` are kept in the same chunk. A
+    warning is logged if this leaves a single chunk of more than ``chunk_size``
+    timeseries, as then the timeseries cannot be infilled in parallel
+    """
+    ts = scenarios.timeseries()
+    all_levels = levels
+    levels = [
+        level for level in levels if level in ts.index.names and level != "variable"
+    ]
+    if levels:
+        groups = ts.groupby(level=levels, sort=False, dropna=False).indices
+        groups = list(groups.values())
+    else:
+        groups = [np.arange(len(ts))]
+
+    if len(groups) == 1 and len(ts) > chunk_size:
+        logger.warning(
+            "The {} timeseries have the same values of the levels {} so they are "
+            "infilled in a single chunk, without parallelism. Use levels which "
+            "vary between the scenarios (e.g. pathway_id)".format(
+                len(ts), list(all_levels)
+            )
+        )
+
+    chunks = []
+    rows = []
+    n_rows = 0
+    for group in groups:
+        rows.append(group)
+        n_rows += len(group)
+        if n_rows >= chunk_size:
+            chunks.append(scmdata.ScmRun(ts.iloc[np.concatenate(rows)]))
+            rows = []
+            n_rows = 0
+    if rows:
+        chunks.append(scmdata.ScmRun(ts.iloc[np.concatenate(rows)]))
+
+    return chunks
+
+
+def infill_all(
+    cruncher,
+    scenarios,
+    variable_followers,
+    output_db,
+    variable_leaders=None,
+    chunk_size=100,
+    max_workers=None,
+    **kwargs,
+):
+    """
+    Infill many scenarios in chunks in parallel
+
+    The relationships are derived once, in this process, and sent once to each
+    worker. For :class:`EqualQuantileWalk_MM` this is only the prepared quantile
+    tables and for :class:`TimeDepRatio` the ratios, not the database. Each
+    chunk of ``scenarios`` is then infilled and saved to ``output_db`` by a
+    worker so the infilled timeseries are never all held in memory.
+
+    Parameters
+    ----------
+    cruncher : :class:`EqualQuantileWalk_MM` or :class:`TimeDepRatio`
+        Cruncher to infill with
+
+    scenarios : :class:`scmdata.ScmRun`
+        Timeseries of the lead variable
+
+    variable_followers : list[str]
+        The variables to infill
+
+    output_db : :class:`scmdata.database.ScmDatabase`
+        Database to save the infilled timeseries to. The scenarios are only
+        split between chunks along the levels of ``output_db`` (other than
+        ``variable``) so the chunks do not write to the same files, e.g. use
+        levels which include ``pathway_id``
+
+    variable_leaders : list[str]
+        The lead variable. Defaults to ``[LEAD]``
+
+    chunk_size : int
+        Number of timeseries of ``scenarios`` in each chunk
+
+    max_workers : int
+        Maximum number of processes to use. If 1, the chunks are infilled in
+        this process. If None, the number of processors on the machine is used
+
+    **kwargs
+        Passed to :meth:`EqualQuantileWalk_MM.derive_scmrun_relationships` or
+        :meth:`TimeDepRatio.derive_scmrun_relationship`
+
+    Returns
+    -------
+    int
+        Number of timeseries saved to ``output_db``
+    """
+    if variable_leaders is None:
+        variable_leaders = [LEAD]
+
+    if isinstance(cruncher, EqualQuantileWalk_MM):
+        fillers = [
+            cruncher.derive_scmrun_relationships(
+                variable_followers, variable_leaders, **kwargs
+            )
+        ]
+    else:
+        fillers = [
+            cruncher.derive_scmrun_relationship(v, variable_leaders, **kwargs)
+            for v in variable_followers
+        ]
+
+    chunks = _get_chunks(
+        scenarios.filter(variable=variable_leaders, log_if_empty=False),
+        output_db.levels,
+        chunk_size,
+    )
+    if max_workers == 1:
+        _init_infill_worker(fillers, output_db)
+        return sum(_infill_chunk(chunk) for chunk in tqdm(chunks, desc="chunks"))
+
+    with ProcessPoolExecutor(
+        max_workers=max_workers,
+        initializer=_init_infill_worker,
+        initargs=(fillers, output_db),
+    ) as pool:
+        futures = [pool.submit(_infill_chunk, chunk) for chunk in chunks]
+        return sum(
+            future.result()
+            for future in tqdm(as_completed(futures), total=len(futures), desc="chunks")
+        )
+
+
+def _latest_times(ts):
+    # Latest time with data in each row of a timeseries frame
+    notna = ts.notna().values
+    last = notna.shape[1] - 1 - np.argmax(notna[:, ::-1], axis=1)
+    return ts.columns.values[last]
+
+
+def _resample_annual(ts):
+    """
+    Linearly interpolate a timeseries frame with years as columns onto every year
+
+    Gives the same result as :meth:`scmdata.ScmRun.resample` with ``"AS"``, i.e.
+    interpolation in seconds which ignores NaNs in each row, but rows with the
+    same missing values are interpolated together rather than one at a time.
+    """
+    years = ts.columns.values.astype(int)
+    seconds = (years - 1970).astype("datetime64[Y]").astype("datetime64[s]")
+    seconds = seconds.astype(np.int64)
+    target_years = np.arange(years.min(), years.max() + 1)
+    target = (target_years - 1970).astype("datetime64[Y]").astype("datetime64[s]")
+    target = target.astype(np.int64)
+
+    values = ts.values
+    resampled = np.full((len(ts), len(target)), np.nan)
+    masks, groups = np.unique(~np.isnan(values), axis=0, return_inverse=True)
+    for i, mask in enumerate(masks):
+        if mask.sum() < 2:
+            raise InsufficientDataError
+        rows = groups.ravel() == i
+        x = seconds[mask]
+        y = values[rows][:, mask]
+        # As :class:`scipy.interpolate.interp1d`, including linear extrapolation
+        hi = np.clip(np.searchsorted(x, target), 1, len(x) - 1)
+        lo = hi - 1
+        slope = (y[:, hi] - y[:, lo]) / (x[hi] - x[lo])
+        resampled[rows] = slope * (target - x[lo]) + y[:, lo]
+
+    return pd.DataFrame(resampled, index=ts.index, columns=target_years)
+
+
+class _QuantileCurve:
+    """
+    Map between values and quantiles of a distribution
+
+    Follows :func:`silicone.stats.calc_quantiles_of_data`. Without smoothing,
+    the sorted values have quantiles ``0, 1 / (n - 1), ..., 1``. With smoothing,
+    the quantiles are the cumulative sum of a Gaussian kernel density estimate
+    of the distribution.
+
+    Parameters
+    ----------
+    distribution : :obj:`np.ndarray`
+        Values of the distribution. NaNs are ignored
+
+    smoothing : float or str
+        If truthy, the bandwidth of :class:`scipy.stats.gaussian_kde`
+    """
+
+    def __init__(self, distribution, smoothing=None):
+        distribution = distribution[~np.isnan(distribution)]
+        if not len(distribution):
+            raise ValueError("No valid data entered to establish the quantiles.")
+
+        self.minimum = distribution.min()
+        self.maximum = distribution.max()
+        if len(distribution) == 1:
+            # Quantiles are not defined
+            self.values = distribution
+            self.quantiles = np.array([np.nan])
+        elif smoothing:
+            kde = scipy.stats.gaussian_kde(
+                distribution, smoothing, weights=np.ones_like(distribution)
+            )
+            tail = (self.maximum - self.minimum) / 2
+            # tile the probability space with 10000 points between the tail ends
+            xpts = np.linspace(self.minimum - tail, self.maximum + tail, 10000)
+            smooth_dist = np.cumsum(kde(xpts)) * (xpts[1] - xpts[0])
+            # But only keep the values between the extrema
+            keep = (xpts >= self.minimum) & (xpts <= self.maximum)
+            self.values = xpts[keep]
+            self.quantiles = smooth_dist[keep]
+        else:
+            self.values = np.sort(distribution)
+            self.quantiles = np.arange(len(distribution)) / (len(distribution) - 1)
+
+    def to_quantile(self, values):
+        """
+        Quantiles of ``values``, NaN if the distribution has a single value
+        """
+        if len(self.values) == 1:
+            return np.full(np.shape(values), np.nan)
+
+        return np.interp(values, self.values, self.quantiles, left=0, right=1)
+
+    def from_quantile(self, quantiles):
+        """
+        Values at ``quantiles``
+        """
+        if len(self.values) == 1:
+            return np.full(np.shape(quantiles), self.values[0])
+
+        return np.interp(
+            quantiles,
+            self.quantiles,
+            self.values,
+            left=self.minimum,
+            right=self.maximum,
+        )
+
+
+_WORKER_EXTENDER = None
+
+
+def _init_extender_worker(extender):
+    global _WORKER_EXTENDER
+    _WORKER_EXTENDER = extender
+
+
+def _extend_chunk(scenarios):
+    return _WORKER_EXTENDER.extend(scenarios)
+
+
+class TimeseriesExtender:
+    """
+    Extend timeseries by keeping them at their latest quantile in a database
+
+    The quantile of each timeseries in the distribution of the database at its
+    latest time is kept for all the later times in the database. This is the
+    approach of :class:`silicone.time_projectors.ExtendLatestTimeQuantile`,
+    but the distributions of the database are prepared once and all the
+    timeseries are projected together with array operations.
+
+    Parameters
+    ----------
+    infilling_database : :class:`scmdata.ScmRun` or :class:`InfillingDatabase`
+        Database of scenarios which extend to 2100. Only the five-yearly data from
+        2015 is used
+
+    lead : str
+        Variable in ``infilling_database`` to follow
+
+    smoothing : float or str
+        If truthy, the distribution of the database at each time is smoothed
+        with a Gaussian kernel density estimate with this bandwidth, see
+        :class:`scipy.stats.gaussian_kde`
+
+    Raises
+    ------
+    ValueError
+        There is no data or more than one unit for ``lead`` in
+        ``infilling_database``
+    """
+
+    def __init__(self, infilling_database, lead=LEAD, smoothing=0):
+        self.lead = lead
+        self.smoothing = smoothing
+
+        if isinstance(infilling_database, InfillingDatabase):
+            years = np.isin(infilling_database.years, range(2015, 2101, 5))
+            # year x scenario
+            values = infilling_database.values(lead)[years]
+            has_data = ~np.isnan(values).all(axis=0)
+            ts = pd.DataFrame(
+                values[:, has_data].T, columns=infilling_database.years[years]
+            )
+        else:
+            database = infilling_database.filter(
+                variable=lead, year=range(2015, 2101, 5), log_if_empty=False
+            )
+            if database.empty:
+                raise ValueError(
+                    "No data for `variable` ({}) in database".format(lead)
                 )
-                logger.warning(warn_str)
-                print(warn_str)
-            times_needed = set(in_iamdf.data[in_iamdf.time_col])
-            if any(
-                [
-                    k not in set(iamdf_follower[data_follower_time_col])
-                    for k in times_needed
-                ]
-            ):
-                error_msg = (
-                    "Not all required timepoints are in the data for "
-                    "the lead gas ({})".format(variable_leaders[0])
+            if len(database.get_unique_meta("unit")) != 1:
+                raise ValueError(
+                    "The infiller database has {} units in it. It should have "
+                    "one.".format(len(database.get_unique_meta("unit")))
                 )
-                raise ValueError(error_msg)
-            output_ts = lead_var.timeseries()
-
-            for year in times_needed:
-                if (
-                    scaling.loc[year][
-                        output_ts[year].map(lambda x: "neg" if x < 0 else "pos")
-                    ]
-                    .isnull()
-                    .values.any()
-                ):
-                    raise ValueError(
-                        "Attempt to infill {} data using the time_dep_ratio cruncher "
-                        "where the infillee data has a sign not seen in the infiller "
-                        "database for year "
-                        "{}.".format(variable_leaders, year)
-                    )
-                output_ts[year] = (
-                    output_ts[year].values
-                    * scaling.loc[year][
-                        output_ts[year].map(lambda x: "pos" if x > 0 else "neg")
-                    ].values
+            ts = database.timeseries(time_axis="year")
+
+        ts = ts.dropna(axis=1, how="all")
+        if ts.isnull().values.any():
+            logger.warning("The input database may be inconsistent at later times")
+        self._years = ts.columns.values
+        self._curves = [
+            _QuantileCurve(ts[year].values, smoothing) for year in self._years
+        ]
+
+    def extend(self, scenarios, max_workers=1, chunk_size=100):
+        """
+        Extend a batch of timeseries
+
+        Each timeseries is extended from the latest time it has data for and
+        the result is resampled to annual values.
+
+        Parameters
+        ----------
+        scenarios : :class:`scmdata.ScmRun`
+            Timeseries to extend. They are assumed to be of ``lead``
+
+        max_workers : int
+            Number of processes to extend the timeseries with. If 1, the
+            timeseries are extended in this process. If None, the number of
+            processors on the machine is used
+
+        chunk_size : int
+            Number of timeseries sent to a process at once
+
+        Returns
+        -------
+        :class:`scmdata.ScmRun`
+            The input and extended timeseries with ``stage`` set to
+            ``"extended"``
+
+        Raises
+        ------
+        ValueError
+            The latest time of a timeseries is not in the database or the
+            database does not extend past it
+        """
+        scenarios = scenarios.copy()
+        scenarios["variable"] = self.lead
+
+        if max_workers == 1:
+            extended = self._extend_filled(scenarios)
+        else:
+            ts = scenarios.timeseries()
+            chunks = [
+                scmdata.ScmRun(ts.iloc[i : i + chunk_size])
+                for i in range(0, len(ts), chunk_size)
+            ]
+            with ProcessPoolExecutor(
+                max_workers=max_workers,
+                initializer=_init_extender_worker,
+                initargs=(self,),
+            ) as pool:
+                extended = scmdata.run_append(list(pool.map(_extend_chunk, chunks)))
+
+        extended["stage"] = "extended"
+        return extended
+
+    def _extend_filled(self, scenarios):
+        ts = scenarios.timeseries(time_axis="year")
+        latest = _latest_times(ts)
+        latest_values = ts.values[
+            np.arange(len(ts)), np.searchsorted(ts.columns.values, latest)
+        ]
+
+        # Quantile of each timeseries at its latest time
+        quantiles = np.full(len(ts), np.nan)
+        for time in np.unique(latest):
+            if time not in self._years:
+                raise ValueError(
+                    "The latest time of a timeseries ({}) is not in the infiller "
+                    "database".format(time)
+                )
+            if time >= self._years[-1]:
+                raise ValueError(
+                    "The infiller database does not extend in time past the target "
+                    "database, so no infilling can occur."
                 )
-            output_ts.reset_index(inplace=True)
-            output_ts["variable"] = variable_follower
-            output_ts["unit"] = data_follower_unit
+            rows = latest == time
+            curve = self._curves[np.searchsorted(self._years, time)]
+            quantiles[rows] = curve.to_quantile(latest_values[rows])
 
-            return IamDataFrame(output_ts)
+        if np.isnan(quantiles).any():
+            logger.warning("Only a single value provided for calculating quantiles")
+            quantiles[np.isnan(quantiles)] = 0.5
 
-        return filler
+        # Values at the same quantiles at all the later times
+        later = self._years > latest.min()
+        extended = np.full((len(ts), later.sum()), np.nan)
+        for i, (year, curve) in enumerate(
+            zip(self._years[later], np.array(self._curves, dtype=object)[later])
+        ):
+            rows = latest < year
+            extended[rows, i] = curve.from_quantile(quantiles[rows])
+        extended = pd.DataFrame(extended, index=ts.index, columns=self._years[later])
+
+        return scmdata.ScmRun(_resample_annual(ts.combine_first(extended)))
 
 
 def extend_timeseries(infilling_database, scenario, lead=LEAD, smoothing=0):
-    cruncher = silicone.time_projectors.ExtendLatestTimeQuantile(
-        infilling_database.filter(year=range(2015, 2101, 5)).to_iamdataframe()
-    )
-    filler = cruncher.derive_relationship(lead, smoothing=smoothing)
+    """
+    Extend timeseries by keeping them at their latest quantile in a database
+
+    To extend many batches of timeseries with the same database, create a
+    :class:`TimeseriesExtender` once instead.
+
+    Parameters
+    ----------
+    infilling_database : :class:`scmdata.ScmRun` or :class:`InfillingDatabase`
+        Database of scenarios which extend to 2100
 
+    scenario : :class:`scmdata.ScmRun`
+        Timeseries to extend
+
+    lead : str
+        Variable in ``infilling_database`` to follow
+
+    smoothing : float or str
+        Smoothing of the distribution of the database
+
+    Returns
+    -------
+    :class:`scmdata.ScmRun`
+        The input and extended timeseries
+    """
     scenario["variable"] = lead
-    extended_scenario = filler(scenario.to_iamdataframe())
-    extended_scenario = scmdata.ScmRun(scenario.append(extended_scenario)).resample(
-        "AS"
-    )
-    extended_scenario["stage"] = "extended"
-    return extended_scenario
+    return TimeseriesExtender(infilling_database, lead, smoothing).extend(scenario)
 
 
 # Excludes CO2|AFOLU
@@ -357,20 +1316,123 @@ kyoto_ghg_exclude_co2_vars = [
 ]
 
 
+GHG_UNIT = "Mt CO2 / yr"
+
+
+@functools.lru_cache(maxsize=None)
+def _gwp_weight(unit, context):
+    # Emissions units convert linearly so a conversion is a single factor
+    return float(UnitConverter(unit, GHG_UNIT, context=context).convert_from(1.0))
+
+
+def _gwp_weights(units, contexts):
+    """
+    Get the GWP weights to convert each unit to :data:`GHG_UNIT`
+
+    The weights are only calculated with pint once per unit and context.
+
+    Returns
+    -------
+    :obj:`np.ndarray`
+        Weights with shape (units, contexts)
+    """
+    return np.array(
+        [[_gwp_weight(unit, context) for context in contexts] for unit in units]
+    ).reshape(len(units), len(contexts))
+
+
 def calc_ghg(
     run,
     include_vars,
     var_name="GHG excl CO2 AFOLU",
     context="AR6GWP100",
 ):
-    keep_met = list(set(run.meta.columns) - {"variable"})
-    ghgeq = (
-        run.filter(variable=include_vars)
-        .convert_unit("Mt CO2 / yr", context=context)
-        .timeseries()
-        .groupby(keep_met)
-        .sum(min_count=1)
-    )
-    ghgeq["variable"] = "Emissions|{} ({})".format(var_name, context)
-    ghgeq = scmdata.ScmRun(ghgeq)
-    return ghgeq
+    """
+    Calculate the CO2-equivalent sum of some variables
+
+    The timeseries are stacked into a (timeseries x gas x time) array which is
+    weighted with a (gas x context) matrix of GWPs, so the sums for several
+    metrics are calculated at once.
+
+    Parameters
+    ----------
+    run : :class:`scmdata.ScmRun` or :class:`InfillingDatabase`
+        Timeseries to sum. The variables of an :class:`InfillingDatabase` are
+        already aligned by scenario so they are stacked without grouping
+
+    include_vars : list[str]
+        Variables to include in the sum
+
+    var_name : str
+        Name of the output variable
+
+    context : str or list[str]
+        Metric(s) used to convert to CO2-equivalent emissions (e.g.
+        ``"AR6GWP100"``)
+
+    Returns
+    -------
+    :class:`scmdata.ScmRun`
+        Sum of ``include_vars`` for each context with the variable
+        ``"Emissions|{var_name} ({context})"`` in units of ``"Mt CO2 / yr"``.
+        Timeseries are summed over all metadata other than ``variable`` and
+        ``unit``. A time is NaN if all the included variables are NaN
+    """
+    contexts = [context] if isinstance(context, str) else list(context)
+    if isinstance(run, InfillingDatabase):
+        gases = [v for v in include_vars if v in run]
+        # timeseries x gas x time, NaN where a gas is missing
+        values = np.array([run.values(v) for v in gases]).reshape(
+            len(gases), len(run.years), len(run.meta)
+        )
+        values = values.transpose(2, 0, 1)
+        present = ~np.isnan(values)
+        has_data = present.any(axis=(1, 2))
+        stacked, present = np.nan_to_num(values[has_data]), present[has_data]
+        group_meta = run.meta[has_data]
+        gas_units = [run.get_unit(v) for v in gases]
+        columns = run.years
+    else:
+        keep_met = sorted(set(run.meta.columns) - {"variable", "unit"})
+
+        ts = run.filter(variable=include_vars).timeseries()
+        meta = ts.index.to_frame(index=False)
+        groups = meta.groupby(keep_met, sort=True).ngroup().values
+        gases = meta.groupby(["variable", "unit"], sort=False).ngroup().values
+        # Rows with missing metadata are not part of any group
+        valid = (groups >= 0) & (gases >= 0)
+        groups, gases, values = groups[valid], gases[valid], ts.values[valid]
+        group_meta = (
+            meta[valid][keep_met].assign(_group=groups).drop_duplicates("_group")
+        )
+        group_meta = group_meta.sort_values("_group").drop(columns="_group")
+        gas_units = (
+            meta[valid].assign(_gas=gases).drop_duplicates("_gas").sort_values("_gas")
+        )["unit"].values
+
+        # timeseries x gas x time, NaN where a gas is missing
+        stacked = np.zeros((len(group_meta), len(gas_units), values.shape[1]))
+        present = np.zeros_like(stacked, dtype=bool)
+        np.add.at(stacked, (groups, gases), np.nan_to_num(values))
+        np.logical_or.at(present, (groups, gases), ~np.isnan(values))
+        columns = ts.columns
+
+    # context x timeseries x time
+    weights = _gwp_weights(gas_units, contexts)
+    ghgeq = np.tensordot(weights, stacked, axes=([0], [1]))
+    ghgeq[:, ~present.any(axis=1)] = np.nan
+
+    out = []
+    for ctx, ctx_values in zip(contexts, ghgeq):
+        ctx_meta = group_meta.assign(
+            variable="Emissions|{} ({})".format(var_name, ctx), unit=GHG_UNIT
+        )
+        out.append(
+            pd.DataFrame(
+                ctx_values,
+                index=pd.MultiIndex.from_frame(ctx_meta),
+                columns=columns,
+            )
+        )
+
+    return scmdata.ScmRun(pd.concat(out))
@@ -0,0 +1,346 @@
+"""
+Infilling database indexed by variable and year
+
+The infilling code repeatedly needs the values of a variable in a year for all
+the scenarios of the database. :class:`InfillingDatabase` stores them in a dense
+(variable x year x scenario) array so these are contiguous slices which are
+found with a dictionary lookup rather than by filtering the metadata.
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+import scmdata
+
+from .cache import make_key
+from .constants import PROCESSED_DATA_DIR
+
+SR15_DATA_FILE = os.path.join(PROCESSED_DATA_DIR, "sr15_data.csv")
+
+
+def _nanquantile(values, quantiles):
+    """
+    Quantiles along the last axis ignoring NaNs
+
+    Uses the same linear interpolation as :meth:`pandas.DataFrame.quantile`
+    (and hence :meth:`scmdata.ScmRun.quantiles_over`) so the results are
+    identical.
+
+    Returns
+    -------
+    :obj:`np.ndarray`
+        Quantiles with shape (quantiles, ...)
+    """
+    # NaNs are sorted to the end
+    values = np.sort(values, axis=-1)
+    count = (~np.isnan(values)).sum(axis=-1)
+    n = values.shape[-1]
+
+    res = []
+    for q in quantiles:
+        idx = q * (count - 1)
+        lower = np.floor(idx).astype(int)
+        frac = idx % 1
+        value = np.take_along_axis(
+            values, np.clip(lower, 0, n - 1)[..., np.newaxis], axis=-1
+        )[..., 0]
+        next_value = np.take_along_axis(
+            values, np.clip(lower + 1, 0, n - 1)[..., np.newaxis], axis=-1
+        )[..., 0]
+        with np.errstate(invalid="ignore"):
+            q_values = np.where(frac == 0, value, value + (next_value - value) * frac)
+        res.append(np.where(count == 0, np.nan, q_values))
+
+    return np.array(res)
+
+
+class InfillingDatabase:
+    """
+    Immutable infilling database indexed by variable and year
+
+    Each scenario of the database (a unique combination of the metadata other
+    than ``variable`` and ``unit``) is a column of a dense (variable x year x
+    scenario) array, with NaN where a scenario does not have a variable. The
+    values of a variable in a year are therefore a contiguous slice which is
+    found without filtering, and the rows of different variables are aligned
+    by scenario.
+
+    The database is built once (see :meth:`from_csv`) and can be shared by
+    :class:`ndcs.infilling.EqualQuantileWalk_MM`,
+    :class:`ndcs.infilling.TimeDepRatio`, :func:`ndcs.infilling.calc_ghg` and
+    :class:`ndcs.infilling.TimeseriesExtender`. The arrays are read-only.
+
+    Parameters
+    ----------
+    run : :class:`scmdata.ScmRun`
+        Database. Anything that :class:`scmdata.ScmRun` can be initialised from
+        (e.g. a :obj:`pyam.IamDataFrame`) is also accepted
+
+    Raises
+    ------
+    ValueError
+        A variable has more than one unit
+    """
+
+    def __init__(self, run):
+        if not isinstance(run, scmdata.ScmRun):
+            run = scmdata.ScmRun(run)
+
+        ts = run.timeseries(time_axis="year")
+        meta = ts.index.to_frame(index=False)
+
+        units = meta.groupby("variable")["unit"].unique()
+        multiple_units = units[units.apply(len) > 1]
+        if len(multiple_units):
+            raise ValueError(
+                "Variables with more than one unit: {}".format(
+                    list(multiple_units.index)
+                )
+            )
+
+        scenario_cols = sorted(set(meta.columns) - {"variable", "unit"})
+        scenarios = meta.groupby(scenario_cols, sort=True, dropna=False).ngroup()
+        scenarios = scenarios.values
+        scenario_meta = (
+            meta[scenario_cols]
+            .assign(_scenario=scenarios)
+            .drop_duplicates("_scenario")
+            .sort_values("_scenario")
+            .drop(columns="_scenario")
+            .reset_index(drop=True)
+        )
+
+        variables = list(units.index)
+        variable_idx = pd.Index(variables).get_indexer(meta["variable"])
+
+        values = np.full((len(variables), ts.shape[1], len(scenario_meta)), np.nan)
+        values[variable_idx, :, scenarios] = ts.values
+        values.setflags(write=False)
+
+        years = np.array(ts.columns.values, dtype=int)
+        years.setflags(write=False)
+
+        self._values = values
+        self._years = years
+        self._meta = scenario_meta
+        self._units = {v: u[0] for v, u in units.items()}
+        self._variable_idx = {v: i for i, v in enumerate(variables)}
+        self._year_idx = {y: i for i, y in enumerate(years)}
+        self._key = None
+
+    @classmethod
+    def from_csv(cls, fname=SR15_DATA_FILE):
+        """
+        Load a database from a CSV file
+
+        Parameters
+        ----------
+        fname : str
+            File to load. Defaults to the processed SR1.5 data
+
+        Returns
+        -------
+        :class:`InfillingDatabase`
+        """
+        return cls(scmdata.ScmRun(fname))
+
+    def __repr__(self):
+        return "<InfillingDatabase variables: {}, years: {}, scenarios: {}>".format(
+            len(self.variables), len(self.years), len(self.meta)
+        )
+
+    def __contains__(self, variable):
+        return variable in self._variable_idx
+
+    def copy(self):
+        """
+        The database is immutable so it is not copied
+        """
+        return self
+
+    @property
+    def variables(self):
+        """
+        list[str]: Variables in the database
+        """
+        return list(self._variable_idx)
+
+    @property
+    def years(self):
+        """
+        :obj:`np.ndarray`: Years of the database
+        """
+        return self._years
+
+    @property
+    def meta(self):
+        """
+        :obj:`pd.DataFrame`: Metadata of each scenario
+        """
+        return self._meta.copy()
+
+    @property
+    def key(self):
+        """
+        str: Key of the content of the database, see :func:`ndcs.cache.make_key`
+        """
+        if self._key is None:
+            self._key = make_key(
+                self._values,
+                self._years,
+                self._meta,
+                sorted(self._units.items()),
+            )
+
+        return self._key
+
+    def get_unit(self, variable):
+        """
+        Get the unit of a variable
+        """
+        self._check_variable(variable)
+        return self._units[variable]
+
+    def _check_variable(self, variable):
+        if variable not in self._variable_idx:
+            raise ValueError("No data for `variable` ({}) in database".format(variable))
+
+    def values(self, variable, year=None):
+        """
+        Get the values of a variable
+
+        Parameters
+        ----------
+        variable : str
+            Variable to get
+
+        year : int
+            If given, only the values in this year
+
+        Returns
+        -------
+        :obj:`np.ndarray`
+            Read-only view of the values of each scenario with shape
+            (scenarios,) if ``year`` is given, otherwise (years, scenarios).
+            Scenarios without ``variable`` are NaN
+
+        Raises
+        ------
+        ValueError
+            ``variable`` or ``year`` is not in the database
+        """
+        self._check_variable(variable)
+        values = self._values[self._variable_idx[variable]]
+        if year is None:
+            return values
+
+        if year not in self._year_idx:
+            raise ValueError("No data for year {} in database".format(year))
+
+        return values[self._year_idx[year]]
+
+    def quantiles(self, quantiles):
+        """
+        Calculate the quantiles of each variable over the scenarios
+
+        Parameters
+        ----------
+        quantiles : list[float]
+            Quantiles to calculate
+
+        Returns
+        -------
+        :class:`pandas.DataFrame`
+            The quantiles of each variable, like the output of
+            ``quantiles_over(("scenario", "model"), quantiles)`` on the database.
+            The scenarios are grouped by the rest of their metadata (e.g.
+            ``climate_model``) and the quantiles are calculated over the
+            scenarios of each group. Each quantile is labelled in the
+            ``quantile`` level of the index
+        """
+        quantiles = np.asarray(quantiles, dtype=float)
+
+        group_cols = [c for c in self._meta.columns if c not in ("model", "scenario")]
+        if group_cols:
+            groups = self._meta.groupby(group_cols, sort=True, dropna=False).ngroup()
+            groups = groups.values
+            group_meta = (
+                self._meta[group_cols]
+                .assign(_group=groups)
+                .drop_duplicates("_group")
+                .sort_values("_group")
+                .drop(columns="_group")
+                .reset_index(drop=True)
+            )
+        else:
+            groups = np.zeros(len(self._meta), dtype=int)
+            group_meta = pd.DataFrame(index=[0])
+
+        values = []
+        index = []
+        for group, meta in group_meta.iterrows():
+            group_values = self._values[:, :, groups == group]
+            # Variables which none of the scenarios in the group have
+            has_data = ~np.isnan(group_values).all(axis=(1, 2))
+            variables = np.array(self.variables)[has_data]
+
+            # quantile x variable x year
+            values.append(_nanquantile(group_values[has_data], quantiles))
+            group_index = pd.DataFrame(
+                {
+                    "variable": np.repeat(variables, len(quantiles)),
+                    "unit": np.repeat(
+                        [self._units[v] for v in variables], len(quantiles)
+                    ),
+                    "quantile": np.tile(quantiles, len(variables)),
+                }
+            )
+            for c in group_cols:
+                group_index[c] = meta[c]
+            index.append(group_index)
+
+        index = pd.concat(index, ignore_index=True)
+        index = index[sorted(set(index.columns) - {"quantile"}) + ["quantile"]]
+
+        return pd.DataFrame(
+            np.concatenate(
+                [v.transpose(1, 0, 2).reshape(-1, len(self._years)) for v in values]
+            ),
+            index=pd.MultiIndex.from_frame(index),
+            columns=pd.Index(self._years, name="year"),
+        )
+
+    def to_run(self, variables=None):
+        """
+        Convert to a :class:`scmdata.ScmRun`
+
+        Parameters
+        ----------
+        variables : list[str]
+            Variables to include. If None, all the variables are included
+
+        Returns
+        -------
+        :class:`scmdata.ScmRun`
+            Timeseries of each variable and scenario with data
+        """
+        if variables is None:
+            variables = self.variables
+
+        out = []
+        for variable in variables:
+            values = self.values(variable).T
+            has_data = ~np.isnan(values).all(axis=1)
+            meta = self._meta[has_data].assign(
+                variable=variable, unit=self._units[variable]
+            )
+            out.append(
+                pd.DataFrame(
+                    values[has_data],
+                    index=pd.MultiIndex.from_frame(meta),
+                    columns=self._years,
+                )
+            )
+
+        return scmdata.ScmRun(pd.concat(out))
@@ -0,0 +1,408 @@
+"""
+Storage of the metadata describing each global pathway
+
+Each pathway records which countries' NDCs were selected (and when they were
+submitted) and which countries were filled using baseline emissions. Rather than
+writing a ``selected_countries.json`` file per pathway, :class:`PathwayMetaStore`
+keeps this information for a release in a single SQLite database. Only the
+countries whose status changes between consecutive pathways are stored so the
+size of the store grows linearly with the number of pathways.
+"""
+
+import contextlib
+import json
+import os
+import sqlite3
+
+import pandas as pd
+
+from .utils import ensure_dir_exists
+
+KEY_COLUMNS = ("ambition", "conditionality", "country_extension", "exclude_hot_air")
+PATHWAY_COLUMNS = KEY_COLUMNS + ("pathway_id", "pathway_num", "date", "last_country")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS pathways (
+    ambition TEXT NOT NULL,
+    conditionality TEXT NOT NULL,
+    country_extension TEXT NOT NULL,
+    exclude_hot_air TEXT NOT NULL,
+    pathway_id TEXT NOT NULL,
+    pathway_num INTEGER NOT NULL,
+    date TEXT NOT NULL,
+    last_country TEXT NOT NULL,
+    PRIMARY KEY (
+        ambition, conditionality, country_extension, exclude_hot_air, pathway_id
+    )
+);
+CREATE INDEX IF NOT EXISTS pathways_num ON pathways (
+    ambition, conditionality, country_extension, exclude_hot_air, pathway_num
+);
+CREATE INDEX IF NOT EXISTS pathways_last_country ON pathways (last_country);
+CREATE INDEX IF NOT EXISTS pathways_date ON pathways (date);
+CREATE TABLE IF NOT EXISTS regions (
+    ambition TEXT NOT NULL,
+    conditionality TEXT NOT NULL,
+    country_extension TEXT NOT NULL,
+    exclude_hot_air TEXT NOT NULL,
+    pathway_num INTEGER NOT NULL,
+    region TEXT NOT NULL,
+    status TEXT NOT NULL,
+    submission_date TEXT,
+    PRIMARY KEY (
+        ambition,
+        conditionality,
+        country_extension,
+        exclude_hot_air,
+        pathway_num,
+        region
+    )
+);
+CREATE INDEX IF NOT EXISTS regions_region ON regions (region);
+"""
+
+SELECTED = "selected"
+MISSING = "missing"
+ABSENT = "absent"
+
+
+def selected_countries_fname(
+    meta_dir, ambition, conditionality, pathway_id, country_extension
+):
+    """
+    Get the filename of a pathway's ``selected_countries.json`` file
+    """
+    return os.path.join(
+        meta_dir,
+        ambition,
+        conditionality,
+        pathway_id,
+        country_extension,
+        "selected_countries.json",
+    )
+
+
+def _get_region_states(record):
+    states = {r: (SELECTED, str(d)) for r, d in record["selected"].items()}
+    states.update({r: (MISSING, None) for r in record["missing"]})
+    return states
+
+
+def _where(filters):
+    clauses = []
+    values = []
+    for k, v in filters.items():
+        if isinstance(v, (list, tuple, set)):
+            v = list(v)
+            clauses.append("{} IN ({})".format(k, ", ".join("?" * len(v))))
+            values.extend(v)
+        else:
+            clauses.append("{} = ?".format(k))
+            values.append(v)
+
+    if not clauses:
+        return "", values
+    return " WHERE " + " AND ".join(clauses), values
+
+
+class PathwayMetaStore:
+    """
+    Metadata for the global pathways of a release stored in a SQLite database
+
+    Pathways are keyed by (``ambition``, ``conditionality``,
+    ``country_extension``, ``exclude_hot_air``, ``pathway_id``). Each record
+    contains the same information as the ``selected_countries.json`` files
+    written by :class:`ndcs.pathways.NDCCruncher` plus the ``date`` of the
+    pathway.
+
+    A connection is only opened for each operation so the store can be passed
+    to other processes.
+
+    Parameters
+    ----------
+    fname : str
+        Path to the SQLite database. It is created if it does not exist
+    """
+
+    def __init__(self, fname):
+        self.fname = fname
+        # (key) -> (pathway_num, {region: (status, submission_date)})
+        self._last_states = {}
+
+        ensure_dir_exists(fname)
+        with self._connect() as conn:
+            conn.executescript(_SCHEMA)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_last_states"] = {}
+        return state
+
+    @contextlib.contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.fname, timeout=60)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def add(self, record):
+        """
+        Add the metadata for a pathway
+
+        Parameters
+        ----------
+        record : dict
+            Pathway metadata with the keys of ``selected_countries.json``
+            (``selected``, ``missing``, ``last_country``, ``pathway_num``,
+            ``pathway_id`` and the key columns) and ``date``
+        """
+        self.add_many([record])
+
+    def add_many(self, records):
+        """
+        Add the metadata for many pathways in a single transaction
+
+        Records for the same option combination are fastest to add in order of
+        ``pathway_num``. A pathway which already exists (with the same
+        ``pathway_id`` or ``pathway_num``) is replaced and the pathways after it
+        are unchanged.
+
+        Parameters
+        ----------
+        records : list[dict]
+            Pathway metadata, see :meth:`add`
+        """
+        with self._connect() as conn:
+            for record in records:
+                self._insert(conn, record)
+
+    def _insert(self, conn, record):
+        key = tuple(str(record[c]) for c in KEY_COLUMNS)
+        pathway_num = int(record["pathway_num"])
+        key_where, key_values = _where(dict(zip(KEY_COLUMNS, key)))
+
+        # The regions of the next pathway are stored relative to this one so must
+        # be re-encoded if this pathway is replaced
+        following = conn.execute(
+            "SELECT MIN(pathway_num) FROM pathways"
+            + key_where
+            + " AND pathway_num > ?",
+            key_values + [pathway_num],
+        ).fetchone()[0]
+        if following is not None:
+            following_states = self._read_region_states(conn, key, following)
+
+        conn.execute(
+            "DELETE FROM pathways" + key_where + " AND pathway_num = ?",
+            key_values + [pathway_num],
+        )
+        conn.execute(
+            "INSERT OR REPLACE INTO pathways VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            key
+            + (
+                record["pathway_id"],
+                pathway_num,
+                str(record["date"]),
+                record["last_country"],
+            ),
+        )
+
+        previous = self._last_states.get(key)
+        if previous is None or previous[0] != pathway_num - 1:
+            previous = (
+                pathway_num - 1,
+                self._read_region_states(conn, key, pathway_num - 1),
+            )
+        states = _get_region_states(record)
+        self._write_changes(conn, key, pathway_num, previous[1], states)
+        if following is not None:
+            self._write_changes(conn, key, following, states, following_states)
+
+        self._last_states[key] = (pathway_num, states)
+
+    def _write_changes(self, conn, key, pathway_num, previous, states):
+        # Only store the regions which changed since the previous pathway
+        changes = {r: s for r, s in states.items() if previous.get(r) != s}
+        changes.update({r: (ABSENT, None) for r in previous if r not in states})
+
+        where, values = _where(dict(zip(KEY_COLUMNS, key), pathway_num=pathway_num))
+        conn.execute("DELETE FROM regions" + where, values)
+        conn.executemany(
+            "INSERT INTO regions VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [key + (pathway_num, r, s, d) for r, (s, d) in sorted(changes.items())],
+        )
+
+    def _read_region_states(self, conn, key, pathway_num):
+        where, values = _where(dict(zip(KEY_COLUMNS, key)))
+        rows = conn.execute(
+            "SELECT region, status, submission_date FROM regions"
+            + where
+            + " AND pathway_num <= ? ORDER BY pathway_num",
+            values + [pathway_num],
+        )
+        states = {}
+        for region, status, submission_date in rows:
+            states[region] = (status, submission_date)
+
+        return {r: s for r, s in states.items() if s[0] != ABSENT}
+
+    def pathways(self, **filters):
+        """
+        Get the available pathways
+
+        Parameters
+        ----------
+        **filters
+            Values to filter on, e.g. ``last_country="IND"`` or
+            ``date="2021-10-18"``. If a list is provided any of the values
+            match
+
+        Returns
+        -------
+        :obj:`pd.DataFrame`
+            One row per pathway ordered by ``pathway_num``
+        """
+        unknown = set(filters) - set(PATHWAY_COLUMNS)
+        if unknown:
+            raise ValueError("Unknown columns: {}".format(sorted(unknown)))
+
+        where, values = _where(filters)
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT {} FROM pathways{} ORDER BY {}, pathway_num".format(
+                    ", ".join(PATHWAY_COLUMNS), where, ", ".join(KEY_COLUMNS)
+                ),
+                values,
+            ).fetchall()
+
+        return pd.DataFrame(rows, columns=PATHWAY_COLUMNS)
+
+    def load(
+        self, ambition, conditionality, country_extension, exclude_hot_air, pathway_id
+    ):
+        """
+        Load the metadata for a single pathway
+
+        Returns
+        -------
+        dict
+            Pathway metadata in the same format as ``selected_countries.json``
+
+        Raises
+        ------
+        KeyError
+            The pathway is not in the store
+        """
+        key = dict(
+            ambition=ambition,
+            conditionality=conditionality,
+            country_extension=country_extension,
+            exclude_hot_air=exclude_hot_air,
+        )
+        pathway = self.pathways(pathway_id=pathway_id, **key)
+        if pathway.empty:
+            raise KeyError("No metadata for {} {}".format(pathway_id, key))
+
+        pathway = pathway.iloc[0]
+        with self._connect() as conn:
+            states = self._read_region_states(
+                conn, tuple(key.values()), int(pathway["pathway_num"])
+            )
+
+        return self._to_record(pathway, states)
+
+    @staticmethod
+    def _to_record(pathway, states):
+        return {
+            "selected": {r: d for r, (s, d) in sorted(states.items()) if s == SELECTED},
+            "missing": [r for r, (s, _) in sorted(states.items()) if s == MISSING],
+            "last_country": pathway["last_country"],
+            "pathway_num": int(pathway["pathway_num"]),
+            "pathway_id": pathway["pathway_id"],
+            "conditionality": pathway["conditionality"],
+            "country_extension": pathway["country_extension"],
+            "exclude_hot_air": pathway["exclude_hot_air"],
+            "ambition": pathway["ambition"],
+        }
+
+    def iter_records(self, **filters):
+        """
+        Iterate over the metadata of the pathways matching ``filters``
+
+        The changes for each option combination are read once and replayed so
+        this is much faster than calling :meth:`load` for each pathway.
+
+        Yields
+        ------
+        dict
+            Pathway metadata in the same format as ``selected_countries.json``
+        """
+        pathways = self.pathways(**filters)
+        with self._connect() as conn:
+            for key, key_pathways in pathways.groupby(list(KEY_COLUMNS), sort=False):
+                where, values = _where(dict(zip(KEY_COLUMNS, key)))
+                rows = conn.execute(
+                    "SELECT pathway_num, region, status, submission_date FROM regions"
+                    + where
+                    + " ORDER BY pathway_num",
+                    values,
+                ).fetchall()
+
+                states = {}
+                i = 0
+                for _, pathway in key_pathways.iterrows():
+                    while i < len(rows) and rows[i][0] <= pathway["pathway_num"]:
+                        states[rows[i][1]] = (rows[i][2], rows[i][3])
+                        i += 1
+                    yield self._to_record(pathway, states)
+
+    def export_json(self, meta_dir, **filters):
+        """
+        Write the metadata using the ``selected_countries.json`` layout
+
+        As with the files written by :class:`ndcs.pathways.NDCCruncher`, the
+        layout does not include ``exclude_hot_air`` so filter on it if both
+        values are stored.
+
+        Parameters
+        ----------
+        meta_dir : str
+            Root directory of the layout, typically
+            :data:`ndcs.pathways.GLOBAL_DATABASE_META_DIR`
+
+        **filters
+            Passed to :meth:`pathways` to select the pathways to export
+        """
+        for record in self.iter_records(**filters):
+            fname = selected_countries_fname(
+                meta_dir,
+                record["ambition"],
+                record["conditionality"],
+                record["pathway_id"],
+                record["country_extension"],
+            )
+            ensure_dir_exists(fname)
+            with open(fname, "w") as fh:
+                json.dump(record, fh)
+
+    def delete(self, **filters):
+        """
+        Delete the metadata of the option combinations matching ``filters``
+
+        Parameters
+        ----------
+        **filters
+            Values for any of the key columns. Deletes everything if no filters
+            are provided
+        """
+        unknown = set(filters) - set(KEY_COLUMNS)
+        if unknown:
+            raise ValueError("Can only delete using {}".format(KEY_COLUMNS))
+
+        where, values = _where(filters)
+        with self._connect() as conn:
+            conn.execute("DELETE FROM pathways" + where, values)
+            conn.execute("DELETE FROM regions" + where, values)
+        self._last_states = {}
@@ -3,8 +3,19 @@ import logging
 from tqdm.auto import tqdm
 import json
 import os
+import bisect
+import copy
+import pickle
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+from scmdata.database.backends import NetCDFDatabaseBackend
 
 from .utils import ensure_dir_exists
+from .pathway_meta import selected_countries_fname
+from .profiling import NullProfiler, add_suffix, get_profiler
 from .constants import PROCESSED_DATA_DIR, NDC_TARGET_RELEASE
 
 logger = logging.getLogger(__name__)
@@ -13,21 +24,83 @@ GLOBAL_DATABASE_META_DIR = os.path.join(
     PROCESSED_DATA_DIR, "global_emissions_meta", NDC_TARGET_RELEASE
 )
 
+# Options which select the NDCs used for a set of pathways
+OPTION_COLUMNS = ("conditionality", "ambition", "country_extension", "exclude_hot_air")
 
-def _get_latest(run, cmp_col="submission_date"):
-    most_recent = run[cmp_col].max()
+# Levels of a global pathway database which stores all the pathways of a
+# combination of options in one file, see :func:`get_buffered_database`
+BUFFERED_DATABASE_LEVELS = (
+    "ambition",
+    "conditionality",
+    "country_extension",
+    "exclude_hot_air",
+    "global_extension",
+)
 
-    # Hmmm can't filter using datetimes
-    selected = scmdata.ScmRun(
-        run.timeseries().loc[(run[cmp_col] == most_recent).tolist()]
-    )
 
-    if len(selected) != 1:
-        selected = scmdata.ScmRun(selected.timeseries().iloc[[0], :])
-        # Don't do this recursively
-        # return _get_latest(selected, cmp_col="last_provided_year")
+class PathwayDatabaseBackend(NetCDFDatabaseBackend):
+    """
+    netCDF backend which stores many pathways in each file
+
+    The default backend adds a dimension for every metadata column which varies
+    within a file. The pathways differ in several columns (e.g. ``pathway_num``
+    and ``last_country``), so that would write a mostly empty array with a
+    dimension per column. Instead, the timeseries are indexed by ``pathway_id``
+    and the other varying columns are written as extra coordinates.
+    """
+
+    def save(self, sr):
+        """
+        Save a ScmRun to the database, appending it to the existing file
+
+        Parameters
+        ----------
+        sr : :class:`scmdata.ScmRun`
+            Data to save
+
+        Returns
+        -------
+        str
+            Key where the data is saved
+        """
+        key = self.get_key(sr)
+
+        ensure_dir_exists(key)
+        if os.path.exists(key):
+            sr = scmdata.run_append([scmdata.ScmRun.from_nc(key), sr])
 
-    return selected
+        nunique = sr.meta.nunique()
+        extras = [
+            c for c in nunique[nunique > 1].index if c not in ("pathway_id", "variable")
+        ]
+        sr.to_nc(key, dimensions=["pathway_id"], extras=extras)
+
+        return key
+
+
+def get_buffered_database(root_dir):
+    """
+    Get a database of global pathways for ``NDCCruncher(buffer_writes=True)``
+
+    The pathways for each combination of options are stored in one file, so
+    the buffered pathways are written with one write per combination.
+
+    Parameters
+    ----------
+    root_dir : str
+        Root directory of the database
+
+    Returns
+    -------
+    :class:`scmdata.database.ScmDatabase`
+    """
+    return scmdata.database.ScmDatabase(
+        root_dir,
+        levels=BUFFERED_DATABASE_LEVELS,
+        backend=PathwayDatabaseBackend(
+            levels=BUFFERED_DATABASE_LEVELS, root_dir=root_dir
+        ),
+    )
 
 
 def get_older_than(run, dt, cmp_col="submission_date"):
@@ -40,11 +113,164 @@ def get_today(run, dt, cmp_col="submission_date"):
     return scmdata.ScmRun(run.timeseries().loc[(run[cmp_col] == dt).tolist()])
 
 
-def get_latest(run, unique_col="region"):
+def get_latest(run, unique_col="region", cmp_col="submission_date", tie_break=None):
     """
     return a single timeseries for each value in `unique_col`
+
+    The timeseries with the greatest value of ``cmp_col`` is selected. Ties are
+    broken by the greatest value of each of the ``tie_break`` columns in turn
+    and then by taking the first of the tied timeseries in ``run``. Any
+    remaining ties are logged.
+
+    The results are ordered by ``unique_col``.
     """
-    return run.groupby("region").map(_get_latest)
+    ts = run.timeseries()
+    meta = ts.index.to_frame(index=False)
+    meta["_position"] = np.arange(len(meta))
+
+    keys = [unique_col, cmp_col] + list(tie_break or [])
+    meta = meta.sort_values(
+        keys + ["_position"],
+        ascending=[True] + [False] * (len(keys) - 1) + [True],
+        kind="mergesort",
+    )
+
+    latest = ~meta.duplicated(unique_col)
+    tied = latest & meta.duplicated(keys, keep=False)
+    if tied.any():
+        logger.info(
+            "Multiple latest timeseries for {}, using the first".format(
+                meta.loc[tied, unique_col].tolist()
+            )
+        )
+
+    return scmdata.ScmRun(ts.iloc[meta.loc[latest, "_position"].values])
+
+
+class SubmissionIndex:
+    """
+    Index of the submissions made by each region
+
+    The submissions of each region are sorted by submission date so the latest
+    submission as of any date can be found using a binary search per region,
+    rather than masking the whole of the run. :class:`NDCCruncher` uses the
+    index to select the commitments active before, and made on, each
+    submission date.
+
+    Parameters
+    ----------
+    run : :class:`scmdata.ScmRun`
+        Submissions to index
+
+    cmp_col : str
+        Metadata column containing the submission date
+
+    unique_col : str
+        Metadata column identifying who made each submission
+    """
+
+    def __init__(self, run, cmp_col="submission_date", unique_col="region"):
+        self._ts = run.timeseries()
+
+        meta = self._ts.index.to_frame(index=False)
+        self._dates = {}
+        self._rows = {}
+        for region, region_meta in meta.groupby(unique_col, sort=True):
+            region_meta = region_meta.sort_values(cmp_col, kind="mergesort")
+            self._dates[region] = region_meta[cmp_col].tolist()
+            self._rows[region] = region_meta.index.values
+        self._rows_by_date = {
+            dt: date_meta.index.values for dt, date_meta in meta.groupby(cmp_col)
+        }
+
+    @property
+    def regions(self):
+        """
+        list[str]: Regions with at least one submission
+        """
+        return list(self._dates)
+
+    def latest_rows(self, dt=None, before=False):
+        """
+        Get the position of the latest submission of each region
+
+        Parameters
+        ----------
+        dt
+            Only consider submissions made on or before ``dt``. If None, all
+            submissions are considered
+
+        before : bool
+            If True, only consider submissions made before ``dt``
+
+        Returns
+        -------
+        :obj:`np.ndarray`
+            Row of the latest submission of each region, ordered by region.
+            Regions without a submission on or before ``dt`` are skipped. If a
+            region made multiple submissions on the same date, the first in
+            the run's timeseries is used
+        """
+        bisect_dt = bisect.bisect_left if before else bisect.bisect_right
+
+        rows = []
+        for region, dates in self._dates.items():
+            end = len(dates) if dt is None else bisect_dt(dates, dt)
+            if end:
+                start = bisect.bisect_left(dates, dates[end - 1], hi=end)
+                rows.append(self._rows[region][start])
+
+        return np.array(rows, dtype=int)
+
+    def as_of(self, dt=None, before=False):
+        """
+        Get the latest submission of each region as of a given date
+
+        The global emissions at ``dt`` can then be calculated using
+        :func:`sum_country_emissions`.
+
+        Parameters
+        ----------
+        dt
+            Only consider submissions made on or before ``dt``. If None, all
+            submissions are considered
+
+        before : bool
+            If True, only consider submissions made before ``dt``
+
+        Returns
+        -------
+        :class:`scmdata.ScmRun`
+            Latest submission of each region
+        """
+        return scmdata.ScmRun(self._ts.iloc[self.latest_rows(dt, before=before)])
+
+    def submitted_on(self, dt):
+        """
+        Get the submissions made on a given date
+
+        Returns
+        -------
+        :class:`scmdata.ScmRun`
+            Submissions made on ``dt`` in the order of the run's timeseries
+        """
+        rows = self._rows_by_date.get(dt, np.array([], dtype=int))
+        return scmdata.ScmRun(self._ts.iloc[rows])
+
+
+def _global_ndc_columns(conditionality, ambition, country_extension):
+    return {
+        "variable": "Emissions|Total GHG excl. LULUCF",
+        "unit": "Mt CO2/yr",
+        "region": "World",
+        "scenario": "HighNDC" if ambition == "high" else "LowNDC",
+        "model": "NDC Factsheet",
+        "conditionality": conditionality,
+        "ambition": ambition,
+        "country_extension": country_extension,
+        "pathway_id": "_".join([ambition, conditionality, country_extension]),
+        "global_extension": "N/A",
+    }
 
 
 def process_ndc(latest_ndcs, conditionality, ambition, country_extension):
@@ -56,54 +282,349 @@ def process_ndc(latest_ndcs, conditionality, ambition, country_extension):
     global_emms = scmdata.ScmRun(
         emms.values.sum(axis=0),
         index=emms["year"],
-        columns={
-            "variable": "Emissions|Total GHG excl. LULUCF",
-            "unit": "Mt CO2/yr",
-            "region": "World",
-            "scenario": "HighNDC" if ambition == "high" else "LowNDC",
-            "model": "NDC Factsheet",
-            "conditionality": conditionality,
-            "ambition": ambition,
-            "country_extension": country_extension,
-            "pathway_id": "_".join([ambition, conditionality, country_extension]),
-            "global_extension": "N/A",
-        },
+        columns=_global_ndc_columns(conditionality, ambition, country_extension),
     )
 
     return global_emms
 
 
+def process_all_ndcs(latest_ndcs):
+    """
+    Sum the NDCs for every combination of options at once
+
+    Equivalent to calling :func:`process_ndc` for each combination of
+    ``conditionality``, ``ambition`` and ``country_extension`` in
+    ``latest_ndcs``, but the totals are calculated with a single grouped sum
+    over the values.
+
+    Parameters
+    ----------
+    latest_ndcs : :class:`scmdata.ScmRun`
+        Latest NDC of each country for each combination of options
+
+    Returns
+    -------
+    :class:`scmdata.ScmRun`
+        Global emissions of each combination of options
+    """
+    keys = ["conditionality", "ambition", "country_extension"]
+    ts = latest_ndcs.timeseries(time_axis="year")
+    meta = ts.index.to_frame(index=False)[keys]
+
+    groups = meta.groupby(keys, sort=True).ngroup().values
+    in_group = groups >= 0
+    combinations = meta[in_group].drop_duplicates().sort_values(keys)
+
+    # NaNs propagate in the same way as in ``process_ndc``
+    totals = np.zeros((len(combinations), ts.shape[1]))
+    np.add.at(totals, groups[in_group], ts.values[in_group])
+
+    columns = [
+        _global_ndc_columns(*combination)
+        for combination in combinations.itertuples(index=False, name=None)
+    ]
+    return scmdata.ScmRun(
+        totals.T,
+        index=ts.columns.values,
+        columns={c: [col[c] for col in columns] for c in columns[0]},
+    )
+
+
+class _RunningTotal:
+    """
+    Sum over a changing set of rows
+
+    NaNs are counted rather than summed so that removing a row which contains
+    NaNs restores the total. The result therefore matches ``values.sum(axis=0)``
+    over the rows which are currently included.
+
+    ``shape`` can have leading dimensions in which case ``idx`` selects the
+    totals which a row is added to or removed from.
+    """
+
+    def __init__(self, shape):
+        self._sum = np.zeros(shape)
+        self._nans = np.zeros(shape, dtype=int)
+
+    def add(self, row, idx=slice(None)):
+        nans = np.isnan(row)
+        self._sum[idx] += np.where(nans, 0, row)
+        self._nans[idx] += nans
+
+    def remove(self, row, idx=slice(None)):
+        nans = np.isnan(row)
+        self._sum[idx] -= np.where(nans, 0, row)
+        self._nans[idx] -= nans
+
+    @property
+    def values(self):
+        return np.where(self._nans > 0, np.nan, self._sum)
+
+
+class BaselineRemainder:
+    """
+    Baseline emissions of the countries which are yet to submit
+
+    The sum over all the baseline regions is calculated once. As regions submit,
+    their baseline emissions are subtracted from the total so the remainder can
+    be updated in O(years) rather than filtering and summing the baseline
+    emissions for every pathway.
+
+    Parameters
+    ----------
+    baseline_emms : :class:`scmdata.ScmRun`
+        Baseline emissions for each region
+    """
+
+    def __init__(self, baseline_emms):
+        ts = baseline_emms.timeseries(time_axis="year")
+        regions = ts.index.get_level_values("region")
+
+        self.years = ts.columns.values
+        self._rows = {
+            r: ts.values[regions == r].sum(axis=0) for r in sorted(set(regions))
+        }
+        self._submitted = set()
+        self._total = _RunningTotal(len(self.years))
+        for row in self._rows.values():
+            self._total.add(row)
+
+    @property
+    def regions(self):
+        """
+        list[str]: Regions with baseline emissions
+        """
+        return list(self._rows)
+
+    @property
+    def missing(self):
+        """
+        list[str]: Regions with baseline emissions which have not submitted
+        """
+        return [r for r in self._rows if r not in self._submitted]
+
+    @property
+    def values(self):
+        """
+        :obj:`np.ndarray`: Sum of the baseline emissions of the missing regions
+        """
+        return self._total.values
+
+    def get(self, region):
+        """
+        Get the baseline emissions of a region
+        """
+        return self._rows[region]
+
+    def submit(self, region):
+        """
+        Remove a region's baseline emissions from the remainder
+
+        Regions without baseline emissions or which have already submitted are
+        ignored.
+        """
+        if region in self._rows and region not in self._submitted:
+            self._total.remove(self._rows[region])
+            self._submitted.add(region)
+
+    def withdraw(self, region):
+        """
+        Add a region's baseline emissions back into the remainder
+        """
+        if region in self._submitted:
+            self._total.add(self._rows[region])
+            self._submitted.remove(region)
+
+    def update(self, submitted_regions):
+        """
+        Set the regions which have submitted
+
+        Only the regions which have changed since the previous update are added
+        to or removed from the remainder.
+        """
+        submitted_regions = set(submitted_regions)
+        for r in submitted_regions - self._submitted:
+            self.submit(r)
+        for r in self._submitted - submitted_regions:
+            self.withdraw(r)
+
+    def copy(self):
+        """
+        Copy the remainder, including which regions have submitted
+        """
+        return copy.deepcopy(self)
+
+
 def sum_country_emissions(submitted_ndcs, baseline_emms):
+    """
+    Sum the submitted NDCs and the baseline emissions of the remaining countries
+
+    Parameters
+    ----------
+    submitted_ndcs : :class:`scmdata.ScmRun`
+        Selected NDC for each country which has submitted
+
+    baseline_emms : :class:`scmdata.ScmRun` or :class:`BaselineRemainder`
+        Baseline emissions used for the countries which have not submitted.
+        Reusing a :class:`BaselineRemainder` between calls avoids re-summing the
+        baseline emissions each time.
+
+    Returns
+    -------
+    :class:`scmdata.ScmRun`, dict, list[str]
+        Global emissions, submission date of each submitted country and the
+        countries which have not submitted
+    """
     submitted_countries = submitted_ndcs.get_unique_meta("region")
     submitted_countries = {
         k: submitted_ndcs.filter(region=k).get_unique_meta("submission_date", True)
         for k in submitted_countries
     }
 
-    missing_countries = set(baseline_emms.get_unique_meta("region")) - set(
-        submitted_countries.keys()
-    )
-    missing_countries_emms = baseline_emms.filter(
-        region=missing_countries, log_if_empty=False
-    )
+    if not isinstance(baseline_emms, BaselineRemainder):
+        baseline_emms = BaselineRemainder(baseline_emms)
+    baseline_emms.update(submitted_countries.keys())
 
     columns = {"variable": "Emissions|Total GHG excl. LULUCF", "region": "World"}
     for c in ["ambition", "country_extension", "conditionality", "model", "unit"]:
         columns[c] = submitted_ndcs.get_unique_meta(c, True)
     columns["scenario"] = "__".join([columns["ambition"], columns["conditionality"]])
 
-    sum_emissions = submitted_ndcs.values.sum(
-        axis=0
-    ) + missing_countries_emms.values.sum(axis=0)
+    sum_emissions = submitted_ndcs.values.sum(axis=0) + baseline_emms.values
 
     return (
         scmdata.ScmRun(sum_emissions, columns=columns, index=submitted_ndcs["year"]),
         submitted_countries,
-        list(missing_countries),
+        baseline_emms.missing,
     )
 
 
+_SCENARIO_NAME_COLUMNS = [
+    "pathway_id",
+    "ambition",
+    "conditionality",
+    "country_extension",
+    "exclude_hot_air",
+]
+
+
+def _option_suffix(option):
+    return "__".join(str(o) for o in option)
+
+
+def _get_scenario_name(meta):
+    return "__".join([meta[c] for c in _SCENARIO_NAME_COLUMNS])
+
+
+def _dump_selected_countries(pathway_meta):
+    fname = selected_countries_fname(
+        GLOBAL_DATABASE_META_DIR,
+        pathway_meta["ambition"],
+        pathway_meta["conditionality"],
+        pathway_meta["pathway_id"],
+        pathway_meta["country_extension"],
+    )
+    ensure_dir_exists(fname)
+    with open(fname, "w") as fh:
+        json.dump(pathway_meta, fh)
+
+    return os.path.getsize(fname)
+
+
+def _saved_bytes(output_db, run):
+    """
+    Get the size of the file of ``output_db`` which ``run`` was saved to
+
+    The netCDF backend rewrites the whole file when it appends to it, so this is
+    the number of bytes written by the save. Returns 0 if ``output_db`` does not
+    store its runs in files.
+    """
+    try:
+        fname = output_db._backend.get_key(run)
+    except AttributeError:
+        return 0
+
+    return os.path.getsize(fname)
+
+
+def _group_by_levels(runs, levels):
+    """
+    Group runs by the values of ``levels``
+
+    Each group is saved to the same file of a
+    :class:`scmdata.database.ScmDatabase` with ``levels``, so saving the runs of a
+    group together writes the file once.
+    """
+    groups = {}
+    for run in runs:
+        meta = run.meta
+        key = tuple(tuple(meta[level].unique()) for level in levels)
+        groups.setdefault(key, []).append(run)
+
+    return list(groups.values())
+
+
 class NDCCruncher:
+    """
+    Produce global pathways by incrementally selecting each submitted NDC
+
+    Parameters
+    ----------
+    output_db : :class:`scmdata.database.ScmDatabase`
+        Database to save the global pathways to
+
+    country_emms : :class:`scmdata.ScmRun`
+        Emissions of each submitted NDC
+
+    baseline_emms : :class:`scmdata.ScmRun`
+        Baseline emissions used for the countries which have not submitted
+
+    conditionality, ambition, country_extension, exclude_hot_air : str
+        Options used to select the NDCs from ``country_emms``
+
+    buffer_writes : bool
+        If True, pathways are collected in memory and written to ``output_db``
+        in bulk rather than one at a time. The buffered pathways which belong
+        in the same file of ``output_db`` are saved together, so each file is
+        only written once per flush. ``pathway_id`` must not be one of the
+        levels of ``output_db`` so that the pathways share files, see
+        :func:`get_buffered_database`. The buffer is written when :meth:`flush`
+        is called and at the end of :meth:`crunch`.
+
+    flush_every : int
+        If ``buffer_writes`` is True, also write the buffer after every
+        ``flush_every`` pathways. If None, the buffer is only written when
+        :meth:`flush` is called or :meth:`crunch` finishes.
+
+    meta_store : :class:`ndcs.pathway_meta.PathwayMetaStore`
+        Store for the metadata of each pathway. If None, the metadata is written
+        to a ``selected_countries.json`` file per pathway in
+        :data:`GLOBAL_DATABASE_META_DIR`
+
+    checkpoint : str
+        File to store the state of the cruncher in after each submission date
+        has been processed. If the file already exists, :meth:`crunch` resumes
+        from the last processed date and only the newer submission dates are
+        crunched. The pathways produced by the earlier run must still be in
+        ``output_db`` and the baseline emissions must be unchanged. If None, no
+        checkpoint is kept.
+
+    contribution_store : :class:`ndcs.contributions.ContributionStore`
+        Store for the change in global emissions caused by the ``last_country``
+        of each pathway, i.e. its new commitment minus the commitment or
+        baseline emissions which it replaces. The contributions are written
+        whenever the pathways are. If None, the contributions are not
+        calculated.
+
+    profile : bool or str
+        If True, time the phases of :meth:`crunch` and count the pathways and
+        the bytes of the pathway, metadata and checkpoint files written. The
+        report is logged at the end of :meth:`crunch` and is available as
+        :attr:`profile_report`. If a string, the report is also written to that
+        file as JSON. If None, the ``NDCS_PROFILE`` environment variable is
+        used, see :func:`ndcs.profiling.get_profiler`.
+    """
+
     def __init__(
         self,
         output_db,
@@ -113,13 +634,39 @@ class NDCCruncher:
         ambition,
         country_extension,
         exclude_hot_air,
+        buffer_writes=False,
+        flush_every=None,
+        meta_store=None,
+        checkpoint=None,
+        contribution_store=None,
+        profile=None,
     ):
         self.conditionality = conditionality
         self.ambition = ambition
         self.country_extension = country_extension
         self.exclude_hot_air = exclude_hot_air
         self.baseline_emms = baseline_emms
+        self.baseline_remainder = BaselineRemainder(baseline_emms)
         self.output_db = output_db
+        if buffer_writes and "pathway_id" in getattr(output_db, "levels", ()):
+            raise ValueError(
+                "Each pathway is saved to its own file when `pathway_id` is a level "
+                "of `output_db`, so `buffer_writes` would not reduce the number of "
+                "files written. Use a database without the `pathway_id` level, "
+                "e.g. from `get_buffered_database`"
+            )
+        self.buffer_writes = buffer_writes
+        self.flush_every = flush_every
+        self.meta_store = meta_store
+        self._buffer = []
+        self._meta_buffer = []
+        self.checkpoint = checkpoint
+        self._pending_checkpoint = None
+        self.contribution_store = contribution_store
+        self._contribution_buffer = []
+        self.profile = profile
+        self.profiler = NullProfiler()
+        self.profile_report = None
 
         self.emms = country_emms.filter(
             conditionality=conditionality,
@@ -127,27 +674,201 @@ class NDCCruncher:
             country_extension=country_extension,
             exclude_hot_air=exclude_hot_air,
         )
+        self.submissions = SubmissionIndex(self.emms)
         self.previous_step = None
         self.count = 1
 
     def crunch(self):
+        self.profiler = get_profiler(self.profile, suffix=_option_suffix(self.options))
         unique_submission_dts = sorted(self.emms.get_unique_meta("submission_date"))
         logger.info(
             "Found {} unique submission dates from {} submissions".format(
                 unique_submission_dts, len(self.emms)
             )
         )
-        for dt in tqdm(unique_submission_dts):
-            logger.info("Processing {}".format(str(dt)))
-            self.process_day(dt, self.emms)
+        if self.checkpoint is not None and os.path.exists(self.checkpoint):
+            last_dt = self._load_checkpoint()
+            unique_submission_dts = [d for d in unique_submission_dts if d > last_dt]
+            logger.info(
+                "Resuming after {}, {} submission dates remaining".format(
+                    str(last_dt), len(unique_submission_dts)
+                )
+            )
+
+        try:
+            for dt in tqdm(unique_submission_dts):
+                logger.info("Processing {}".format(str(dt)))
+                self.process_day(dt, self.emms)
+
+                if self.checkpoint is not None:
+                    with self.profiler.time("checkpoint"):
+                        self._pending_checkpoint = self._get_checkpoint(dt)
+                    if not self.buffer_writes:
+                        self._write_contributions()
+                        self._write_checkpoint()
+        finally:
+            self.flush()
+            self.profile_report = self.profiler.emit(
+                cruncher=type(self).__name__,
+                options=dict(zip(OPTION_COLUMNS, self.options)),
+            )
+
+    @property
+    def options(self):
+        """
+        tuple[str]: Options used to select the NDCs, in the order of
+        :data:`OPTION_COLUMNS`
+        """
+        return (
+            self.conditionality,
+            self.ambition,
+            self.country_extension,
+            self.exclude_hot_air,
+        )
+
+    def iter_pathways(self):
+        """
+        Iterate over the global pathways without saving them
+
+        The pathways are the same as those written by :meth:`crunch`, but are
+        yielded as they are computed rather than written to :attr:`output_db`
+        and :attr:`meta_store`. Only the current state of the cruncher is kept
+        in memory so this can be used to pass the pathways straight to later
+        processing steps.
+
+        All the submission dates are crunched, the checkpoint is not used.
+
+        Yields
+        ------
+        :class:`scmdata.ScmRun`, dict
+            Global pathway and its metadata in the same format as
+            ``selected_countries.json``
+        """
+        self.previous_step = None
+        self.count = 1
+        for dt in sorted(self.emms.get_unique_meta("submission_date")):
+            for _, global_emms, pathway_meta, _ in self._iter_day(dt, self.emms):
+                yield global_emms, pathway_meta
+
+    def flush(self):
+        """
+        Write any buffered pathways to :attr:`output_db` and :attr:`meta_store`
+
+        The contributions are always buffered and are also written. If a
+        checkpoint is being kept, it is updated once the buffered pathways
+        have been written.
+        """
+        if self._buffer:
+            logger.info("Writing {} buffered pathways".format(len(self._buffer)))
+            with self.profiler.time("save"):
+                for group in _group_by_levels(self._buffer, self.output_db.levels):
+                    self._save(scmdata.run_append(group))
+            self._buffer = []
+
+        if self._meta_buffer:
+            with self.profiler.time("meta"):
+                self.meta_store.add_many(self._meta_buffer)
+            self._meta_buffer = []
+
+        self._write_contributions()
+        self._write_checkpoint()
+
+    def _save(self, run):
+        self.output_db.save(run, disable_tqdm=True)
+        if self.profiler.enabled:
+            self.profiler.count("pathway_bytes", _saved_bytes(self.output_db, run))
+
+    def _write_contributions(self):
+        if self._contribution_buffer:
+            with self.profiler.time("contributions"):
+                self.contribution_store.add_many(self._contribution_buffer)
+            self._contribution_buffer = []
+
+    def _processed_submissions(self, last_dt):
+        meta = self.emms.meta
+        meta = meta[(meta["submission_date"] <= last_dt).tolist()]
+        return set(zip(meta["region"], meta["submission_date"].astype(str)))
+
+    def _get_checkpoint(self, last_dt):
+        # Pickle straight away as the state may be modified by later dates
+        return pickle.dumps(
+            {
+                "cruncher": type(self).__name__,
+                "options": (
+                    self.conditionality,
+                    self.ambition,
+                    self.country_extension,
+                    self.exclude_hot_air,
+                ),
+                "last_dt": last_dt,
+                "count": self.count,
+                "previous_step": self.previous_step,
+                "submissions": self._processed_submissions(last_dt),
+            }
+        )
+
+    def _write_checkpoint(self):
+        if self._pending_checkpoint is None:
+            return
+
+        with self.profiler.time("checkpoint"):
+            ensure_dir_exists(self.checkpoint)
+            tmp_fname = self.checkpoint + ".tmp"
+            with open(tmp_fname, "wb") as fh:
+                fh.write(self._pending_checkpoint)
+            os.replace(tmp_fname, self.checkpoint)
+        self.profiler.count("checkpoint_bytes", os.path.getsize(self.checkpoint))
+        self._pending_checkpoint = None
+
+    def _load_checkpoint(self):
+        with open(self.checkpoint, "rb") as fh:
+            checkpoint = pickle.load(fh)
+
+        options = (
+            self.conditionality,
+            self.ambition,
+            self.country_extension,
+            self.exclude_hot_air,
+        )
+        if checkpoint["cruncher"] != type(self).__name__:
+            raise ValueError(
+                "Checkpoint was created by {}".format(checkpoint["cruncher"])
+            )
+        if checkpoint["options"] != options:
+            raise ValueError(
+                "Checkpoint was created for {}".format(checkpoint["options"])
+            )
+
+        last_dt = checkpoint["last_dt"]
+        if self._processed_submissions(last_dt) != checkpoint["submissions"]:
+            raise ValueError(
+                "Submissions made on or before {} have changed since the checkpoint "
+                "was created. Remove {} to crunch all the submissions".format(
+                    str(last_dt), self.checkpoint
+                )
+            )
+
+        self.previous_step = checkpoint["previous_step"]
+        self.count = checkpoint["count"]
+        return last_dt
 
     def process_day(self, dt, emms):
+        for pathway in self._iter_day(dt, emms):
+            self._save_pathway(*pathway)
+
+    def _iter_day(self, dt, emms):
         commitments_prev = self.previous_step
-        if commitments_prev is None:
-            commitments_prev = get_older_than(emms, dt)
-            commitments_prev = get_latest(commitments_prev) or commitments_prev
+        with self.profiler.time("select"):
+            submissions = self.submissions
+            if emms is not self.emms:
+                submissions = SubmissionIndex(emms)
+
+            if commitments_prev is None:
+                commitments_prev = submissions.as_of(dt, before=True)
 
-        commitments_today = get_today(emms, dt).timeseries().sort_index(level="region")
+            commitments_today = (
+                submissions.submitted_on(dt).timeseries().sort_index(level="region")
+            )
 
         commitments_selected = commitments_prev
 
@@ -156,76 +877,737 @@ class NDCCruncher:
             to_add = scmdata.ScmRun(commitments_today.iloc[[i]])
             last_country = to_add.get_unique_meta("region", True)
 
+            contribution = None
+            if self.contribution_store is not None:
+                with self.profiler.time("contribution"):
+                    contribution = self._get_contribution(
+                        to_add,
+                        commitments_prev.filter(
+                            region=last_country, log_if_empty=False
+                        ),
+                    )
+
             # Merge the selected commitments from today with the previous commitment
-            commitments_selected = scmdata.run_append(
-                [
-                    commitments_prev.filter(
-                        region=last_country, keep=False, log_if_empty=False
-                    ),
-                    to_add,
-                ]
+            with self.profiler.time("select"):
+                commitments_selected = scmdata.run_append(
+                    [
+                        commitments_prev.filter(
+                            region=last_country, keep=False, log_if_empty=False
+                        ),
+                        to_add,
+                    ]
+                )
+            yield self._process_selected_ndcs(
+                dt, i, commitments_selected, last_country, contribution
             )
-            self._process_selected_ndcs(dt, i, commitments_selected, last_country)
 
             commitments_prev = commitments_selected
         self.previous_step = commitments_selected
 
-    def _process_selected_ndcs(self, dt, i, commitments_selected, last_country):
+    def _get_contribution(self, to_add, replaced):
+        new = to_add.timeseries(time_axis="year").iloc[0]
+        region = to_add.get_unique_meta("region", True)
+        if len(replaced):
+            old = replaced.timeseries(time_axis="year").iloc[0]
+        elif region in self.baseline_remainder.regions:
+            old = pd.Series(
+                self.baseline_remainder.get(region),
+                index=self.baseline_remainder.years,
+            )
+        else:
+            old = 0
+
+        return new - old
+
+    def _process_selected_ndcs(
+        self, dt, i, commitments_selected, last_country, contribution=None
+    ):
         number_of_countries = len(commitments_selected.get_unique_meta("region"))
         assert len(commitments_selected) == number_of_countries  # Sanity check
 
         # Sum country emissions
-        global_emms, selected_countries, missing_countries = sum_country_emissions(
-            commitments_selected, self.baseline_emms
+        with self.profiler.time("sum"):
+            global_emms, selected_countries, missing_countries = sum_country_emissions(
+                commitments_selected, self.baseline_remainder
+            )
+        return self._make_pathway(
+            dt,
+            i,
+            global_emms,
+            selected_countries,
+            missing_countries,
+            last_country,
+            contribution,
         )
 
-        # Unique id for the pathway
-        pathway_id = "{}_{}".format(str(dt), i + 1)
+    def _make_pathway(
+        self,
+        dt,
+        i,
+        global_emms,
+        selected_countries,
+        missing_countries,
+        last_country,
+        contribution=None,
+    ):
+        with self.profiler.time("build"):
+            # Unique id for the pathway
+            pathway_id = "{}_{}".format(str(dt), i + 1)
+
+            # Dump emissions to database
+            global_emms["last_country"] = last_country
+            global_emms["pathway_id"] = pathway_id
+            global_emms["pathway_num_today"] = i + 1
+            global_emms["pathway_num"] = self.count
+            global_emms["date"] = str(dt)
+            global_emms["global_extension"] = "n/a"
+            global_emms["exclude_hot_air"] = self.exclude_hot_air
+
+            # Create a unique_scenario_name
+            global_emms["scenario"] = _get_scenario_name(
+                {
+                    c: global_emms.get_unique_meta(c, True)
+                    for c in _SCENARIO_NAME_COLUMNS
+                }
+            )
+
+            pathway_meta = {
+                "selected": {k: str(v) for k, v in selected_countries.items()},
+                "missing": missing_countries,
+                "last_country": last_country,
+                "pathway_num": self.count,
+                "pathway_id": pathway_id,
+                "conditionality": self.conditionality,
+                "country_extension": self.country_extension,
+                "exclude_hot_air": self.exclude_hot_air,
+                "ambition": self.ambition,
+            }
+        self.count += 1
+
+        return dt, global_emms, pathway_meta, contribution
+
+    def _save_pathway(self, dt, global_emms, pathway_meta, contribution=None):
+        self.profiler.count("pathways")
+        if self.buffer_writes:
+            self._buffer.append(global_emms)
+            if self.meta_store is not None:
+                self._meta_buffer.append(dict(pathway_meta, date=str(dt)))
+        else:
+            with self.profiler.time("save"):
+                self._save(global_emms)
+            if self.meta_store is not None:
+                with self.profiler.time("meta"):
+                    self.meta_store.add(dict(pathway_meta, date=str(dt)))
+
+        if self.meta_store is None:
+            with self.profiler.time("meta"):
+                meta_bytes = _dump_selected_countries(pathway_meta)
+            self.profiler.count("meta_bytes", meta_bytes)
+
+        if contribution is not None:
+            self._contribution_buffer.append(
+                dict(
+                    pathway_meta,
+                    date=str(dt),
+                    unit=global_emms.get_unique_meta("unit", True),
+                    contribution=contribution,
+                )
+            )
+
+        if (
+            self.buffer_writes
+            and self.flush_every
+            and len(self._buffer) >= self.flush_every
+        ):
+            self.flush()
+
+
+def _processing_order(index):
+    """
+    Get the order in which :class:`NDCCruncher` processes submissions
+
+    The submissions are processed by submission date and, on each date, in the
+    order given by sorting the timeseries index by region (and then by the
+    remaining metadata). A region which submits more than once on the same date
+    ends with the last of its submissions in this order.
+
+    Parameters
+    ----------
+    index : :class:`pandas.MultiIndex`
+        Index of the timeseries of the submissions
+
+    Returns
+    -------
+    :obj:`np.ndarray`
+        Positions of the timeseries in processing order
+    """
+    positions = pd.Series(np.arange(len(index)), index=index)
+
+    return positions.sort_index(level=["submission_date", "region"]).values
+
+
+class _CommitmentState:
+    """
+    Currently active commitments held as a dense regions x years matrix
+
+    Alongside the matrix a running total of the active commitments is kept. The
+    baseline emissions of the regions which have not yet submitted are tracked
+    by a :class:`BaselineRemainder`.
+    """
+
+    def __init__(self, regions, baseline, n_years):
+        self.regions = list(regions)
+        self.index = {r: i for i, r in enumerate(self.regions)}
+        self.active = np.full((len(self.regions), n_years), np.nan)
+        self.selected = {}
+        self.baseline = baseline
+        self.total = _RunningTotal(n_years)
+
+    def submit(self, region, values, submission_date):
+        if region not in self.index:
+            # A region which was not known when the state was created, e.g. when
+            # resuming from a checkpoint
+            self.index[region] = len(self.regions)
+            self.regions.append(region)
+            self.active = np.vstack([self.active, np.full_like(values, np.nan)])
+
+        i = self.index[region]
+        if region in self.selected:
+            self.total.remove(self.active[i])
+        self.baseline.submit(region)
+
+        self.active[i] = values
+        self.total.add(values)
+        self.selected[region] = submission_date
+
+    def get(self, region):
+        """
+        Get the commitment, or otherwise the baseline emissions, of a region
+        """
+        if region in self.selected:
+            return self.active[self.index[region]].copy()
+        if region in self.baseline.regions:
+            return self.baseline.get(region)
+        return np.zeros(self.active.shape[1])
+
+    @property
+    def values(self):
+        return self.total.values + self.baseline.values
+
+    @property
+    def missing(self):
+        return self.baseline.missing
+
+
+class ArrayNDCCruncher(NDCCruncher):
+    """
+    Cruncher which tracks the selected NDCs using arrays
+
+    Produces the same pathways and metadata as :class:`NDCCruncher`. Rather than
+    building and summing a new :class:`scmdata.ScmRun` for every submission, the
+    currently active commitments are kept as a dense regions x years matrix
+    together with a running global total. Each submission then only subtracts the
+    commitment (or baseline) it replaces and adds the new commitment.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(ArrayNDCCruncher, self).__init__(*args, **kwargs)
+
+        ts = self.emms.timeseries(time_axis="year")
+        meta = ts.index.to_frame(index=False)
+        self._years = ts.columns.values
+        self._values = ts.values
+        self._regions = meta["region"].values
+        self._dates = meta["submission_date"].values
+        self._rows_by_date = {}
+        for row in _processing_order(ts.index):
+            self._rows_by_date.setdefault(self._dates[row], []).append(row)
+
+        if not np.array_equal(self.baseline_remainder.years, self._years):
+            raise ValueError(
+                "Baseline and country emissions must be defined for the same years"
+            )
+
+        self._columns = {
+            "variable": "Emissions|Total GHG excl. LULUCF",
+            "region": "World",
+        }
+        for c in ["ambition", "country_extension", "conditionality", "model", "unit"]:
+            self._columns[c] = self.emms.get_unique_meta(c, True)
+        self._columns["scenario"] = "__".join(
+            [self._columns["ambition"], self._columns["conditionality"]]
+        )
+
+    def _new_state(self):
+        regions = sorted(set(self._regions) | set(self.baseline_remainder.regions))
+        return _CommitmentState(
+            regions, self.baseline_remainder.copy(), len(self._years)
+        )
+
+    def _iter_day(self, dt, emms):
+        """
+        Produce the pathways for the submissions made on a given date
+
+        The submissions are read from the arrays prepared from :attr:`emms` when
+        the cruncher was created, ``emms`` is only kept for compatibility with
+        :meth:`NDCCruncher.process_day`.
+        """
+        state = self.previous_step
+        if state is None:
+            # Start from the latest commitment of each country prior to ``dt``
+            state = self._new_state()
+            for prev_dt in sorted(d for d in self._rows_by_date if d < dt):
+                for row in self._rows_by_date[prev_dt]:
+                    state.submit(self._regions[row], self._values[row], prev_dt)
+
+        for i, row in enumerate(self._rows_by_date.get(dt, [])):
+            last_country = self._regions[row]
+            contribution = None
+            if self.contribution_store is not None:
+                with self.profiler.time("contribution"):
+                    contribution = pd.Series(
+                        self._values[row] - state.get(last_country),
+                        index=self._years,
+                    )
+            with self.profiler.time("select"):
+                state.submit(last_country, self._values[row], dt)
+
+            with self.profiler.time("sum"):
+                global_emms = scmdata.ScmRun(
+                    state.values, index=self._years, columns=self._columns.copy()
+                )
+            selected_countries = {r: state.selected[r] for r in sorted(state.selected)}
+            yield self._make_pathway(
+                dt,
+                i,
+                global_emms,
+                selected_countries,
+                state.missing,
+                last_country,
+                contribution,
+            )
+
+        self.previous_step = state
+
+
+class MultiNDCCruncher:
+    """
+    Crunch many combinations of options in a single pass over the submissions
+
+    All the combinations share the same submission timeline. Rather than walking
+    it separately for each combination, the active commitments of every
+    combination are kept in a combinations x regions x years array which is
+    advanced for all the combinations which have a submission at the same time.
+    The pathways for all the combinations are written at the end of
+    :meth:`crunch`.
+
+    The pathways and metadata are the same as those produced by running
+    :class:`NDCCruncher` for each combination.
 
-        # Dump emissions to database
-        global_emms["last_country"] = last_country
-        global_emms["pathway_id"] = pathway_id
-        global_emms["pathway_num_today"] = i + 1
-        global_emms["pathway_num"] = self.count
-        global_emms["date"] = str(dt)
-        global_emms["global_extension"] = "n/a"
-        global_emms["exclude_hot_air"] = self.exclude_hot_air
-
-        # Create a unique_scenario_name
-        uniq_vars = [
-            "pathway_id",
-            "ambition",
-            "conditionality",
-            "country_extension",
-            "exclude_hot_air",
+    Parameters
+    ----------
+    output_db : :class:`scmdata.database.ScmDatabase`
+        Database to save the global pathways to
+
+    country_emms : :class:`scmdata.ScmRun`
+        Emissions of each submitted NDC
+
+    baseline_emms : :class:`scmdata.ScmRun`
+        Baseline emissions used for the countries which have not submitted
+
+    options : list[tuple[str, str, str, str]]
+        Combinations of (``conditionality``, ``ambition``, ``country_extension``,
+        ``exclude_hot_air``) to crunch. If None, every combination which occurs
+        in ``country_emms`` is crunched
+
+    meta_store : :class:`ndcs.pathway_meta.PathwayMetaStore`
+        Store for the metadata of each pathway. If None, the metadata is written
+        to a ``selected_countries.json`` file per pathway in
+        :data:`GLOBAL_DATABASE_META_DIR`
+    """
+
+    def __init__(
+        self, output_db, country_emms, baseline_emms, options=None, meta_store=None
+    ):
+        self.output_db = output_db
+        self.meta_store = meta_store
+        self.baseline_remainder = BaselineRemainder(baseline_emms)
+
+        ts = country_emms.timeseries(time_axis="year")
+        meta = ts.index.to_frame(index=False)
+        self._years = ts.columns.values
+        self._values = ts.values
+        if not np.array_equal(self.baseline_remainder.years, self._years):
+            raise ValueError(
+                "Baseline and country emissions must be defined for the same years"
+            )
+
+        if options is None:
+            options = (
+                meta[list(OPTION_COLUMNS)]
+                .drop_duplicates()
+                .sort_values(list(OPTION_COLUMNS))
+                .itertuples(index=False, name=None)
+            )
+        self.options = [tuple(o) for o in options]
+
+        meta["_option"] = -1
+        for k, option in enumerate(self.options):
+            in_option = np.ones(len(meta), dtype=bool)
+            for c, v in zip(OPTION_COLUMNS, option):
+                in_option &= (meta[c] == v).values
+            meta.loc[in_option, "_option"] = k
+        meta = meta[meta["_option"] >= 0]
+
+        self._columns = []
+        for k, option in enumerate(self.options):
+            option_meta = meta[meta["_option"] == k]
+            columns = dict(zip(OPTION_COLUMNS, option))
+            for c in ["model", "unit"]:
+                values = option_meta[c].unique()
+                if len(values) != 1:
+                    raise ValueError(
+                        "`{}` is not unique for {} (found values: {})".format(
+                            c, option, list(values)
+                        )
+                    )
+                columns[c] = values[0]
+            self._columns.append(columns)
+
+        self._regions = sorted(
+            set(meta["region"]) | set(self.baseline_remainder.regions)
+        )
+        region_index = {r: j for j, r in enumerate(self._regions)}
+        self._baseline_regions = [
+            (r, region_index[r]) for r in self.baseline_remainder.regions
         ]
-        scenario = "__".join([global_emms.get_unique_meta(c, True) for c in uniq_vars])
-        global_emms["scenario"] = scenario
-        self.output_db.save(global_emms)
 
-        # Dump selected countries to json
-        fname = os.path.join(
-            GLOBAL_DATABASE_META_DIR,
-            self.ambition,
-            self.conditionality,
-            pathway_id,
-            self.country_extension,
-            "selected_countries.json",
+        # Each event is a submission by a region on a date. The rows for each
+        # option are ordered in the same way as NDCCruncher processes them
+        order = _processing_order(ts.index)
+        meta = meta.loc[order[np.isin(order, meta.index)]]
+        meta["_occurrence"] = meta.groupby(
+            ["_option", "submission_date", "region"]
+        ).cumcount()
+        event_keys = ["submission_date", "region", "_occurrence"]
+        events = meta[event_keys].drop_duplicates().reset_index(drop=True)
+        event_index = (
+            meta[event_keys]
+            .merge(events.reset_index(), on=event_keys, how="left")["index"]
+            .values
         )
-        ensure_dir_exists(fname)
-        with open(fname, "w") as fh:
-            json.dump(
-                {
-                    "selected": {k: str(v) for k, v in selected_countries.items()},
-                    "missing": missing_countries,
-                    "last_country": last_country,
-                    "pathway_num": self.count,
-                    "pathway_id": pathway_id,
-                    "conditionality": self.conditionality,
-                    "country_extension": self.country_extension,
-                    "exclude_hot_air": self.exclude_hot_air,
-                    "ambition": self.ambition,
+
+        self._event_dates = events["submission_date"].tolist()
+        self._event_regions = [region_index[r] for r in events["region"]]
+        self._event_rows = np.full((len(events), len(self.options)), -1)
+        self._event_rows[event_index, meta["_option"].values] = meta.index.values
+
+        self._pathway_values = []
+        self._pathway_columns = []
+        self._pathway_meta = []
+
+    def crunch(self):
+        n_options = len(self.options)
+        n_regions = len(self._regions)
+        n_years = len(self._years)
+
+        active = np.full((n_options, n_regions, n_years), np.nan)
+        selected = np.zeros((n_options, n_regions), dtype=bool)
+        selected_dates = np.empty((n_options, n_regions), dtype=object)
+        total = _RunningTotal((n_options, n_years))
+        remainder = _RunningTotal((n_options, n_years))
+        baseline_rows = {}
+        for r, j in self._baseline_regions:
+            baseline_rows[j] = self.baseline_remainder.get(r)
+            remainder.add(baseline_rows[j])
+
+        counts = np.ones(n_options, dtype=int)
+        today = np.zeros(n_options, dtype=int)
+        previous_dt = None
+        for dt, j, rows in tqdm(
+            zip(self._event_dates, self._event_regions, self._event_rows),
+            total=len(self._event_dates),
+        ):
+            if dt != previous_dt:
+                today[:] = 0
+                previous_dt = dt
+
+            submitted = rows >= 0
+            replaced = submitted & selected[:, j]
+            total.remove(active[replaced, j], replaced)
+            if j in baseline_rows:
+                remainder.remove(baseline_rows[j], submitted & ~selected[:, j])
+
+            active[submitted, j] = self._values[rows[submitted]]
+            total.add(active[submitted, j], submitted)
+            selected[submitted, j] = True
+            selected_dates[submitted, j] = dt
+
+            global_emms = total.values + remainder.values
+            for k in np.flatnonzero(submitted):
+                self._add_pathway(
+                    k,
+                    dt,
+                    today[k],
+                    counts[k],
+                    j,
+                    global_emms[k],
+                    selected[k],
+                    selected_dates[k],
+                )
+            today[submitted] += 1
+            counts[submitted] += 1
+
+        self.flush()
+
+    def _add_pathway(
+        self, k, dt, i, count, last_region, values, selected, selected_dates
+    ):
+        last_country = self._regions[last_region]
+        pathway_id = "{}_{}".format(str(dt), i + 1)
+
+        columns = dict(
+            self._columns[k],
+            variable="Emissions|Total GHG excl. LULUCF",
+            region="World",
+            last_country=last_country,
+            pathway_id=pathway_id,
+            pathway_num_today=int(i + 1),
+            pathway_num=int(count),
+            date=str(dt),
+            global_extension="n/a",
+        )
+        columns["scenario"] = _get_scenario_name(columns)
+        self._pathway_values.append(values)
+        self._pathway_columns.append(columns)
+
+        self._pathway_meta.append(
+            {
+                "selected": {
+                    self._regions[j]: str(selected_dates[j])
+                    for j in np.flatnonzero(selected)
                 },
-                fh,
+                "missing": [r for r, j in self._baseline_regions if not selected[j]],
+                "last_country": last_country,
+                "pathway_num": int(count),
+                "pathway_id": pathway_id,
+                "conditionality": columns["conditionality"],
+                "country_extension": columns["country_extension"],
+                "exclude_hot_air": columns["exclude_hot_air"],
+                "ambition": columns["ambition"],
+            }
+        )
+
+    def flush(self):
+        """
+        Write the crunched pathways to :attr:`output_db` and their metadata
+        """
+        if self._pathway_values:
+            logger.info("Writing {} pathways".format(len(self._pathway_values)))
+            self.output_db.save(
+                scmdata.ScmRun(
+                    np.array(self._pathway_values).T,
+                    index=self._years,
+                    columns={
+                        c: [p[c] for p in self._pathway_columns]
+                        for c in self._pathway_columns[0]
+                    },
+                )
             )
-        self.count += 1
+
+        if self.meta_store is not None:
+            self.meta_store.add_many(
+                [
+                    dict(m, date=c["date"])
+                    for m, c in zip(self._pathway_meta, self._pathway_columns)
+                ]
+            )
+        else:
+            for m in self._pathway_meta:
+                _dump_selected_countries(m)
+
+        self._pathway_values = []
+        self._pathway_columns = []
+        self._pathway_meta = []
+
+
+class _SharedRun:
+    """
+    Handle to timeseries whose values are stored in shared memory
+
+    Only the handle (the name of the shared memory block, the metadata and the
+    rows of interest) is pickled when it is sent to another process. When the
+    run is loaded, the selected rows (or all the values if no rows were
+    selected) are copied out of shared memory into the new run and the block is
+    detached, so each process holds its own copy of the rows it loads.
+    """
+
+    def __init__(self, name, shape, years, meta, rows):
+        self.name = name
+        self.shape = shape
+        self.years = years
+        self.meta = meta
+        self.rows = rows
+
+    @classmethod
+    def create(cls, run):
+        """
+        Copy the values of ``run`` into a new block of shared memory
+
+        Returns
+        -------
+        :class:`multiprocessing.shared_memory.SharedMemory`, :class:`_SharedRun`
+            The shared memory block, which must be closed and unlinked by the
+            caller, and a handle to the run
+        """
+        ts = run.timeseries(time_axis="year")
+        values = ts.values.astype(float)
+
+        shm = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+        np.ndarray(values.shape, dtype=float, buffer=shm.buf)[:] = values
+
+        meta = ts.index.to_frame(index=False).astype("category")
+        return shm, cls(shm.name, values.shape, ts.columns.values, meta, None)
+
+    def subset(self, **filters):
+        """
+        Get a handle to the rows matching ``filters``
+        """
+        keep = np.ones(len(self.meta), dtype=bool)
+        for k, v in filters.items():
+            keep &= (self.meta[k] == v).values
+
+        return _SharedRun(
+            self.name,
+            self.shape,
+            self.years,
+            self.meta[keep].reset_index(drop=True),
+            np.where(keep)[0],
+        )
+
+    def load(self):
+        """
+        Load a copy of the selected rows as a :class:`scmdata.ScmRun`
+        """
+        shm = shared_memory.SharedMemory(name=self.name)
+        try:
+            values = np.ndarray(self.shape, dtype=float, buffer=shm.buf)
+            if self.rows is None:
+                values = values.copy()
+            else:
+                values = values[self.rows]
+        finally:
+            shm.close()
+
+        return scmdata.ScmRun(
+            values.T,
+            index=self.years,
+            columns={c: self.meta[c].tolist() for c in self.meta.columns},
+        )
+
+
+def _crunch_shared(cruncher_cls, output_db, country, baseline, option, kwargs):
+    cruncher = cruncher_cls(
+        output_db, country.load(), baseline.load(), *option, **kwargs
+    )
+    cruncher.crunch()
+
+    return cruncher.count - 1
+
+
+def crunch_all(
+    output_db,
+    country_emms,
+    baseline_emms,
+    options=None,
+    max_workers=None,
+    cruncher_cls=ArrayNDCCruncher,
+    **kwargs,
+):
+    """
+    Crunch combinations of options in parallel
+
+    The values of ``country_emms`` and ``baseline_emms`` are copied into shared
+    memory once. Each task is then only sent the metadata for its combination
+    of options rather than pickled copies of ``country_emms`` and
+    ``baseline_emms``. The workers do not compute on the shared memory
+    directly: each task copies the rows of ``country_emms`` for its combination
+    and all of ``baseline_emms`` out of shared memory, so a worker holds a copy
+    of the data for the combination it is crunching.
+
+    Parameters
+    ----------
+    output_db : :class:`scmdata.database.ScmDatabase`
+        Database to save the global pathways to
+
+    country_emms : :class:`scmdata.ScmRun`
+        Emissions of each submitted NDC
+
+    baseline_emms : :class:`scmdata.ScmRun`
+        Baseline emissions used for the countries which have not submitted
+
+    options : list[tuple[str, str, str, str]]
+        Combinations of (``conditionality``, ``ambition``, ``country_extension``,
+        ``exclude_hot_air``) to crunch. If None, every combination which occurs
+        in ``country_emms`` is crunched
+
+    max_workers : int
+        Maximum number of processes to use. If None, the number of processors
+        on the machine is used
+
+    cruncher_cls : type
+        Cruncher used for each combination
+
+    **kwargs
+        Passed to ``cruncher_cls``. If ``profile`` or ``checkpoint`` is a file,
+        the combination of options is added to its name (see
+        :func:`ndcs.profiling.add_suffix`) so each combination writes its own
+        report and checkpoint
+
+    Returns
+    -------
+    dict
+        Number of pathways produced for each combination of options
+    """
+    if options is None:
+        options = list(
+            country_emms.meta[list(OPTION_COLUMNS)]
+            .drop_duplicates()
+            .sort_values(list(OPTION_COLUMNS))
+            .itertuples(index=False, name=None)
+        )
+
+    country_shm, country = _SharedRun.create(country_emms)
+    baseline_shm, baseline = _SharedRun.create(baseline_emms)
+    try:
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            futures = {}
+            for option in options:
+                # Each worker writes its own report and checkpoint
+                option_kwargs = dict(kwargs)
+                for k in ["profile", "checkpoint"]:
+                    if isinstance(kwargs.get(k), str):
+                        option_kwargs[k] = add_suffix(kwargs[k], _option_suffix(option))
+
+                future = pool.submit(
+                    _crunch_shared,
+                    cruncher_cls,
+                    output_db,
+                    country.subset(**dict(zip(OPTION_COLUMNS, option))),
+                    baseline,
+                    option,
+                    option_kwargs,
+                )
+                futures[future] = option
+
+            res = {}
+            for future in tqdm(
+                as_completed(futures), total=len(futures), desc="options"
+            ):
+                res[futures[future]] = future.result()
+    finally:
+        for shm in (country_shm, baseline_shm):
+            shm.close()
+            shm.unlink()
+
+    return res
@@ -0,0 +1,221 @@
+"""
+Lightweight instrumentation of the pathway crunchers
+
+:class:`Profiler` accumulates the time spent in named phases and counters such
+as the number of pathways and bytes written. When profiling is disabled a
+:class:`NullProfiler` is used instead so the instrumented code only pays for a
+method call.
+"""
+
+import contextlib
+import json
+import logging
+import os
+import sys
+import time
+
+try:
+    import resource
+except ImportError:  # pragma: no cover
+    # Not available on Windows
+    resource = None
+
+from .utils import ensure_dir_exists
+
+logger = logging.getLogger(__name__)
+
+PROFILE_ENV_VAR = "NDCS_PROFILE"
+
+
+def get_peak_rss():
+    """
+    Get the peak resident set size of the current process
+
+    Returns
+    -------
+    int
+        Peak RSS in bytes or None if it cannot be determined
+    """
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in kilobytes on Linux and bytes on macOS
+    return int(peak) if sys.platform == "darwin" else int(peak) * 1024
+
+
+class Profiler:
+    """
+    Timers and counters for the phases of a long running process
+
+    Parameters
+    ----------
+    fname : str
+        File to write the JSON report to. If None, the report is only logged
+    """
+
+    enabled = True
+
+    def __init__(self, fname=None):
+        self.fname = fname
+        self._start = time.perf_counter()
+        self._times = {}
+        self._calls = {}
+        self._counters = {}
+
+    @contextlib.contextmanager
+    def time(self, phase):
+        """
+        Time a block of code as part of ``phase``
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._times[phase] = (
+                self._times.get(phase, 0.0) + time.perf_counter() - start
+            )
+            self._calls[phase] = self._calls.get(phase, 0) + 1
+
+    def count(self, name, n=1):
+        """
+        Increment the counter ``name`` by ``n``
+        """
+        self._counters[name] = self._counters.get(name, 0) + n
+
+    def report(self, **extra):
+        """
+        Get the report of the timers and counters
+
+        Parameters
+        ----------
+        **extra
+            Additional information to include in the report
+
+        Returns
+        -------
+        dict
+            ``wall_time`` since the profiler was created, the ``time`` and
+            number of ``calls`` of each phase, the ``counters`` and the
+            ``peak_rss`` in bytes
+        """
+        res = dict(extra)
+        res.update(
+            {
+                "wall_time": time.perf_counter() - self._start,
+                "phases": {
+                    p: {"time": self._times[p], "calls": self._calls[p]}
+                    for p in sorted(self._times)
+                },
+                "counters": dict(sorted(self._counters.items())),
+                "peak_rss": get_peak_rss(),
+            }
+        )
+
+        return res
+
+    def emit(self, **extra):
+        """
+        Log the report and write it to :attr:`fname` if provided
+
+        Returns
+        -------
+        dict
+            The report, see :meth:`report`
+        """
+        report = self.report(**extra)
+        logger.info("Profile: {}".format(json.dumps(report)))
+        if self.fname is not None:
+            ensure_dir_exists(self.fname)
+            with open(self.fname, "w") as fh:
+                json.dump(report, fh, indent=2)
+
+        return report
+
+
+class NullProfiler:
+    """
+    Profiler which does nothing
+    """
+
+    enabled = False
+
+    def time(self, phase):
+        return contextlib.nullcontext()
+
+    def count(self, name, n=1):
+        pass
+
+    def emit(self, **extra):
+        return None
+
+
+def add_suffix(fname, suffix):
+    """
+    Add a suffix to the name of a file before its extension
+
+    Characters which are not safe in filenames are replaced with ``_``.
+
+    Examples
+    --------
+    >>> add_suffix("profile.json", "C__high")
+    'profile_C__high.json'
+    """
+    suffix = "".join(c if c.isalnum() or c in "-_." else "_" for c in suffix)
+    root, ext = os.path.splitext(fname)
+
+    return "{}_{}{}".format(root, suffix, ext)
+
+
+def get_profiler(profile=None, suffix=None):
+    """
+    Get a profiler
+
+    Parameters
+    ----------
+    profile : bool or str
+        If True, profile and log the report. If a non-empty string, also write
+        the report to that file. ``False`` or ``""`` disables profiling. If
+        None, the ``NDCS_PROFILE`` environment variable is used in the same way
+        where ``"1"`` or ``"true"`` enables profiling and any other non-empty
+        value (other than ``"0"`` or ``"false"``) is the file to write the
+        report to.
+
+    suffix : str
+        Added to the name of the file given by ``NDCS_PROFILE`` (see
+        :func:`add_suffix`). Every process reads the same environment variable,
+        so this stops the reports of different runs (e.g. the workers of
+        :func:`ndcs.pathways.crunch_all`) overwriting each other. A file passed
+        as ``profile`` is used as is.
+
+    Returns
+    -------
+    :class:`Profiler` or :class:`NullProfiler`
+
+    Raises
+    ------
+    TypeError
+        ``profile`` is not a bool, str or None
+    """
+    if profile is not None and not isinstance(profile, (bool, str)):
+        raise TypeError(
+            "`profile` must be a bool, str or None, not {}".format(
+                type(profile).__name__
+            )
+        )
+
+    if profile is None:
+        profile = os.environ.get(PROFILE_ENV_VAR, "")
+        if profile.lower() in ("", "0", "false"):
+            profile = False
+        elif profile.lower() in ("1", "true"):
+            profile = True
+        elif suffix is not None:
+            profile = add_suffix(profile, suffix)
+
+    if not profile:
+        return NullProfiler()
+    if profile is True:
+        return Profiler()
+
+    return Profiler(profile)
@@ -0,0 +1,275 @@
+"""
+Streaming estimates of the quantiles of an infilling database
+
+:class:`QuantileSketch` summarises the distribution of each variable over the
+scenarios of a database with a t-digest [Dunning and Ertl, 2019]. The database
+is added chunk by chunk (e.g. one model at a time) so it never has to be held in
+memory as a single :class:`scmdata.ScmRun`, and sketches of different parts of
+a database can be merged.
+
+Dunning, T. and Ertl, O. (2019). Computing extremely accurate quantiles using
+t-digests. arXiv:1902.04023
+"""
+
+import numpy as np
+import pandas as pd
+import scmdata
+
+
+def _compress(means, weights, compression):
+    """
+    Merge sorted centroids so that each spans less than one unit of the k1 scale
+    function
+
+    Centroids in the tails have small weights so the extreme quantiles are
+    accurate.
+    """
+    total = weights.sum()
+    q = (np.cumsum(weights) - weights / 2) / total
+    k = np.floor(compression / (2 * np.pi) * np.arcsin(2 * q - 1))
+
+    starts = np.flatnonzero(np.r_[True, k[1:] != k[:-1]])
+    merged_weights = np.add.reduceat(weights, starts)
+    merged_means = np.add.reduceat(means * weights, starts) / merged_weights
+    if len(starts) == len(means):
+        # Nothing merged, avoid rounding errors in the means
+        merged_means = means
+
+    return merged_means, merged_weights
+
+
+class _Digest:
+    """
+    t-digest of a single cell (timeseries metadata and time)
+
+    Values are buffered and only compressed once the digest holds more than
+    ``buffer_factor * compression`` centroids, so cells with few values are
+    exact.
+    """
+
+    buffer_factor = 10
+
+    def __init__(self, compression):
+        self.compression = compression
+        self.means = np.array([])
+        self.weights = np.array([])
+        self.minimum = np.inf
+        self.maximum = -np.inf
+        self._buffer = []
+        self._n_buffered = 0
+
+    def add(self, means, weights=None):
+        if weights is None:
+            weights = np.ones_like(means)
+
+        self._buffer.append((means, weights))
+        self._n_buffered += len(means)
+        self.minimum = min(self.minimum, means.min())
+        self.maximum = max(self.maximum, means.max())
+        if len(self.means) + self._n_buffered > self._max_size:
+            self._flush()
+
+    def merge(self, other):
+        other._flush()
+        self.add(other.means, other.weights)
+        self.minimum = min(self.minimum, other.minimum)
+        self.maximum = max(self.maximum, other.maximum)
+
+    @property
+    def _max_size(self):
+        return self.buffer_factor * self.compression
+
+    def _flush(self):
+        if not self._buffer:
+            return
+
+        means, weights = zip(*self._buffer)
+        means = np.concatenate((self.means,) + means)
+        weights = np.concatenate((self.weights,) + weights)
+        order = np.argsort(means, kind="stable")
+        self.means, self.weights = means[order], weights[order]
+        # Raw values cannot be interpolated between compressed centroids, so
+        # once compressed everything is compressed
+        if len(self.means) > self._max_size or np.any(self.weights > 1):
+            self.means, self.weights = _compress(
+                self.means, self.weights, self.compression
+            )
+        self._buffer = []
+        self._n_buffered = 0
+
+    def quantiles(self, quantiles):
+        # Interpolate in rank space between the centres of the centroids. With
+        # unit weights this is the same as :func:`np.quantile` with linear
+        # interpolation.
+        self._flush()
+        total = self.weights.sum()
+        positions = np.cumsum(self.weights) - (self.weights + 1) / 2
+        positions = np.r_[0, positions, total - 1]
+        means = np.r_[self.minimum, self.means, self.maximum]
+
+        return np.interp(quantiles * (total - 1), positions, means)
+
+
+class QuantileSketch:
+    """
+    Mergeable estimate of the quantiles of each timeseries over scenarios
+
+    Equivalent to ``quantiles_over(("model", "scenario"), quantiles)`` on the
+    whole database, but the database can be added in chunks. Timeseries with the
+    same metadata (other than model and scenario) are summarised together.
+
+    The quantiles are exact while a timeseries has at most ``10 * compression``
+    values at a given time. Beyond that, the values are compressed into about
+    ``compression / 2`` centroids and the error in the rank of the quantiles is
+    of order ``1 / compression``.
+
+    Parameters
+    ----------
+    compression : float
+        Compression of the t-digests. Larger values are more accurate but
+        use more memory
+
+    over : tuple[str]
+        Metadata columns to calculate the quantiles over
+
+    Examples
+    --------
+    >>> sketch = QuantileSketch()
+    >>> for model in models:
+    ...     sketch.update(database.load(model=model))
+    >>> cruncher = EqualQuantileWalk_MM.from_sketch(sketch, bottom_up_gases)
+    """
+
+    def __init__(self, compression=200, over=("model", "scenario")):
+        self.compression = compression
+        self.over = tuple(over)
+        self.meta_cols = None
+        self._digests = {}
+
+    def __len__(self):
+        """
+        Number of timeseries metadata and time combinations in the sketch
+        """
+        return len(self._digests)
+
+    def _check_meta_cols(self, meta_cols):
+        if self.meta_cols is None:
+            self.meta_cols = meta_cols
+        elif meta_cols != self.meta_cols:
+            raise ValueError(
+                "Metadata columns differ from those already in the sketch: "
+                "{} != {}".format(meta_cols, self.meta_cols)
+            )
+
+    def update(self, run):
+        """
+        Add a chunk of the database
+
+        Parameters
+        ----------
+        run : :class:`scmdata.ScmRun`
+            Timeseries to add. Anything that :class:`scmdata.ScmRun` can be
+            initialised from (e.g. a :obj:`pyam.IamDataFrame`) is also accepted
+
+        Returns
+        -------
+        :class:`QuantileSketch`
+            The updated sketch
+
+        Raises
+        ------
+        ValueError
+            ``run`` does not have the same metadata columns as the previous
+            chunks
+        """
+        if not isinstance(run, scmdata.ScmRun):
+            run = scmdata.ScmRun(run)
+
+        meta_cols = tuple(sorted(set(run.meta_attributes) - set(self.over)))
+        self._check_meta_cols(meta_cols)
+
+        ts = run.timeseries()
+        for meta, group in ts.groupby(level=list(meta_cols), sort=False):
+            if not isinstance(meta, tuple):  # pragma: no cover
+                meta = (meta,)
+            values = group.values
+            for i, time in enumerate(group.columns):
+                v = values[:, i]
+                v = v[~np.isnan(v)]
+                if not len(v):
+                    continue
+
+                key = (meta, time)
+                if key not in self._digests:
+                    self._digests[key] = _Digest(self.compression)
+                self._digests[key].add(v)
+
+        return self
+
+    def merge(self, other):
+        """
+        Merge another sketch into this one
+
+        Parameters
+        ----------
+        other : :class:`QuantileSketch`
+            Sketch of another part of the database
+
+        Returns
+        -------
+        :class:`QuantileSketch`
+            The updated sketch
+        """
+        if other.over != self.over:
+            raise ValueError("Cannot merge sketches over different columns")
+        if other.meta_cols is None:
+            return self
+
+        self._check_meta_cols(other.meta_cols)
+        for key, digest in other._digests.items():
+            if key not in self._digests:
+                self._digests[key] = _Digest(self.compression)
+            self._digests[key].merge(digest)
+
+        return self
+
+    def quantiles(self, quantiles):
+        """
+        Estimate the quantiles
+
+        Parameters
+        ----------
+        quantiles : list[float]
+            Quantiles to estimate
+
+        Returns
+        -------
+        :class:`pandas.DataFrame`
+            The quantiles of the timeseries, like the output of
+            :meth:`scmdata.ScmRun.quantiles_over`. Each quantile is labelled in
+            the ``quantile`` level of the index. Times without data are NaN
+        """
+        if not self._digests:
+            raise ValueError("No data in the sketch")
+
+        quantiles = np.asarray(quantiles, dtype=float)
+        times = sorted({time for _, time in self._digests})
+        time_idx = {time: i for i, time in enumerate(times)}
+        metas = list(dict.fromkeys(meta for meta, _ in self._digests))
+        meta_idx = {meta: i for i, meta in enumerate(metas)}
+
+        values = np.full((len(metas), len(quantiles), len(times)), np.nan)
+        for (meta, time), digest in self._digests.items():
+            values[meta_idx[meta], :, time_idx[time]] = digest.quantiles(quantiles)
+
+        index = pd.DataFrame(
+            [meta + (q,) for meta in metas for q in quantiles],
+            columns=list(self.meta_cols) + ["quantile"],
+        )
+        index = pd.MultiIndex.from_frame(index)
+
+        return pd.DataFrame(
+            values.reshape(-1, len(times)),
+            index=index,
+            columns=pd.Index(times, dtype="object", name="time"),
+        )
@@ -1,10 +1,28 @@
 import numpy as np
+import pandas as pd
 import pytest
 import scmdata
+import scmdata.database
+import logging
 import os
+from unittest import mock
 
+from ndcs.cache import RunCache, make_key
 from ndcs.constants import PROCESSED_DATA_DIR, NDC_TARGET_RELEASE, LEAD
-from ndcs.infilling import EqualQuantileWalk_MM, kyoto_ghg_exclude_co2_vars, calc_ghg
+from ndcs.infilling import (
+    DEFAULT_QUANTILES,
+    EqualQuantileWalk_MM,
+    TimeDepRatio,
+    TimeseriesExtender,
+    extend_timeseries,
+    infill_all,
+    kyoto_ghg_exclude_co2_vars,
+    calc_ghg,
+    _get_chunks,
+    _interp,
+)
+from ndcs.infilling_database import InfillingDatabase
+from ndcs.quantile_sketch import QuantileSketch
 
 YEARS_TO_INFILL = [2015] + list(range(2020, 2100 + 1, 5))
 
@@ -22,6 +40,27 @@ def infilling_database():
     )
 
 
+@pytest.fixture()
+def synthetic_database():
+    rng = np.random.default_rng(0)
+    gases = {"Emissions|CH4": "Mt CH4/yr", "Emissions|N2O": "kt N2O/yr"}
+    n_scenarios = 20
+
+    return scmdata.ScmRun(
+        rng.uniform(1, 100, size=(len(YEARS_TO_INFILL), n_scenarios * len(gases))),
+        index=YEARS_TO_INFILL,
+        columns={
+            "model": "model",
+            "scenario": [
+                "scenario{}".format(i) for i in range(n_scenarios) for _ in gases
+            ],
+            "region": "World",
+            "variable": list(gases) * n_scenarios,
+            "unit": list(gases.values()) * n_scenarios,
+        },
+    ).to_iamdataframe()
+
+
 @pytest.fixture()
 def scenarios():
     extended_scenario_all = scmdata.ScmRun(
@@ -110,3 +149,696 @@ def test_mm_infilling_multi(infilling_database, scenarios):
     scenario_cum_ghg = infilled_scenario.filter(variable=LEAD).values.sum(axis=1)
 
     np.testing.assert_allclose(infilled_cum_ghg, scenario_cum_ghg, rtol=0.001)
+
+
+def test_mm_infilling_all_followers(infilling_database, scenarios):
+    cruncher = EqualQuantileWalk_MM(infilling_database, kyoto_ghg_exclude_co2_vars)
+    scenarios = scenarios.to_iamdataframe()
+
+    exp = []
+    for v in kyoto_ghg_exclude_co2_vars:
+        infiller = cruncher.derive_relationship(v, [LEAD], include_quantile=True)
+        exp.append(scmdata.ScmRun(infiller(scenarios)))
+    exp = scmdata.run_append(exp).timeseries().sort_index()
+
+    infiller = cruncher.derive_relationships(
+        kyoto_ghg_exclude_co2_vars, [LEAD], include_quantile=True
+    )
+    res = scmdata.ScmRun(infiller(scenarios)).timeseries().sort_index()
+
+    assert res.index.equals(exp.index)
+    np.testing.assert_allclose(res.values, exp.values)
+
+
+def test_interp():
+    rng = np.random.default_rng(0)
+    xp = np.sort(rng.uniform(0, 10, size=(5, 20)), axis=1)
+    # Repeated x-coordinates, e.g. harmonised emissions
+    xp[1] = 4.0
+    xp[2, 5:10] = xp[2, 5]
+    fp = rng.uniform(0, 1, size=(5, 20))
+    x = rng.uniform(-2, 12, size=(5, 30))
+    x[:, :20] = xp
+    x[0, 0] = np.nan
+
+    res = _interp(x, xp, fp)
+    for i in range(len(x)):
+        np.testing.assert_array_equal(res[i], np.interp(x[i], xp[i], fp[i]))
+
+
+def test_interp_shared_xp():
+    rng = np.random.default_rng(1)
+    xp = np.linspace(0.01, 0.99, 99)
+    fp = np.sort(rng.uniform(0, 10, size=(3, 5, 99)), axis=-1)
+    x = rng.uniform(0, 1, size=(5, 30))
+    x[0, :10] = xp[:10]
+    x[1, 0] = np.nan
+
+    res = _interp(x, xp, fp)
+    assert res.shape == (3, 5, 30)
+    for k in range(3):
+        for i in range(5):
+            np.testing.assert_array_equal(res[k, i], np.interp(x[i], xp, fp[k, i]))
+
+
+def test_mm_infilling_cache(synthetic_database, tmpdir):
+    gases = ["Emissions|CH4", "Emissions|N2O"]
+    cruncher = EqualQuantileWalk_MM(synthetic_database, gases, cache_dir=str(tmpdir))
+    assert len(RunCache(str(tmpdir), "equal_quantile_walk").entries()) == 1
+
+    with mock.patch.object(
+        scmdata.ScmRun, "quantiles_over", side_effect=AssertionError
+    ):
+        cached = EqualQuantileWalk_MM(synthetic_database, gases, cache_dir=str(tmpdir))
+
+    for attr in ["_db_quantiles", "_db_ghg"]:
+        exp = getattr(cruncher, attr).timeseries().sort_index()
+        res = getattr(cached, attr).timeseries().sort_index()
+        assert res.index.equals(exp.index)
+        np.testing.assert_array_equal(res.values, exp.values)
+    np.testing.assert_array_equal(cached._ghg_table, cruncher._ghg_table)
+
+    # Changing the bottom up gases is a different entry
+    EqualQuantileWalk_MM(synthetic_database, gases[:1], cache_dir=str(tmpdir))
+    assert len(RunCache(str(tmpdir), "equal_quantile_walk").entries()) == 2
+
+
+def test_mm_infilling_cache_env_var(synthetic_database, tmpdir, monkeypatch):
+    monkeypatch.setenv("NDCS_INFILLING_CACHE_DIR", str(tmpdir))
+    EqualQuantileWalk_MM(synthetic_database, ["Emissions|CH4"])
+
+    assert len(RunCache(str(tmpdir), "equal_quantile_walk").entries()) == 1
+
+
+def test_make_key(synthetic_database):
+    data = synthetic_database.data
+    key = make_key(data, np.arange(0.01, 1, 0.01), ["Emissions|CH4"])
+
+    # The order of the rows does not matter
+    assert make_key(data.iloc[::-1], np.arange(0.01, 1, 0.01), ["Emissions|CH4"]) == key
+
+    changed = data.copy()
+    changed.loc[0, "value"] += 1
+    assert make_key(changed, np.arange(0.01, 1, 0.01), ["Emissions|CH4"]) != key
+    assert make_key(data, np.arange(0.05, 1, 0.05), ["Emissions|CH4"]) != key
+    assert make_key(data, np.arange(0.01, 1, 0.01), ["Emissions|N2O"]) != key
+
+
+def test_run_cache_eviction(synthetic_database, tmpdir):
+    cache = RunCache(str(tmpdir), "test", max_entries=2)
+    run = scmdata.ScmRun(synthetic_database)
+
+    for i, key in enumerate(["a", "b", "c"]):
+        cache.save(key, {"run": run})
+        # Ensure the modification times differ
+        os.utime(cache.get_fname(key), (i, i))
+    assert cache.entries() == [cache.get_fname("c"), cache.get_fname("b")]
+
+    # Loading marks an entry as recently used
+    res = cache.load("b")["run"]
+    exp = run.timeseries().sort_index()
+    assert res.timeseries().sort_index().index.equals(exp.index)
+
+    cache.save("d", {"run": run})
+    assert cache.entries() == [cache.get_fname("d"), cache.get_fname("b")]
+    assert cache.load("a") is None
+
+
+def _infill(cruncher, lead):
+    gases = ["Emissions|CH4", "Emissions|N2O"]
+    res = cruncher.derive_relationships(gases, [LEAD], include_quantile=True)(lead)
+    return scmdata.ScmRun(res).timeseries().sort_index()
+
+
+@pytest.fixture()
+def synthetic_lead(synthetic_database):
+    ghg = calc_ghg(
+        scmdata.ScmRun(synthetic_database), ["Emissions|CH4", "Emissions|N2O"]
+    )
+    lead = ghg.filter(scenario=["scenario3", "scenario7"]) * 1.05
+    lead["variable"] = LEAD
+    return lead.to_iamdataframe()
+
+
+def test_mm_infilling_quantiles(synthetic_database, synthetic_lead):
+    quantiles = [0.05, 0.25, 0.5, 0.75, 0.95]
+    gases = ["Emissions|CH4", "Emissions|N2O"]
+    cruncher = EqualQuantileWalk_MM(synthetic_database, gases, quantiles=quantiles)
+
+    np.testing.assert_array_equal(cruncher.quantiles, quantiles)
+    assert sorted(cruncher._db_quantiles.get_unique_meta("quantile")) == quantiles
+
+    res = scmdata.ScmRun(_infill(cruncher, synthetic_lead))
+    quantile_values = res.filter(variable="*|Quantile").values
+    assert quantile_values.min() >= 0.05
+    assert quantile_values.max() <= 0.95
+
+
+@pytest.mark.parametrize(
+    "quantiles,match",
+    [
+        ([0.5], "Expected at least two quantiles"),
+        ([0.5, 0.1], "Quantiles must be strictly increasing"),
+        ([0.5, 0.5], "Quantiles must be strictly increasing"),
+        ([0.5, 1.5], "Quantiles must be between 0 and 1"),
+    ],
+)
+def test_mm_infilling_quantiles_invalid(synthetic_database, quantiles, match):
+    with pytest.raises(ValueError, match=match):
+        EqualQuantileWalk_MM(synthetic_database, ["Emissions|CH4"], quantiles=quantiles)
+
+
+def test_quantile_sketch(synthetic_database):
+    run = scmdata.ScmRun(synthetic_database)
+    exp = run.quantiles_over(("model", "scenario"), DEFAULT_QUANTILES)
+
+    sketch = QuantileSketch()
+    for scenario in run.get_unique_meta("scenario"):
+        sketch.update(run.filter(scenario=scenario))
+    res = sketch.quantiles(DEFAULT_QUANTILES)
+
+    # Small databases are not compressed
+    pd.testing.assert_frame_equal(res.sort_index(), exp.sort_index(), rtol=1e-12)
+
+
+def test_quantile_sketch_large():
+    rng = np.random.default_rng(1)
+    values = rng.lognormal(size=(2, 10000))
+
+    def _chunk(start, stop):
+        return scmdata.ScmRun(
+            values[:, start:stop],
+            index=[2015, 2020],
+            columns={
+                "model": "model",
+                "scenario": ["scenario{}".format(i) for i in range(start, stop)],
+                "region": "World",
+                "variable": "Emissions|CH4",
+                "unit": "Mt CH4/yr",
+            },
+        )
+
+    # Build in chunks and merge, as if from several processes
+    sketches = []
+    for i in range(0, 10000, 2500):
+        sketch = QuantileSketch(compression=100)
+        for j in range(i, i + 2500, 500):
+            sketch.update(_chunk(j, j + 500))
+        sketches.append(sketch)
+    sketch = sketches[0]
+    for other in sketches[1:]:
+        sketch.merge(other)
+
+    quantiles = [0.01, 0.1, 0.5, 0.9, 0.99]
+    res = sketch.quantiles(quantiles)
+    assert res.shape == (len(quantiles), 2)
+
+    # The ranks of the estimates are close to the requested quantiles
+    for i, year in enumerate([2015, 2020]):
+        ranks = (values[i][:, np.newaxis] <= res.iloc[:, i].values).mean(axis=0)
+        np.testing.assert_allclose(ranks, quantiles, atol=0.005)
+
+
+def test_quantile_sketch_meta_mismatch(synthetic_database):
+    run = scmdata.ScmRun(synthetic_database)
+    sketch = QuantileSketch().update(run)
+
+    run["climate_model"] = "MAGICC"
+    with pytest.raises(ValueError, match="Metadata columns differ"):
+        sketch.update(run)
+
+
+def test_mm_infilling_from_sketch(synthetic_database, synthetic_lead):
+    gases = ["Emissions|CH4", "Emissions|N2O"]
+    sketch = QuantileSketch().update(synthetic_database)
+
+    cruncher = EqualQuantileWalk_MM.from_sketch(sketch, gases)
+    exp = EqualQuantileWalk_MM(synthetic_database, gases)
+
+    res = _infill(cruncher, synthetic_lead)
+    exp = _infill(exp, synthetic_lead)
+    assert res.index.equals(exp.index)
+    np.testing.assert_allclose(res.values, exp.values, rtol=1e-12)
+
+
+def test_mm_infilling_scmrun(synthetic_database, synthetic_lead):
+    gases = ["Emissions|CH4", "Emissions|N2O"]
+    cruncher = EqualQuantileWalk_MM(synthetic_database, gases)
+    lead = scmdata.ScmRun(synthetic_lead)
+
+    res = cruncher.derive_scmrun_relationships(gases, [LEAD], include_quantile=True)(
+        lead
+    )
+    assert isinstance(res, scmdata.ScmRun)
+    res = res.timeseries().sort_index()
+    exp = _infill(cruncher, synthetic_lead)
+    assert res.index.equals(exp.index)
+    np.testing.assert_array_equal(res.values, exp.values)
+
+    lead_ts = lead.timeseries(time_axis="year")
+    quantiles, values = cruncher.infill_values(
+        lead_ts.columns.values, lead_ts.values, gases
+    )
+    assert quantiles.shape == lead_ts.shape
+    assert values.shape == (len(gases),) + lead_ts.shape
+    index = lead_ts.index.droplevel(["variable", "unit"])
+    for gas, gas_values in zip(gases, values):
+        exp_gas = exp.xs(gas, level="variable").droplevel("unit")
+        exp_gas = exp_gas.reorder_levels(index.names).loc[index]
+        np.testing.assert_array_equal(gas_values, exp_gas.values)
+
+    with pytest.raises(ValueError, match="Not all the years are in the database"):
+        cruncher.infill_values([2101], lead_ts.values[:, :1], gases)
+    with pytest.raises(ValueError, match="No data in the database for Emissions|SF6"):
+        cruncher.infill_values(
+            lead_ts.columns.values, lead_ts.values, ["Emissions|SF6"]
+        )
+
+
+@pytest.mark.parametrize("cruncher_cls", [EqualQuantileWalk_MM, TimeDepRatio])
+@pytest.mark.parametrize("max_workers", [1, 2])
+def test_infill_all(
+    synthetic_database, synthetic_lead, tmp_path, cruncher_cls, max_workers
+):
+    gases = ["Emissions|CH4", "Emissions|N2O"]
+    database = scmdata.ScmRun(synthetic_database)
+    database = database.append(calc_ghg(database, gases))
+    if cruncher_cls is EqualQuantileWalk_MM:
+        cruncher = EqualQuantileWalk_MM(synthetic_database, gases)
+        exp = cruncher.derive_scmrun_relationships(gases, [LEAD])(
+            scmdata.ScmRun(synthetic_lead)
+        )
+    else:
+        cruncher = TimeDepRatio(database)
+        exp = scmdata.run_append(
+            [
+                cruncher.derive_scmrun_relationship(gas, [LEAD])(
+                    scmdata.ScmRun(synthetic_lead)
+                )
+                for gas in gases
+            ]
+        )
+
+    output_db = scmdata.database.ScmDatabase(
+        str(tmp_path), levels=("variable", "scenario")
+    )
+    res = infill_all(
+        cruncher,
+        scmdata.ScmRun(synthetic_lead),
+        gases,
+        output_db,
+        chunk_size=1,
+        max_workers=max_workers,
+    )
+    assert res == len(exp)
+
+    res = output_db.load(disable_tqdm=True).timeseries().sort_index()
+    exp = exp.timeseries().sort_index()
+    assert res.index.equals(exp.index)
+    np.testing.assert_allclose(res.values, exp.values)
+
+
+def test_get_chunks(synthetic_lead, caplog):
+    lead = scmdata.ScmRun(synthetic_lead)
+
+    chunks = _get_chunks(lead, ("variable", "scenario"), chunk_size=1)
+    assert [c.get_unique_meta("scenario") for c in chunks] == [
+        ["scenario3"],
+        ["scenario7"],
+    ]
+    assert not caplog.records
+
+    # Timeseries saved to the same file are not split
+    chunks = _get_chunks(lead, ("variable", "model"), chunk_size=1)
+    assert len(chunks) == 1
+    assert len(chunks[0]) == len(lead)
+    assert "infilled in a single chunk" in caplog.text
+
+
+@pytest.mark.parametrize("chunk_size,warns", [(1, True), (2, False)])
+def test_get_chunks_no_shared_levels(synthetic_lead, chunk_size, warns, caplog):
+    lead = scmdata.ScmRun(synthetic_lead)
+
+    # None of the levels are in the metadata of the scenarios
+    with caplog.at_level(logging.WARNING, logger="ndcs.infilling"):
+        chunks = _get_chunks(lead, ("variable", "pathway_id"), chunk_size=chunk_size)
+    assert len(chunks) == 1
+    assert ("infilled in a single chunk" in caplog.text) == warns
+
+
+@pytest.fixture()
+def signed_database():
+    rng = np.random.default_rng(2)
+    n_scenarios = 30
+    years = [2015, 2020, 2030]
+    lead = rng.uniform(-50, 100, size=(len(years), n_scenarios))
+    follower = rng.uniform(1, 10, size=(len(years), n_scenarios))
+
+    return scmdata.ScmRun(
+        np.hstack([lead, follower]),
+        index=years,
+        columns={
+            "model": "model",
+            "scenario": ["scenario{}".format(i) for i in range(n_scenarios)] * 2,
+            "region": "World",
+            "variable": ["Emissions|CO2"] * n_scenarios
+            + ["Emissions|CH4"] * n_scenarios,
+            "unit": ["Mt CO2/yr"] * n_scenarios + ["Mt CH4/yr"] * n_scenarios,
+        },
+    )
+
+
+@pytest.mark.parametrize("same_sign", [True, False])
+@pytest.mark.parametrize("only_consistent_cases", [True, False])
+def test_time_dep_ratio(signed_database, same_sign, only_consistent_cases):
+    cruncher = TimeDepRatio(signed_database.to_iamdataframe())
+    filler = cruncher.derive_relationship(
+        "Emissions|CH4",
+        ["Emissions|CO2"],
+        same_sign=same_sign,
+        only_consistent_cases=only_consistent_cases,
+    )
+
+    lead_values = signed_database.filter(variable="Emissions|CO2").values
+    follower_values = signed_database.filter(variable="Emissions|CH4").values
+
+    target = signed_database.filter(
+        variable="Emissions|CO2", scenario=["scenario1", "scenario2", "scenario3"]
+    )
+    target_values = target.timeseries().values
+    res = scmdata.ScmRun(filler(target.to_iamdataframe()))
+    assert res.get_unique_meta("variable", True) == "Emissions|CH4"
+    assert res.get_unique_meta("unit", True) == "Mt CH4/yr"
+
+    # Reference calculation one year and one scenario at a time
+    exp = np.zeros_like(target_values)
+    for j in range(target_values.shape[1]):
+        pos = lead_values[:, j] > 0
+        for i, value in enumerate(target_values[:, j]):
+            if not same_sign:
+                ratio = np.mean(follower_values[:, j]) / np.mean(lead_values[:, j])
+            elif value > 0:
+                ratio = np.nanmean(follower_values[pos, j]) / np.nanmean(
+                    lead_values[pos, j]
+                )
+            else:
+                ratio = np.nanmean(follower_values[~pos, j]) / np.nanmean(
+                    lead_values[~pos, j]
+                )
+            exp[i, j] = value * ratio
+
+    np.testing.assert_allclose(res.timeseries().values, exp, rtol=1e-12)
+
+
+def test_time_dep_ratio_unseen_sign(signed_database):
+    database = scmdata.ScmRun(
+        np.abs(signed_database.timeseries().values.T),
+        index=signed_database["year"].unique(),
+        columns=signed_database.meta.to_dict("list"),
+    )
+    filler = TimeDepRatio(database.to_iamdataframe()).derive_relationship(
+        "Emissions|CH4", ["Emissions|CO2"]
+    )
+
+    target = signed_database.filter(variable="Emissions|CO2", scenario="scenario1")
+    target = target * -1
+    with pytest.raises(ValueError, match="has a sign not seen in the infiller"):
+        filler(target.to_iamdataframe())
+
+
+@pytest.mark.parametrize("same_sign", [True, False])
+def test_time_dep_ratio_scmrun(signed_database, same_sign, caplog, capsys):
+    target = signed_database.filter(
+        variable="Emissions|CO2", scenario=["scenario1", "scenario2", "scenario3"]
+    )
+    exp = TimeDepRatio(signed_database.to_iamdataframe()).derive_relationship(
+        "Emissions|CH4", ["Emissions|CO2"], same_sign=same_sign
+    )(target.to_iamdataframe())
+    exp = scmdata.ScmRun(exp).timeseries().sort_index()
+
+    filler = TimeDepRatio(signed_database).derive_scmrun_relationship(
+        "Emissions|CH4", ["Emissions|CO2"], same_sign=same_sign
+    )
+    caplog.clear()
+    capsys.readouterr()
+    with caplog.at_level(logging.WARNING, logger="ndcs.infilling"):
+        res = filler(target)
+    assert isinstance(res, scmdata.ScmRun)
+    res = res.timeseries().sort_index()
+
+    # The negative lead is logged rather than printed
+    assert "goes negative" in caplog.text
+    assert not capsys.readouterr().out
+
+    assert res.index.equals(exp.index)
+    np.testing.assert_array_equal(res.values, exp.values)
+
+
+def test_calc_ghg(synthetic_database):
+    run = scmdata.ScmRun(synthetic_database)
+    run = run.filter(scenario="scenario1", variable="Emissions|N2O", keep=False)
+    # A scenario where all the gases are missing in a year
+    ts = run.timeseries(time_axis="year")
+    ts.loc[ts.index.get_level_values("scenario") == "scenario2", 2020] = np.nan
+    run = scmdata.ScmRun(ts)
+
+    gases = ["Emissions|CH4", "Emissions|N2O"]
+    contexts = ["AR6GWP100", "AR5GWP100", "AR4GWP100"]
+    res = calc_ghg(run, gases, var_name="Test", context=contexts)
+
+    assert len(res) == len(contexts) * len(run.get_unique_meta("scenario"))
+    assert res.get_unique_meta("unit", True) == "Mt CO2 / yr"
+    for context in contexts:
+        res_context = res.filter(variable="Emissions|Test ({})".format(context))
+        assert len(res_context) == len(run.get_unique_meta("scenario"))
+
+        exp = (
+            run.convert_unit("Mt CO2 / yr", context=context)
+            .timeseries()
+            .groupby(["model", "region", "scenario"])
+            .sum(min_count=1)
+        )
+        res_context = res_context.timeseries().reset_index(["unit", "variable"])
+        res_context = res_context.drop(columns=["unit", "variable"]).sort_index()
+        pd.testing.assert_frame_equal(
+            res_context,
+            exp.sort_index(),
+            check_names=False,
+            check_column_type=False,
+            rtol=1e-12,
+        )
+        assert np.isnan(res_context.xs("scenario2", level="scenario").iloc[0, 1])
+
+    single = calc_ghg(run, gases, var_name="Test", context="AR5GWP100")
+    assert single.get_unique_meta("variable", True) == "Emissions|Test (AR5GWP100)"
+    np.testing.assert_allclose(
+        single.timeseries().sort_index().values,
+        res.filter(variable="*AR5GWP100*").timeseries().sort_index().values,
+        rtol=1e-12,
+    )
+
+
+@pytest.fixture()
+def extension_database(synthetic_database):
+    return calc_ghg(
+        scmdata.ScmRun(synthetic_database), ["Emissions|CH4", "Emissions|N2O"]
+    )
+
+
+@pytest.fixture()
+def pathways(extension_database):
+    ts = extension_database.filter(
+        scenario=["scenario1", "scenario4", "scenario9"], year=range(2015, 2051)
+    ).timeseries(time_axis="year")
+    ts = ts.reindex(columns=range(2015, 2051)).interpolate(axis=1) * 1.02
+    # One pathway ends earlier
+    ts.loc[ts.index.get_level_values("scenario") == "scenario4", 2031:] = np.nan
+    pathways = scmdata.ScmRun(ts)
+    pathways["pathway_id"] = pathways["scenario"]
+    pathways["stage"] = "harmonised"
+
+    return pathways
+
+
+@pytest.mark.parametrize("smoothing", [0, 0.5])
+def test_timeseries_extender(extension_database, pathways, smoothing):
+    extender = TimeseriesExtender(extension_database, smoothing=smoothing)
+    res = extender.extend(pathways)
+
+    assert res.get_unique_meta("stage", True) == "extended"
+    assert res["year"].max() == 2100
+    assert not np.isnan(res.values).any()
+
+    exp = []
+    for pathway_id in pathways.get_unique_meta("pathway_id"):
+        pathway = pathways.filter(pathway_id=pathway_id)
+        pathway = scmdata.ScmRun(pathway.timeseries().dropna(axis=1))
+        exp.append(extend_timeseries(extension_database, pathway, smoothing=smoothing))
+    exp = scmdata.run_append(exp).timeseries().sort_index()
+
+    res = res.timeseries().sort_index()
+    assert res.index.equals(exp.index)
+    np.testing.assert_array_equal(res.values, exp.values)
+
+    res_parallel = extender.extend(pathways, max_workers=2, chunk_size=1)
+    np.testing.assert_array_equal(
+        res_parallel.timeseries().sort_index().values, res.values
+    )
+
+
+@pytest.mark.parametrize("smoothing", [0, 0.5])
+def test_timeseries_extender_silicone(extension_database, pathways, smoothing):
+    from silicone.time_projectors import ExtendLatestTimeQuantile
+
+    res = TimeseriesExtender(extension_database, smoothing=smoothing).extend(pathways)
+
+    cruncher = ExtendLatestTimeQuantile(
+        extension_database.filter(year=range(2015, 2101, 5)).to_iamdataframe()
+    )
+    filler = cruncher.derive_relationship(LEAD, smoothing=smoothing)
+    exp = []
+    for pathway_id in pathways.get_unique_meta("pathway_id"):
+        pathway = pathways.filter(pathway_id=pathway_id)
+        pathway = scmdata.ScmRun(pathway.timeseries().dropna(axis=1))
+        pathway["variable"] = LEAD
+        exp.append(
+            scmdata.ScmRun(pathway.append(filler(pathway.to_iamdataframe())))
+            .resample("AS")
+            .timeseries()
+        )
+    exp = pd.concat(exp).sort_index()
+
+    res = res.timeseries().sort_index()
+    np.testing.assert_array_equal(res.values, exp.values)
+    np.testing.assert_array_equal(res.columns.values, exp.columns.values)
+
+
+@pytest.mark.parametrize(
+    "end_year,match",
+    [
+        (2100, "does not extend in time past"),
+        (2033, "not in the infiller database"),
+    ],
+)
+def test_timeseries_extender_invalid(extension_database, pathways, end_year, match):
+    pathways = pathways.filter(scenario="scenario1")
+    ts = pathways.timeseries(time_axis="year")
+    ts = ts.reindex(columns=range(2015, end_year + 1)).ffill(axis=1)
+    extender = TimeseriesExtender(extension_database)
+
+    with pytest.raises(ValueError, match=match):
+        extender.extend(scmdata.ScmRun(ts))
+
+
+def test_infilling_database(synthetic_database, tmp_path):
+    run = scmdata.ScmRun(synthetic_database)
+    database = InfillingDatabase(run)
+
+    assert database.variables == ["Emissions|CH4", "Emissions|N2O"]
+    np.testing.assert_array_equal(database.years, YEARS_TO_INFILL)
+    assert database.get_unit("Emissions|N2O") == "kt N2O/yr"
+    assert "Emissions|CH4" in database
+    assert database.copy() is database
+
+    values = database.values("Emissions|CH4", 2030)
+    assert values.flags["C_CONTIGUOUS"]
+    assert not values.flags["WRITEABLE"]
+    np.testing.assert_array_equal(
+        values, run.filter(variable="Emissions|CH4", year=2030).values.squeeze()
+    )
+    assert database.values("Emissions|CH4").shape == (len(YEARS_TO_INFILL), 20)
+
+    exp = run.timeseries(time_axis="year").sort_index()
+    res = database.to_run().timeseries(time_axis="year").sort_index()
+    assert res.index.equals(exp.index)
+    np.testing.assert_array_equal(res.values, exp.values)
+
+    exp = run.quantiles_over(("model", "scenario"), quantiles=DEFAULT_QUANTILES)
+    exp.columns = [t.year for t in exp.columns]
+    res = database.quantiles(DEFAULT_QUANTILES)
+    assert res.sort_index().index.equals(exp.sort_index().index)
+    np.testing.assert_array_equal(res.sort_index().values, exp.sort_index().values)
+
+    fname = str(tmp_path / "database.csv")
+    run.to_csv(fname)
+    loaded = InfillingDatabase.from_csv(fname)
+    assert loaded.variables == database.variables
+    np.testing.assert_allclose(
+        loaded.values("Emissions|CH4"), database.values("Emissions|CH4")
+    )
+    assert InfillingDatabase(run).key == database.key
+
+    with pytest.raises(ValueError, match="No data for `variable`"):
+        database.values("Emissions|SF6")
+    with pytest.raises(ValueError, match="No data for year 2101"):
+        database.values("Emissions|CH4", 2101)
+
+
+def test_infilling_database_quantiles_grouped(synthetic_database):
+    run = scmdata.ScmRun(synthetic_database)
+    run["climate_model"] = "a"
+    other = run.filter(variable="Emissions|CH4") * 2
+    other["climate_model"] = "b"
+    run = run.append(other)
+
+    exp = run.quantiles_over(("model", "scenario"), quantiles=DEFAULT_QUANTILES)
+    exp.columns = [t.year for t in exp.columns]
+    res = InfillingDatabase(run).quantiles(DEFAULT_QUANTILES)
+    # Each climate model has its own quantiles
+    assert len(res) == 3 * len(DEFAULT_QUANTILES)
+    assert res.sort_index().index.equals(exp.sort_index().index)
+    np.testing.assert_array_equal(res.sort_index().values, exp.sort_index().values)
+
+
+def test_infilling_database_invalid(synthetic_database):
+    run = scmdata.ScmRun(synthetic_database)
+
+    mixed_units = run.copy()
+    mixed_units["unit"] = [
+        "Gt CH4/yr" if s == "scenario1" and u == "Mt CH4/yr" else u
+        for s, u in zip(mixed_units["scenario"], mixed_units["unit"])
+    ]
+    with pytest.raises(ValueError, match="Variables with more than one unit"):
+        InfillingDatabase(mixed_units)
+
+
+def test_infilling_database_shared(synthetic_database, synthetic_lead, pathways):
+    gases = ["Emissions|CH4", "Emissions|N2O"]
+    run = scmdata.ScmRun(synthetic_database)
+    run = run.append(calc_ghg(run, gases))
+    database = InfillingDatabase(run)
+
+    def _compare(res, exp, **kwargs):
+        res = res.timeseries(time_axis="year").sort_index()
+        exp = exp.timeseries(time_axis="year").sort_index()
+        assert res.index.equals(exp.index)
+        np.testing.assert_allclose(res.values, exp.values, **kwargs)
+
+    _compare(calc_ghg(database, gases), calc_ghg(run, gases), rtol=1e-14)
+
+    lead = scmdata.ScmRun(synthetic_lead)
+    _compare(
+        EqualQuantileWalk_MM(database, gases).derive_scmrun_relationships(
+            gases, [LEAD]
+        )(lead),
+        EqualQuantileWalk_MM(synthetic_database, gases).derive_scmrun_relationships(
+            gases, [LEAD]
+        )(lead),
+        rtol=1e-14,
+    )
+
+    _compare(
+        TimeDepRatio(database).derive_scmrun_relationship("Emissions|CH4", [LEAD])(
+            lead
+        ),
+        TimeDepRatio(run.to_iamdataframe()).derive_scmrun_relationship(
+            "Emissions|CH4", [LEAD]
+        )(lead),
+        rtol=0,
+    )
+
+    _compare(
+        TimeseriesExtender(database).extend(pathways),
+        TimeseriesExtender(run).extend(pathways),
+        rtol=0,
+    )
@@ -0,0 +1,761 @@
+import datetime as dt
+import glob
+import json
+import os
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+import pytest
+import scmdata
+import scmdata.database
+
+import ndcs.pathways
+from ndcs.contributions import ContributionStore
+from ndcs.pathway_meta import PathwayMetaStore
+from ndcs.profiling import get_profiler
+from ndcs.pathways import (
+    NDCCruncher,
+    ArrayNDCCruncher,
+    MultiNDCCruncher,
+    BaselineRemainder,
+    SubmissionIndex,
+    get_buffered_database,
+    get_latest,
+    process_ndc,
+    process_all_ndcs,
+    crunch_all,
+    sum_country_emissions,
+)
+
+YEARS = list(range(2010, 2051))
+REGIONS = ["AAA", "BBB", "CCC", "DDD", "EEE"]
+SUBMISSIONS = [
+    # region, submission_date, scenario
+    ("AAA", dt.date(2016, 4, 22), "HighInitialNDC"),
+    ("BBB", dt.date(2016, 4, 22), "HighInitialNDC"),
+    ("CCC", dt.date(2016, 9, 3), "HighInitialNDC"),
+    ("AAA", dt.date(2020, 12, 12), "HighNDC"),
+    ("DDD", dt.date(2021, 10, 18), "HighNDC"),
+    ("BBB", dt.date(2021, 10, 18), "HighNDC"),
+]
+
+
+@pytest.fixture()
+def country_emms():
+    rng = np.random.default_rng(0)
+    return scmdata.ScmRun(
+        rng.uniform(10, 100, size=(len(YEARS), len(SUBMISSIONS))),
+        index=YEARS,
+        columns={
+            "model": "NDC Factsheet",
+            "scenario": [s[2] for s in SUBMISSIONS],
+            "region": [s[0] for s in SUBMISSIONS],
+            "variable": "Emissions|Total GHG excl. LULUCF|SSP1BL",
+            "unit": "Mt CO2 /yr",
+            "submission_date": [s[1] for s in SUBMISSIONS],
+            "ambition": "high",
+            "conditionality": "C",
+            "country_extension": "SSP1BL",
+            "exclude_hot_air": "exclude",
+        },
+    )
+
+
+@pytest.fixture()
+def baseline_emms():
+    rng = np.random.default_rng(1)
+    return scmdata.ScmRun(
+        rng.uniform(10, 100, size=(len(YEARS), len(REGIONS))),
+        index=YEARS,
+        columns={
+            "model": "SSP",
+            "scenario": "SSP1BL",
+            "region": REGIONS,
+            "variable": "Emissions|Total GHG",
+            "unit": "Mt CO2 /yr",
+        },
+    )
+
+
+@pytest.fixture()
+def global_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        ndcs.pathways, "GLOBAL_DATABASE_META_DIR", str(tmp_path / "meta")
+    )
+    return scmdata.database.ScmDatabase(
+        str(tmp_path / "global"),
+        levels=(
+            "ambition",
+            "conditionality",
+            "country_extension",
+            "exclude_hot_air",
+            "pathway_id",
+            "global_extension",
+        ),
+    )
+
+
+@pytest.fixture()
+def buffered_db(tmp_path, global_db):
+    return get_buffered_database(str(tmp_path / "buffered"))
+
+
+def _crunch(cls, global_db, country_emms, baseline_emms, **kwargs):
+    cruncher = cls(
+        global_db,
+        country_emms,
+        baseline_emms,
+        "C",
+        "high",
+        "SSP1BL",
+        "exclude",
+        **kwargs,
+    )
+    cruncher.crunch()
+    return cruncher
+
+
+def _load_meta(meta_dir=None):
+    if meta_dir is None:
+        meta_dir = ndcs.pathways.GLOBAL_DATABASE_META_DIR
+
+    res = {}
+    for fname in glob.glob(
+        os.path.join(meta_dir, "**", "*.json"),
+        recursive=True,
+    ):
+        with open(fname) as fh:
+            meta = json.load(fh)
+        meta["missing"] = sorted(meta["missing"])
+        res[meta["pathway_id"]] = meta
+    return res
+
+
+def test_crunch(global_db, country_emms, baseline_emms):
+    _crunch(NDCCruncher, global_db, country_emms, baseline_emms)
+
+    res = global_db.load(disable_tqdm=True)
+    assert len(res) == len(SUBMISSIONS)
+
+    latest = res.filter(pathway_num=len(SUBMISSIONS))
+    exp = (
+        country_emms.filter(scenario="HighNDC").values.sum(axis=0)
+        + country_emms.filter(region="CCC").values.squeeze()
+        + baseline_emms.filter(region="EEE").values.squeeze()
+    )
+    np.testing.assert_allclose(latest.values.squeeze(), exp)
+
+    meta = _load_meta()["2021-10-18_2"]
+    assert meta["last_country"] == "DDD"
+    assert meta["missing"] == ["EEE"]
+    assert meta["selected"] == {
+        "AAA": "2020-12-12",
+        "BBB": "2021-10-18",
+        "CCC": "2016-09-03",
+        "DDD": "2021-10-18",
+    }
+
+
+def test_baseline_remainder(baseline_emms):
+    remainder = BaselineRemainder(baseline_emms)
+    np.testing.assert_allclose(remainder.values, baseline_emms.values.sum(axis=0))
+
+    remainder.update(["AAA", "CCC", "ZZZ"])
+    assert remainder.missing == ["BBB", "DDD", "EEE"]
+    np.testing.assert_allclose(
+        remainder.values,
+        baseline_emms.filter(region=["BBB", "DDD", "EEE"]).values.sum(axis=0),
+    )
+
+    remainder.update(["AAA"])
+    assert remainder.missing == ["BBB", "CCC", "DDD", "EEE"]
+    np.testing.assert_allclose(
+        remainder.values,
+        baseline_emms.filter(region="AAA", keep=False).values.sum(axis=0),
+    )
+
+
+def test_sum_country_emissions_remainder(country_emms, baseline_emms):
+    submitted = country_emms.filter(scenario="HighInitialNDC")
+
+    exp, exp_selected, exp_missing = sum_country_emissions(submitted, baseline_emms)
+    res, selected, missing = sum_country_emissions(
+        submitted, BaselineRemainder(baseline_emms)
+    )
+
+    np.testing.assert_allclose(res.values, exp.values)
+    assert selected == exp_selected
+    assert sorted(missing) == sorted(exp_missing) == ["DDD", "EEE"]
+
+
+def test_submission_index(country_emms):
+    index = SubmissionIndex(country_emms)
+    assert index.regions == ["AAA", "BBB", "CCC", "DDD"]
+
+    res = index.as_of(dt.date(2020, 12, 12))
+    assert res["region"].tolist() == ["AAA", "BBB", "CCC"]
+    assert res["submission_date"].tolist() == [
+        dt.date(2020, 12, 12),
+        dt.date(2016, 4, 22),
+        dt.date(2016, 9, 3),
+    ]
+    assert index.as_of(dt.date(2000, 1, 1)).empty
+
+    res = index.as_of(dt.date(2020, 12, 12), before=True)
+    assert res["region"].tolist() == ["AAA", "BBB", "CCC"]
+    assert res["submission_date"].tolist() == [
+        dt.date(2016, 4, 22),
+        dt.date(2016, 4, 22),
+        dt.date(2016, 9, 3),
+    ]
+
+    res = index.submitted_on(dt.date(2021, 10, 18))
+    assert sorted(res["region"]) == ["BBB", "DDD"]
+    assert index.submitted_on(dt.date(2000, 1, 1)).empty
+
+    latest = get_latest(country_emms)
+    assert latest["region"].tolist() == ["AAA", "BBB", "CCC", "DDD"]
+    np.testing.assert_allclose(
+        latest.filter(region="BBB").values,
+        country_emms.filter(region="BBB", scenario="HighNDC").values,
+    )
+
+
+def test_get_latest_tie_break(country_emms):
+    revised = country_emms.filter(region="CCC") * 2
+    revised["last_provided_year"] = 2050
+    country_emms["last_provided_year"] = 2030
+    country_emms = scmdata.run_append([country_emms, revised])
+
+    # The first of the tied timeseries is used by default
+    res = get_latest(country_emms).filter(region="CCC")
+    assert res["last_provided_year"].tolist() == [2030]
+
+    res = get_latest(country_emms, tie_break=["last_provided_year"])
+    assert res["region"].tolist() == ["AAA", "BBB", "CCC", "DDD"]
+    np.testing.assert_allclose(res.filter(region="CCC").values, revised.values)
+
+
+def _add_same_date_submission(country_emms):
+    # A second submission by BBB on the same date which is after the existing one
+    # in the run but before it when sorted by scenario
+    extra = country_emms.filter(region="BBB", scenario="HighNDC") * 1.5
+    extra["scenario"] = "ExtraNDC"
+    return scmdata.run_append([country_emms, extra])
+
+
+@pytest.mark.parametrize("same_date", [False, True])
+def test_array_cruncher_matches(
+    same_date, tmp_path, global_db, country_emms, baseline_emms, monkeypatch
+):
+    if same_date:
+        country_emms = _add_same_date_submission(country_emms)
+
+    _crunch(NDCCruncher, global_db, country_emms, baseline_emms)
+    exp = global_db.load(disable_tqdm=True).timeseries().sort_index()
+    exp_meta = _load_meta()
+
+    monkeypatch.setattr(
+        ndcs.pathways, "GLOBAL_DATABASE_META_DIR", str(tmp_path / "meta_array")
+    )
+    global_db.delete()
+    _crunch(ArrayNDCCruncher, global_db, country_emms, baseline_emms)
+    res = global_db.load(disable_tqdm=True).timeseries().sort_index()
+
+    assert res.index.equals(exp.index)
+    np.testing.assert_allclose(res.values, exp.values)
+    assert _load_meta() == exp_meta
+
+
+@pytest.mark.parametrize(
+    "levels,flush_every,exp_writes",
+    [
+        (None, None, 1),
+        (None, 4, 2),
+        (("ambition", "conditionality"), None, 1),
+        (("ambition", "conditionality"), 4, 2),
+    ],
+)
+@pytest.mark.parametrize("cls", [NDCCruncher, ArrayNDCCruncher])
+def test_buffered_writes(
+    cls,
+    levels,
+    flush_every,
+    exp_writes,
+    tmp_path,
+    global_db,
+    country_emms,
+    baseline_emms,
+):
+    _crunch(cls, global_db, country_emms, baseline_emms)
+    exp = global_db.load(disable_tqdm=True).timeseries()
+
+    if levels is None:
+        buffered_db = get_buffered_database(str(tmp_path / "grouped"))
+    else:
+        buffered_db = scmdata.database.ScmDatabase(
+            str(tmp_path / "grouped"), levels=levels
+        )
+
+    backend = buffered_db._backend
+    with mock.patch.object(backend, "save", wraps=backend.save) as save:
+        _crunch(
+            cls,
+            buffered_db,
+            country_emms,
+            baseline_emms,
+            buffer_writes=True,
+            flush_every=flush_every,
+        )
+
+    # One write per file and flush
+    assert save.call_count == exp_writes
+    assert len(buffered_db.available_data()) == 1
+    res = buffered_db.load(disable_tqdm=True).timeseries()
+    res = res.reorder_levels(exp.index.names).sort_index()
+    exp = exp.sort_index()
+    assert res.index.equals(exp.index)
+    np.testing.assert_allclose(res.values, exp.values)
+
+
+@pytest.mark.parametrize("cls", [NDCCruncher, ArrayNDCCruncher])
+def test_buffered_writes_pathway_id_level(cls, global_db, country_emms, baseline_emms):
+    with pytest.raises(ValueError, match="pathway_id"):
+        _crunch(cls, global_db, country_emms, baseline_emms, buffer_writes=True)
+
+
+@pytest.mark.parametrize("buffer_writes", [True, False])
+@pytest.mark.parametrize("cls", [NDCCruncher, ArrayNDCCruncher])
+def test_meta_store(
+    cls, buffer_writes, tmp_path, global_db, buffered_db, country_emms, baseline_emms
+):
+    if buffer_writes:
+        global_db = buffered_db
+    _crunch(cls, global_db, country_emms, baseline_emms)
+    exp_meta = _load_meta()
+
+    global_db.delete()
+    store = PathwayMetaStore(str(tmp_path / "meta.sqlite"))
+    _crunch(
+        cls,
+        global_db,
+        country_emms,
+        baseline_emms,
+        meta_store=store,
+        buffer_writes=buffer_writes,
+    )
+
+    pathways = store.pathways()
+    assert pathways["pathway_num"].tolist() == list(range(1, len(SUBMISSIONS) + 1))
+    assert store.pathways(last_country="AAA")["pathway_id"].tolist() == [
+        "2016-04-22_1",
+        "2020-12-12_1",
+    ]
+    assert store.pathways(date="2021-10-18")["last_country"].tolist() == [
+        "BBB",
+        "DDD",
+    ]
+    assert (
+        store.load("high", "C", "SSP1BL", "exclude", "2021-10-18_2")
+        == exp_meta["2021-10-18_2"]
+    )
+
+    store.export_json(str(tmp_path / "exported"))
+    assert _load_meta(str(tmp_path / "exported")) == exp_meta
+
+
+@pytest.mark.parametrize("in_order", [True, False])
+def test_meta_store_replace(in_order, tmp_path, global_db, country_emms, baseline_emms):
+    _crunch(NDCCruncher, global_db, country_emms, baseline_emms)
+    exp_meta = _load_meta()
+    records = sorted(exp_meta.values(), key=lambda m: m["pathway_num"])
+    if not in_order:
+        records = records[::-1]
+
+    store = PathwayMetaStore(str(tmp_path / "meta.sqlite"))
+    store.add_many([dict(m, date=m["pathway_id"][:10]) for m in records])
+
+    # Replace a pathway in the middle of the store
+    replaced = dict(exp_meta["2016-09-03_1"], date="2016-09-03")
+    replaced["selected"] = {"CCC": "2016-09-03"}
+    replaced["missing"] = ["AAA", "BBB", "DDD", "EEE"]
+    store.add(replaced)
+    exp_meta["2016-09-03_1"] = {k: v for k, v in replaced.items() if k != "date"}
+
+    res = {m["pathway_id"]: m for m in store.iter_records()}
+    assert res == exp_meta
+    for pathway_id, meta in exp_meta.items():
+        assert store.load("high", "C", "SSP1BL", "exclude", pathway_id) == meta
+
+
+@pytest.mark.parametrize("buffer_writes", [True, False])
+@pytest.mark.parametrize("cls", [NDCCruncher, ArrayNDCCruncher])
+def test_resume_from_checkpoint(
+    cls, buffer_writes, tmp_path, global_db, buffered_db, country_emms, baseline_emms
+):
+    if buffer_writes:
+        global_db = buffered_db
+    _crunch(cls, global_db, country_emms, baseline_emms)
+    exp = global_db.load(disable_tqdm=True).timeseries().sort_index()
+
+    global_db.delete()
+    checkpoint = str(tmp_path / "checkpoint.pkl")
+    earlier_release = country_emms.filter(scenario="HighNDC", keep=False)
+    cruncher = _crunch(
+        cls,
+        global_db,
+        earlier_release,
+        baseline_emms,
+        checkpoint=checkpoint,
+        buffer_writes=buffer_writes,
+    )
+    assert cruncher.count == len(earlier_release) + 1
+
+    with mock.patch.object(global_db, "save", wraps=global_db.save) as save:
+        cruncher = _crunch(
+            cls, global_db, country_emms, baseline_emms, checkpoint=checkpoint
+        )
+        # Only the pathways for the updated NDCs are crunched
+        assert save.call_count == len(SUBMISSIONS) - len(earlier_release)
+
+    assert cruncher.count == len(SUBMISSIONS) + 1
+    res = global_db.load(disable_tqdm=True).timeseries().sort_index()
+    assert res.index.equals(exp.index)
+    np.testing.assert_allclose(res.values, exp.values)
+
+
+def test_resume_changed_history(tmp_path, global_db, country_emms, baseline_emms):
+    checkpoint = str(tmp_path / "checkpoint.pkl")
+    _crunch(
+        NDCCruncher,
+        global_db,
+        country_emms.filter(region="CCC", keep=False),
+        baseline_emms,
+        checkpoint=checkpoint,
+    )
+
+    with pytest.raises(ValueError, match="have changed since the checkpoint"):
+        _crunch(
+            NDCCruncher, global_db, country_emms, baseline_emms, checkpoint=checkpoint
+        )
+
+
+def test_crunch_all(global_db, country_emms, baseline_emms):
+    unconditional = country_emms * 0.9
+    unconditional["conditionality"] = "U"
+    country_emms = scmdata.run_append([country_emms, unconditional])
+
+    for option in [
+        ("C", "high", "SSP1BL", "exclude"),
+        ("U", "high", "SSP1BL", "exclude"),
+    ]:
+        NDCCruncher(global_db, country_emms, baseline_emms, *option).crunch()
+    exp = global_db.load(disable_tqdm=True).timeseries().sort_index()
+
+    global_db.delete()
+    res = crunch_all(global_db, country_emms, baseline_emms, max_workers=2)
+    assert res == {
+        ("C", "high", "SSP1BL", "exclude"): len(SUBMISSIONS),
+        ("U", "high", "SSP1BL", "exclude"): len(SUBMISSIONS),
+    }
+
+    res = global_db.load(disable_tqdm=True).timeseries().sort_index()
+    assert res.index.equals(exp.index)
+    np.testing.assert_allclose(res.values, exp.values)
+
+
+def test_crunch_all_observed_options(global_db, country_emms, baseline_emms):
+    unconditional = country_emms * 0.9
+    unconditional["conditionality"] = "U"
+    low = country_emms * 1.1
+    low["ambition"] = "low"
+    # There is no U/low combination
+    country_emms = scmdata.run_append([country_emms, unconditional, low])
+
+    res = crunch_all(global_db, country_emms, baseline_emms, max_workers=1)
+    assert res == {
+        ("C", "high", "SSP1BL", "exclude"): len(SUBMISSIONS),
+        ("C", "low", "SSP1BL", "exclude"): len(SUBMISSIONS),
+        ("U", "high", "SSP1BL", "exclude"): len(SUBMISSIONS),
+    }
+
+
+def test_crunch_all_checkpoint(tmp_path, global_db, country_emms, baseline_emms):
+    unconditional = country_emms * 0.9
+    unconditional["conditionality"] = "U"
+    country_emms = scmdata.run_append([country_emms, unconditional])
+    options = [("C", "high", "SSP1BL", "exclude"), ("U", "high", "SSP1BL", "exclude")]
+
+    crunch_all(global_db, country_emms, baseline_emms, max_workers=2)
+    exp = global_db.load(disable_tqdm=True).timeseries().sort_index()
+
+    global_db.delete()
+    checkpoint = str(tmp_path / "checkpoint.pkl")
+    earlier_release = country_emms.filter(scenario="HighNDC", keep=False)
+    crunch_all(
+        global_db, earlier_release, baseline_emms, max_workers=2, checkpoint=checkpoint
+    )
+    assert sorted(f for f in os.listdir(tmp_path) if f.startswith("checkpoint")) == [
+        "checkpoint_C__high__SSP1BL__exclude.pkl",
+        "checkpoint_U__high__SSP1BL__exclude.pkl",
+    ]
+
+    # Each combination resumes from its own checkpoint
+    res = crunch_all(
+        global_db, country_emms, baseline_emms, max_workers=2, checkpoint=checkpoint
+    )
+    assert res == {option: len(SUBMISSIONS) for option in options}
+
+    res = global_db.load(disable_tqdm=True).timeseries().sort_index()
+    assert res.index.equals(exp.index)
+    np.testing.assert_allclose(res.values, exp.values)
+
+
+@pytest.mark.parametrize("from_env", [True, False])
+def test_crunch_all_profile(
+    from_env, tmp_path, global_db, country_emms, baseline_emms, monkeypatch
+):
+    unconditional = country_emms * 0.9
+    unconditional["conditionality"] = "U"
+    country_emms = scmdata.run_append([country_emms, unconditional])
+
+    fname = str(tmp_path / "profile.json")
+    kwargs = {}
+    if from_env:
+        monkeypatch.setenv("NDCS_PROFILE", fname)
+    else:
+        kwargs["profile"] = fname
+    crunch_all(global_db, country_emms, baseline_emms, max_workers=2, **kwargs)
+
+    assert sorted(os.listdir(tmp_path)) == [
+        "global",
+        "meta",
+        "profile_C__high__SSP1BL__exclude.json",
+        "profile_U__high__SSP1BL__exclude.json",
+    ]
+    for conditionality in ["C", "U"]:
+        with open(
+            str(
+                tmp_path
+                / "profile_{}__high__SSP1BL__exclude.json".format(conditionality)
+            )
+        ) as fh:
+            report = json.load(fh)
+        assert report["options"]["conditionality"] == conditionality
+        assert report["counters"]["pathways"] == len(SUBMISSIONS)
+
+
+@pytest.mark.parametrize("same_date", [False, True])
+def test_multi_cruncher(same_date, tmp_path, global_db, country_emms, baseline_emms):
+    unconditional = country_emms.filter(region="DDD", keep=False) * 0.9
+    unconditional["conditionality"] = "U"
+    if same_date:
+        country_emms = _add_same_date_submission(country_emms)
+    country_emms = scmdata.run_append([country_emms, unconditional])
+    options = [
+        ("C", "high", "SSP1BL", "exclude"),
+        ("U", "high", "SSP1BL", "exclude"),
+    ]
+
+    exp_meta = {}
+    for option in options:
+        NDCCruncher(global_db, country_emms, baseline_emms, *option).crunch()
+        exp_meta[option[0]] = _load_meta(
+            os.path.join(ndcs.pathways.GLOBAL_DATABASE_META_DIR, "high", option[0])
+        )
+    exp = global_db.load(disable_tqdm=True).timeseries().sort_index()
+
+    global_db.delete()
+    store = PathwayMetaStore(str(tmp_path / "meta.sqlite"))
+    with mock.patch.object(global_db, "save", wraps=global_db.save) as save:
+        MultiNDCCruncher(
+            global_db, country_emms, baseline_emms, meta_store=store
+        ).crunch()
+    assert save.call_count == 1
+
+    res = global_db.load(disable_tqdm=True).timeseries().sort_index()
+    assert res.index.equals(exp.index)
+    np.testing.assert_allclose(res.values, exp.values)
+
+    for conditionality, meta in exp_meta.items():
+        res_meta = {
+            m["pathway_id"]: dict(m, missing=sorted(m["missing"]))
+            for m in store.iter_records(conditionality=conditionality)
+        }
+        assert res_meta == meta
+
+
+def test_array_cruncher_mismatched_years(global_db, country_emms, baseline_emms):
+    with pytest.raises(ValueError, match="same years"):
+        ArrayNDCCruncher(
+            global_db,
+            country_emms,
+            baseline_emms.filter(year=range(2015, 2051)),
+            "C",
+            "high",
+            "SSP1BL",
+            "exclude",
+        )
+
+
+@pytest.mark.parametrize("cls", [NDCCruncher, ArrayNDCCruncher])
+def test_iter_pathways(
+    cls, tmp_path, global_db, country_emms, baseline_emms, monkeypatch
+):
+    _crunch(cls, global_db, country_emms, baseline_emms)
+    exp = global_db.load(disable_tqdm=True).timeseries().sort_index()
+    exp_meta = _load_meta()
+
+    global_db.delete()
+    meta_dir = str(tmp_path / "meta_iter")
+    monkeypatch.setattr(ndcs.pathways, "GLOBAL_DATABASE_META_DIR", meta_dir)
+    cruncher = cls(
+        global_db, country_emms, baseline_emms, "C", "high", "SSP1BL", "exclude"
+    )
+
+    pathways = []
+    for global_emms, pathway_meta in cruncher.iter_pathways():
+        assert len(global_emms) == 1
+        assert (
+            global_emms.get_unique_meta("pathway_id", True)
+            == pathway_meta["pathway_id"]
+        )
+        pathways.append(global_emms)
+        assert exp_meta[pathway_meta["pathway_id"]] == dict(
+            pathway_meta, missing=sorted(pathway_meta["missing"])
+        )
+    assert len(pathways) == len(SUBMISSIONS)
+
+    # Nothing is written
+    assert not global_db.available_data().size
+    assert not os.path.exists(meta_dir)
+
+    res = scmdata.run_append(pathways).timeseries().sort_index()
+    assert res.index.equals(exp.index)
+    np.testing.assert_allclose(res.values, exp.values)
+
+
+def test_process_all_ndcs(country_emms):
+    latest = get_latest(country_emms)
+    unconditional = latest * 0.9
+    unconditional["conditionality"] = "U"
+    low = latest.filter(region="AAA", keep=False) * 1.1
+    low["ambition"] = "low"
+    latest = scmdata.run_append([latest, unconditional, low])
+    latest = latest.timeseries()
+    latest.iloc[0, 3] = np.nan
+    latest = scmdata.ScmRun(latest)
+
+    res = process_all_ndcs(latest)
+    assert len(res) == 3
+    for c, a in [("C", "high"), ("U", "high"), ("C", "low")]:
+        exp = process_ndc(latest, c, a, "SSP1BL")
+        np.testing.assert_allclose(
+            res.filter(conditionality=c, ambition=a).values, exp.values
+        )
+        assert res.filter(conditionality=c, ambition=a).meta.to_dict(
+            "records"
+        ) == exp.meta.to_dict("records")
+
+
+@pytest.mark.parametrize("cls", [NDCCruncher, ArrayNDCCruncher])
+def test_contributions(cls, tmp_path, global_db, country_emms, baseline_emms):
+    store = ContributionStore(str(tmp_path / "contributions"))
+    _crunch(cls, global_db, country_emms, baseline_emms, contribution_store=store)
+
+    pathways = global_db.load(disable_tqdm=True).timeseries(
+        meta=["pathway_num"], time_axis="year"
+    )
+    pathways = pathways.sort_index().values
+    previous = np.vstack([baseline_emms.values.sum(axis=0), pathways[:-1]])
+
+    res = store.load("high", "C", "SSP1BL", "exclude")
+    assert res["pathway_num"].tolist() == list(range(1, len(SUBMISSIONS) + 1))
+    assert res["last_country"].tolist() == ["AAA", "BBB", "CCC", "AAA", "BBB", "DDD"]
+    np.testing.assert_allclose(res.values, pathways - previous)
+
+    # AAA's second submission replaces its first rather than the baseline
+    np.testing.assert_allclose(
+        res.filter(pathway_id="2020-12-12_1").values[0],
+        country_emms.filter(region="AAA").values[1]
+        - country_emms.filter(region="AAA").values[0],
+    )
+
+
+def test_contribution_store_chunks(tmp_path):
+    store = ContributionStore(str(tmp_path / "contributions"))
+    key = dict(
+        ambition="high",
+        conditionality="C",
+        country_extension="SSP1BL",
+        exclude_hot_air="exclude",
+    )
+
+    def _record(pathway_num, value):
+        return dict(
+            key,
+            pathway_id="2020-01-01_{}".format(pathway_num),
+            pathway_num=pathway_num,
+            date="2020-01-01",
+            last_country="AAA",
+            unit="Mt CO2 /yr",
+            contribution=pd.Series([value, value], index=[2020, 2030]),
+        )
+
+    store.add_many([_record(1, 1.0), _record(2, 2.0)])
+    store.add_many([_record(3, 3.0)])
+    # Replaces the contribution of the second pathway
+    store.add_many([_record(2, 4.0)])
+
+    # Each call adds a file rather than rewriting the existing contributions
+    assert len(os.listdir(store.get_dir(*key.values()))) == 3
+
+    res = store.load(*key.values())
+    assert res["pathway_num"].tolist() == [1, 2, 3]
+    np.testing.assert_allclose(res.values, [[1, 1], [4, 4], [3, 3]])
+
+
+@pytest.mark.parametrize("cls", [NDCCruncher, ArrayNDCCruncher])
+def test_profile(cls, tmp_path, global_db, country_emms, baseline_emms):
+    fname = str(tmp_path / "profile.json")
+    cruncher = _crunch(cls, global_db, country_emms, baseline_emms, profile=fname)
+
+    with open(fname) as fh:
+        report = json.load(fh)
+    assert report == cruncher.profile_report
+    assert report["cruncher"] == cls.__name__
+    assert report["options"]["conditionality"] == "C"
+    assert report["counters"]["pathways"] == len(SUBMISSIONS)
+    pathway_files = glob.glob(str(tmp_path / "global" / "**" / "*.nc"), recursive=True)
+    assert len(pathway_files) == len(SUBMISSIONS)
+    assert report["counters"]["pathway_bytes"] == sum(
+        os.path.getsize(fname) for fname in pathway_files
+    )
+    meta_files = glob.glob(
+        os.path.join(ndcs.pathways.GLOBAL_DATABASE_META_DIR, "**", "*.json"),
+        recursive=True,
+    )
+    assert len(meta_files) == len(SUBMISSIONS)
+    assert report["counters"]["meta_bytes"] == sum(
+        os.path.getsize(fname) for fname in meta_files
+    )
+    assert {"build", "meta", "save", "select", "sum"} <= set(report["phases"])
+    assert report["phases"]["save"]["calls"] == len(SUBMISSIONS)
+    assert report["peak_rss"] > 0
+
+
+def test_profile_env_var(global_db, country_emms, baseline_emms, monkeypatch):
+    cruncher = _crunch(NDCCruncher, global_db, country_emms, baseline_emms)
+    assert cruncher.profile_report is None
+
+    for profile in [False, ""]:
+        assert not get_profiler(profile).enabled
+    for profile in [0, 1, 1.0]:
+        with pytest.raises(TypeError, match="must be a bool, str or None"):
+            get_profiler(profile)
+
+    global_db.delete()
+    monkeypatch.setenv("NDCS_PROFILE", "1")
+    cruncher = _crunch(NDCCruncher, global_db, country_emms, baseline_emms)
+    assert cruncher.profile_report["counters"]["pathways"] == len(SUBMISSIONS)